@@ -0,0 +1,8 @@
+"""
+Throughput benchmarks for the trademark parser.
+
+    python -m benchmark.generate work_dir/bench.xml --cases 20000
+    python -m benchmark extract --cases 5000
+    python -m benchmark load --cases 5000
+    python -m benchmark compare old.json new.json
+"""
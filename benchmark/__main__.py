@@ -0,0 +1,221 @@
+"""
+Runs the benchmarks and saves cases/sec and rows/sec to JSON.
+
+    python -m benchmark extract --cases 5000
+    python -m benchmark extract --cases 5000 --parser target
+    python -m benchmark load --cases 5000 --batch-size 2000
+    python -m benchmark memory --cases 1000000
+    python -m benchmark compare benchmark-old.json benchmark-new.json
+    python -m benchmark download
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+from benchmark.download import check_download
+from benchmark.generate import FIRST_SERIAL, generate
+from benchmark.loaders import NullLoader
+from benchmark.memory import bench_memory
+from case_spec import CASE_FILE_HEADER_ITEMS, extract_case
+from case_target import TargetReader
+from helpers import get_text_or_none
+from loader import TABLES
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def result(cases, rows, seconds, **extra):
+    d = {'cases': cases, 'rows': rows, 'seconds': round(seconds, 4),
+         'cases_per_sec': round(cases / seconds, 1) if seconds else None,
+         'rows_per_sec': round(rows / seconds, 1) if seconds else None}
+    d.update(extra)
+    return d
+
+
+def bench_xpath_fields(filename):
+    """
+    Header fields the way parse_case read them before CASE_SPEC: one XPath string per field
+    """
+    cases = 0
+    start_time = time.time()
+    for event, case in etree.iterparse(filename, events=('end',), tag='case-file'):
+        for item in CASE_FILE_HEADER_ITEMS:
+            get_text_or_none(case, 'case-file-header/' + item.replace('_', '-') + '/text()')
+        cases += 1
+        case.clear()
+    return result(cases, cases, time.time() - start_time)
+
+
+def bench_extract_case(filename):
+    cases = rows = 0
+    start_time = time.time()
+    for event, case in etree.iterparse(filename, events=('end',), tag='case-file'):
+        doc_id = int(get_text_or_none(case, 'serial-number/text()'))
+        rows += sum(len(lst) for lst in extract_case(case, doc_id, 0).values())
+        cases += 1
+        case.clear()
+    return result(cases, rows, time.time() - start_time)
+
+
+def bench_target_extract(filename):
+    """
+    The same rows as extract_case, built by the parser target without an element tree
+    """
+    cases = rows = 0
+    start_time = time.time()
+    with open(filename, 'rb') as source:
+        for doc_id, case_rows in TargetReader().cases(source, 0):
+            rows += sum(len(lst) for lst in case_rows.values())
+            cases += 1
+    return result(cases, rows, time.time() - start_time)
+
+
+def bench_parse_null(filename, options):
+    import tm_parser
+    tm_parser.args = options
+    loader = NullLoader()
+    start_time = time.time()
+    with open(filename, 'rb') as source:
+        tm_parser.parse_source(source, 0, None, 'benchmark', loader=loader)
+    return result(loader.cases, loader.rows, time.time() - start_time)
+
+
+def table_counts(dbc):
+    cur = dbc.cnx.cursor()
+    counts = {}
+    for table in TABLES:
+        cur.execute('SELECT count(*) FROM {0}'.format(table))
+        counts[table] = cur.fetchone()[0]
+    dbc.cnx.commit()
+    cur.close()
+    return counts
+
+
+def bench_load(filename, options):
+    """
+    parse_file against the database from settings.py, best run on an empty schema
+    """
+    import tm_parser
+    from db_pgsql import Db
+    tm_parser.args = options
+    name = 'bench%s.xml' % int(time.time())
+    os.makedirs(tm_parser.WORK_DIR, exist_ok=True)
+    shutil.copy(filename, os.path.join(tm_parser.WORK_DIR, name))
+    dbc = Db()
+    try:
+        file_id = dbc.file_insert({'url': 'benchmark://' + name, 'size': os.path.getsize(filename),
+                                   'date_string': time.strftime('%Y-%m-%d')}, name)
+        before = table_counts(dbc)
+        start_time = time.time()
+        tm_parser.parse_file(name, file_id, dbc=dbc)
+        seconds = time.time() - start_time
+        after = table_counts(dbc)
+    finally:
+        dbc.close()
+    cases = after['trademark_app_case_files'] - before['trademark_app_case_files']
+    rows = sum(after.values()) - sum(before.values())
+    per_table = dict((table, after[table] - before[table]) for table in TABLES)
+    return result(cases, rows, seconds, tables=per_table)
+
+
+def compare(old_filename, new_filename):
+    with open(old_filename) as f:
+        old = json.load(f)
+    with open(new_filename) as f:
+        new = json.load(f)
+    print('%-20s %14s %14s %8s' % ('benchmark', old['commit'], new['commit'], 'ratio'))
+    for name, new_result in sorted(new['results'].items()):
+        old_result = old['results'].get(name)
+        if old_result is None or not old_result.get('cases_per_sec'):
+            continue
+        for metric in ('cases_per_sec', 'rows_per_sec'):
+            print('%-20s %14s %14s %8.2f' % (name + ' ' + metric.split('_')[0], old_result[metric],
+                                             new_result[metric], new_result[metric] / old_result[metric]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the trademark parser.')
+    parser.add_argument('command', choices=('extract', 'load', 'memory', 'all', 'compare', 'download'))
+    parser.add_argument('files', nargs='*', help='two result files for compare')
+    parser.add_argument('--cases', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--first-serial', type=int, default=FIRST_SERIAL,
+                        help='first generated serial number, change it to load into a non-empty schema')
+    parser.add_argument('--verbose', action='store_true', help='keep the per case-file log lines')
+    parser.add_argument('--max-growth', type=float, default=64,
+                        help='memory fails when the peak RSS grows more MB than this after a tenth of the file')
+    parser.add_argument('--input', help='existing XML file instead of a generated one')
+    parser.add_argument('--output', help='result file, default benchmark-<commit>.json')
+    options, parser_args = parser.parse_known_args()
+    if options.command == 'compare':
+        if len(options.files) != 2:
+            parser.error('compare needs two result files')
+        compare(*options.files)
+        return
+    if options.command == 'download':
+        if not options.verbose:
+            logging.getLogger('downloader').setLevel(logging.ERROR)
+        checks = check_download()
+        for name, passed in sorted(checks.items()):
+            print('%-14s %s' % (name, 'ok' if passed else 'FAILED'))
+        return 0 if all(checks.values()) else 1
+    import tm_parser
+    parser_options = tm_parser.create_parser().parse_args(['--parse'] + parser_args)
+    if not options.verbose:
+        for name in ('tm_parser', 'loader'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = options.input
+        if filename is None:
+            filename = os.path.join(tmp_dir, 'bench.xml')
+            generate(filename, options.cases, seed=options.seed, first_serial=options.first_serial)
+        results = {}
+        if options.command in ('extract', 'all'):
+            results['xpath_fields'] = bench_xpath_fields(filename)
+            results['extract_case'] = bench_extract_case(filename)
+            results['target_extract'] = bench_target_extract(filename)
+            results['parse_null'] = bench_parse_null(filename, parser_options)
+        if options.command in ('load', 'all'):
+            results['load'] = bench_load(filename, parser_options)
+        if options.command in ('memory', 'all'):
+            results['memory'] = bench_memory(filename, parser_options, options.cases, options.max_growth)
+    finally:
+        shutil.rmtree(tmp_dir)
+    commit = git_commit()
+    report = {'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+              'input': options.input or 'generated', 'cases': options.cases, 'options': parser_args,
+              'results': results}
+    output = options.output or 'benchmark-%s.json' % commit
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for name, r in sorted(results.items()):
+        print('%-14s %8s cases %10s rows %8.3f sec %10s cases/sec %12s rows/sec' % (
+            name, r['cases'], r['rows'], r['seconds'], r['cases_per_sec'], r['rows_per_sec']))
+    print('Saved to %s' % output)
+    if 'memory' in results:
+        r = results['memory']
+        print('Peak RSS %s bytes after a tenth of %s bytes of XML, %s bytes at the end' % (
+            r['early_rss'], r['size'], r['peak_rss']))
+        if r['bounded'] is False:
+            print('Memory grew by %s MB, more than %s MB' % (r['growth_mb'], options.max_growth))
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
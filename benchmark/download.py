@@ -0,0 +1,155 @@
+"""
+Checks the resume logic of Downloader against a local http.server that supports Range
+"""
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from downloader import DownloadError, Downloader, parse_size
+
+PAYLOAD = bytes(range(256)) * 4096
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves server.payload with its ETag, honouring Range and If-Range unless server.ranges is False.
+    The first server.cut_after bytes of a reply end the connection once, like a dropped download,
+    and the first server.failures requests are answered with 503.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.headers.get('Range'), self.headers.get('If-Range')))
+        if server.failures:
+            server.failures -= 1
+            self.send_error(503)
+            return
+        payload = server.payload
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        if_range = self.headers.get('If-Range')
+        if match and server.ranges and (if_range is None or if_range == server.etag):
+            start = int(match.group(1))
+            if start >= len(payload):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % len(payload))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, len(payload) - 1, len(payload)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(payload) - start))
+        self.end_headers()
+        body = payload[start:]
+        if server.cut_after is not None:
+            body, server.cut_after = body[:server.cut_after], None
+            self.wfile.write(body)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.payload = PAYLOAD
+    server.etag = '"v1"'
+    server.ranges = True
+    server.cut_after = None
+    server.failures = 0
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write(filename, data):
+    with open(filename, 'w' if isinstance(data, str) else 'wb') as f:
+        f.write(data)
+
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def check_interrupted(server, url, filename):
+    # the chunks written before the connection broke are kept and not fetched again
+    server.cut_after = len(PAYLOAD) // 3
+    offset = server.cut_after - server.cut_after % 4096
+    Downloader(chunk_size=4096, retries=2, backoff=0).download(url, filename, len(PAYLOAD))
+    return read(filename) == PAYLOAD and server.requests[1] == ('bytes=%s-' % offset, server.etag)
+
+
+def check_unavailable(server, url, filename):
+    # download() is the only retry layer, one request per attempt
+    server.failures = 2
+    Downloader(retries=2, backoff=0).download(url, filename, len(PAYLOAD))
+    return read(filename) == PAYLOAD and len(server.requests) == 3
+
+
+def check_resume(server, url, filename):
+    write(filename + '.part', PAYLOAD[:1000])
+    write(filename + '.part.validator', server.etag)
+    Downloader(retries=0).download(url, filename, len(PAYLOAD))
+    return read(filename) == PAYLOAD and server.requests == [('bytes=1000-', server.etag)]
+
+
+def check_no_ranges(server, url, filename):
+    server.ranges = False
+    write(filename + '.part', b'x' * 1000)
+    Downloader(retries=0).download(url, filename, len(PAYLOAD))
+    return read(filename) == PAYLOAD
+
+
+def check_changed(server, url, filename):
+    write(filename + '.part', PAYLOAD[:1000])
+    write(filename + '.part.validator', '"v0"')
+    server.payload = PAYLOAD[::-1]
+    Downloader(retries=0).download(url, filename, len(PAYLOAD))
+    return read(filename) == PAYLOAD[::-1]
+
+
+def check_complete(server, url, filename):
+    write(filename + '.part', PAYLOAD)
+    write(filename + '.part.validator', server.etag)
+    Downloader(retries=0).download(url, filename, len(PAYLOAD))
+    return read(filename) == PAYLOAD and not os.path.exists(filename + '.part.validator')
+
+
+def check_size_mismatch(server, url, filename):
+    try:
+        Downloader(retries=0).download(url, filename, parse_size('{:,}'.format(len(PAYLOAD) + 1)))
+    except DownloadError:
+        return not os.path.exists(filename) and not os.path.exists(filename + '.part')
+    return False
+
+
+CHECKS = (('interrupted', check_interrupted), ('unavailable', check_unavailable), ('resume', check_resume),
+          ('no_ranges', check_no_ranges), ('changed', check_changed), ('complete', check_complete),
+          ('size_mismatch', check_size_mismatch))
+
+
+def check_download():
+    """
+    {check name: passed} for each scenario, each against a fresh server and directory
+    """
+    results = {}
+    for name, check in CHECKS:
+        server = serve()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            url = 'http://127.0.0.1:%s/apc.zip' % server.server_address[1]
+            results[name] = check(server, url, os.path.join(tmp_dir, 'apc.zip'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmp_dir)
+    return results
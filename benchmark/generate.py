@@ -0,0 +1,168 @@
+"""
+Writes synthetic <trademark-applications-daily> files shaped like the USPTO daily XML
+"""
+import argparse
+import random
+from xml.sax.saxutils import escape
+
+from case_spec import (CASE_FILE_HEADER_ITEMS, CASE_FILE_OWNERS_ITEMS, CLASSIFICATIONS_ITEMS,
+                       CORRESPONDENT_ITEMS, FOREIGN_APPLICATIONS_ITEMS, INTERNATIONAL_REGISTRATION_ITEMS,
+                       MADRID_HISTORY_EVENTS_ITEMS, MADRID_INTERNATIONAL_FILING_RECORD_ITEMS)
+
+# (min, max) number of child elements per case-file
+CARDINALITIES = {
+    'statements': (1, 4),
+    'events': (3, 25),
+    'prior_registrations': (0, 3),
+    'foreign_applications': (0, 1),
+    'classifications': (1, 3),
+    'us_codes': (1, 4),
+    'owners': (1, 3),
+    'design_searches': (0, 3),
+    'madrid_records': (0, 1),
+    'madrid_events': (1, 4),
+}
+FIRST_SERIAL = 70000000
+# columns of 70 characters and more, other text columns get at most 20
+LONG_TEXT = ('mark_identification', 'attorney_name', 'domestic_representative_name', 'current_location',
+             'employee_name', 'description_text', 'entity_statement', 'party_name',
+             'address_1', 'address_2', 'address_3', 'address_4', 'address_5', 'dba_aka_text', 'composed_of_statement',
+             'name_change_explanation', 'law_office_assigned_location_code')
+WORDS = ('ACME', 'GLOBAL', 'HOLDINGS', 'BRAND', 'NORTH', 'STAR', 'TECH', 'LLC', 'INC', 'FOODS', 'CORP',
+         'SYSTEMS', 'DESIGN', 'CLOTHING', 'SOFTWARE', 'COFFEE', '&', 'SONS', 'GROUP', 'LABS')
+
+
+def dashed(item):
+    return item.replace('_', '-')
+
+
+class CaseGenerator(object):
+
+    def __init__(self, seed=1, cardinalities=None):
+        self.random = random.Random(seed)
+        self.cardinalities = dict(CARDINALITIES)
+        self.cardinalities.update(cardinalities or {})
+
+    def count(self, name):
+        low, high = self.cardinalities[name]
+        return self.random.randint(low, high)
+
+    def date(self):
+        r = self.random
+        return '%04d%02d%02d' % (r.randint(1990, 2018), r.randint(1, 12), r.randint(1, 28))
+
+    def text(self, words=3):
+        return ' '.join(self.random.choice(WORDS) for _ in range(words))
+
+    def value(self, item):
+        r = self.random
+        if item == 'type':
+            return r.choice(('A', 'E', 'I', 'O', 'P'))
+        if item == 'code':
+            return r.choice(('NWAP', 'PUBO', 'NPUB', 'CNRT', 'GNRT', 'IREG', 'MAIL'))
+        if item in ('party_type', 'relationship_type'):
+            return str(r.choice((10, 20, 30)))
+        if item in ('postcode', 'other'):
+            return '%05d' % r.randint(0, 99999)
+        if item == 'date' or item.endswith('_date') or item.endswith('_date_uspto'):
+            return self.date()
+        if item.endswith('_in'):
+            return self.random.choice(('T', 'F'))
+        if item.endswith('_code') or item.endswith('_number') or item.endswith('_no'):
+            return str(self.random.randint(1, 999))
+        if item in ('country', 'state'):
+            return self.random.choice(('US', 'DE', 'JP', 'CN', 'CA', 'NY', 'CA'))
+        if item in ('number', 'international_code'):
+            return str(self.random.randint(1, 99999))
+        text = self.text(self.random.randint(1, 5))
+        if item in LONG_TEXT:
+            return text[:60]
+        return text[:20]
+
+    def items(self, items, fill=0.7):
+        return ''.join('<{0}>{1}</{0}>'.format(dashed(item), escape(self.value(item)))
+                       for item in items if self.random.random() < fill)
+
+    def repeat(self, name, container, element, body, count=None):
+        if count is None:
+            count = self.count(name)
+        return '<{0}>{1}</{0}>'.format(container, ''.join(
+            '<{0}>{1}</{0}>'.format(element, body()) for _ in range(count)))
+
+    def case_file(self, serial_number, transaction_date):
+        r = self.random
+        parts = ['<case-file><serial-number>%s</serial-number>' % serial_number,
+                 '<registration-number>%07d</registration-number>' % r.randint(0, 9999999),
+                 '<transaction-date>%s</transaction-date>' % transaction_date,
+                 '<case-file-header>%s</case-file-header>' % self.items(CASE_FILE_HEADER_ITEMS, 0.5),
+                 self.repeat('statements', 'case-file-statements', 'case-file-statement',
+                             lambda: '<type-code>GS0%s1</type-code><text>%s</text>' % (
+                                 r.randint(1, 45), escape(self.text(r.randint(5, 40))))),
+                 self.repeat('events', 'case-file-event-statements', 'case-file-event-statement',
+                             lambda: self.items(('code', 'type', 'description_text', 'date', 'number'), 1)),
+                 self.repeat('prior_registrations', 'prior-registration-applications',
+                             'prior-registration-application',
+                             lambda: self.items(('relationship_type', 'number'), 1)),
+                 self.repeat('foreign_applications', 'foreign-applications', 'foreign-application',
+                             lambda: self.items(FOREIGN_APPLICATIONS_ITEMS, 0.5)),
+                 self.repeat('classifications', 'classifications', 'classification',
+                             lambda: self.items(CLASSIFICATIONS_ITEMS) + ''.join(
+                                 '<us-code>%03d</us-code>' % r.randint(1, 200) for _ in range(self.count('us_codes')))),
+                 '<correspondent>%s</correspondent>' % self.items(CORRESPONDENT_ITEMS, 0.8),
+                 self.repeat('owners', 'case-file-owners', 'case-file-owner',
+                             lambda: self.items(CASE_FILE_OWNERS_ITEMS, 0.6) +
+                             '<nationality><country>US</country></nationality>'),
+                 self.repeat('design_searches', 'design-searches', 'design-search',
+                             lambda: '<code>%06d</code>' % r.randint(10101, 291101))]
+        madrid_records = self.count('madrid_records')
+        if madrid_records:
+            parts.append('<international-registration>%s</international-registration>' % self.items(
+                INTERNATIONAL_REGISTRATION_ITEMS))
+            parts.append(self.repeat(
+                'madrid_records', 'madrid-international-filing-requests', 'madrid-international-filing-record',
+                lambda: self.items(MADRID_INTERNATIONAL_FILING_RECORD_ITEMS) + self.repeat(
+                    'madrid_events', 'madrid-history-events', 'madrid-history-event',
+                    lambda: self.items(MADRID_HISTORY_EVENTS_ITEMS, 1)), madrid_records))
+        parts.append('</case-file>\n')
+        return ''.join(parts)
+
+
+def generate(filename, cases, seed=1, first_serial=FIRST_SERIAL, transaction_date='20181108', cardinalities=None):
+    """
+    Writes a file with cases case-files and returns its size in bytes
+    """
+    generator = CaseGenerator(seed, cardinalities)
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<trademark-applications-daily>'
+                '<version><version-no>2.0</version-no><version-date>20181108</version-date></version>'
+                '<creation-datetime>201811090000</creation-datetime><application-information>'
+                '<file-segments><file-segment>TMA</file-segment><action-keys><action-key>AA</action-key>\n')
+        for i in range(cases):
+            f.write(generator.case_file(first_serial + i, transaction_date))
+        f.write('</action-keys></file-segments></application-information></trademark-applications-daily>\n')
+        return f.tell()
+
+
+def parse_range(value):
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic trademark applications XML file.')
+    parser.add_argument('filename')
+    parser.add_argument('--cases', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--first-serial', type=int, default=FIRST_SERIAL)
+    parser.add_argument('--transaction-date', default='20181108')
+    for name, (low, high) in sorted(CARDINALITIES.items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=parse_range, default=(low, high),
+                            help='min-max per case-file (default %s-%s)' % (low, high))
+    args = parser.parse_args()
+    cardinalities = dict((name, getattr(args, name)) for name in CARDINALITIES)
+    size = generate(args.filename, args.cases, args.seed, args.first_serial, args.transaction_date, cardinalities)
+    print('Wrote %s case-files, %s bytes to %s' % (args.cases, size, args.filename))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+from metrics import peak_rss
+
+
+class NullLoader(object):
+    """
+    Loader that only counts what it is given, to measure parsing alone
+    """
+
+    def __init__(self):
+        self.cases = 0
+        self.rows = 0
+
+    def lookup(self, serial_numbers):
+        return {}
+
+    def pending_case(self, serial_number):
+        return None
+
+    def advance(self, case, serial_number):
+        pass
+
+    def add(self, serial_number, rows, replace=False):
+        self.cases += 1
+        self.rows += sum(len(lst) for lst in rows.values())
+
+    def flush(self):
+        return 0
+
+    def close(self):
+        return self.cases
+
+
+class MemoryLoader(NullLoader):
+    """
+    Counting loader that samples the peak RSS once a tenth of the cases is parsed
+    """
+
+    def __init__(self, cases):
+        super(MemoryLoader, self).__init__()
+        self.sample_at = max(1, cases // 10)
+        self.early_rss = None
+
+    def add(self, serial_number, rows, replace=False):
+        super(MemoryLoader, self).add(serial_number, rows, replace=replace)
+        if self.cases == self.sample_at:
+            self.early_rss = peak_rss()
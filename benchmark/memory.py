@@ -0,0 +1,42 @@
+"""
+Checks that the parser runs in bounded memory however large the file is
+"""
+import logging
+import multiprocessing
+import os
+import time
+
+from benchmark.loaders import MemoryLoader
+from metrics import peak_rss
+
+
+def parse_memory(filename, options, cases):
+    import tm_parser
+    tm_parser.args = options
+    for name in ('tm_parser', 'loader'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    loader = MemoryLoader(cases)
+    start_time = time.time()
+    with open(filename, 'rb') as source:
+        tm_parser.parse_source(source, 0, None, 'benchmark', loader=loader)
+    return {'cases': loader.cases, 'rows': loader.rows, 'seconds': round(time.time() - start_time, 4),
+            'early_rss': loader.early_rss, 'peak_rss': peak_rss()}
+
+
+def bench_memory(filename, options, cases, max_growth):
+    """
+    Parses in a fresh process, so the peak RSS is that of the parser alone, and checks
+    that it grows by less than max_growth MB between a tenth of the file and its end
+    """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        r = pool.apply(parse_memory, (filename, options, cases))
+    r['size'] = os.path.getsize(filename)
+    r['cases_per_sec'] = round(r['cases'] / r['seconds'], 1) if r['seconds'] else None
+    r['rows_per_sec'] = round(r['rows'] / r['seconds'], 1) if r['seconds'] else None
+    if r['early_rss'] is None or r['peak_rss'] is None:
+        r['bounded'] = None
+    else:
+        r['growth_mb'] = round((r['peak_rss'] - r['early_rss']) / (1024 * 1024), 1)
+        r['bounded'] = r['growth_mb'] < max_growth
+    return r
@@ -0,0 +1,89 @@
+"""
+Initial load of an empty database without the secondary indexes and foreign keys of the
+case-file tables.
+
+start() saves their definitions in trademark_bootstrap and drops them, the backfiles are then
+copied into bare tables. The serial_number indexes stay: without the cascading foreign keys the
+loader deletes the child rows of replaced serials itself, and would scan the tables without
+them. rebuild() creates the indexes in parallel, one per connection with a raised
+maintenance_work_mem, adds the foreign keys back, validates them and ANALYZEs the tables. An
+interrupted bootstrap keeps its definitions, the next run continues or rebuilds.
+"""
+import concurrent.futures as cf
+import logging
+import time
+
+from db_pgsql import Db
+from loader import TABLES
+
+MAINTENANCE_WORK_MEM = '1GB'
+
+logger = logging.getLogger(__name__)
+
+
+class BootstrapError(Exception):
+    pass
+
+
+def pending(dbc):
+    """
+    True while definitions dropped by a bootstrap are not restored
+    """
+    return len(dbc.bootstrap_definitions()) > 0
+
+
+def start(dbc):
+    """
+    Drops the secondary indexes and foreign keys of an empty database, or keeps them dropped
+    when an unfinished bootstrap is continued
+    """
+    if pending(dbc):
+        logger.info('Continuing the unfinished bootstrap')
+        return
+    if not dbc.table_empty('trademark_app_case_files'):
+        raise BootstrapError('Bootstrap needs empty case-file tables')
+    start_time = time.time()
+    dropped = dbc.bootstrap_drop(TABLES)
+    logger.info('Dropped %s indexes and foreign keys for the bootstrap [%6.3f sec]', dropped,
+                time.time() - start_time)
+
+
+def restore(definition, maintenance_work_mem):
+    dbc = Db()
+    try:
+        start_time = time.time()
+        dbc.bootstrap_restore(definition, maintenance_work_mem)
+        logger.info('Restored %s %s on %s [%6.3f sec]', definition['kind'], definition['name'],
+                    definition['table_name'], time.time() - start_time)
+    finally:
+        dbc.close()
+
+
+def analyze(table):
+    dbc = Db()
+    try:
+        dbc.analyze(table)
+    finally:
+        dbc.close()
+
+
+def rebuild(workers, maintenance_work_mem=MAINTENANCE_WORK_MEM):
+    """
+    Restores the saved indexes, then the foreign keys, then ANALYZEs, each step in workers
+    connections at once
+    """
+    dbc = Db()
+    try:
+        definitions = dbc.bootstrap_definitions()
+    finally:
+        dbc.close()
+    if len(definitions) == 0:
+        return
+    start_time = time.time()
+    with cf.ThreadPoolExecutor(max_workers=workers) as executor:
+        for kind in ('index', 'foreign_key'):
+            list(executor.map(restore, [d for d in definitions if d['kind'] == kind],
+                              [maintenance_work_mem] * len(definitions)))
+        list(executor.map(analyze, TABLES))
+    logger.info('Rebuilt %s indexes and foreign keys and analyzed the tables [%6.3f sec]', len(definitions),
+                time.time() - start_time)
@@ -0,0 +1,241 @@
+"""
+Declarative mapping of <case-file> elements to the rows of the trademark_app_* tables.
+
+Every table is described by a TableSpec: where its row elements are found and which
+child tag fills which column. The spec is compiled once into nested tag lookups, so a
+row is filled with a single pass over the children of its element instead of one
+XPath evaluation per column.
+"""
+
+
+def dashed(prefix, items):
+    return tuple((item, prefix + item.replace('_', '-')) for item in items)
+
+
+class TableSpec(object):
+    """
+    Describes one trademark_app_* table.
+
+    path: ElementPath of the row elements relative to the parent element,
+          None when the parent element itself gives exactly one row
+    fields: (column, path) pairs, the first text of path inside the row element,
+            path '.' takes the text of the row element itself
+    context_fields: (column, path) pairs evaluated on the parent element
+    parent_key: column holding the position of the parent row within the case
+    """
+
+    def __init__(self, table, path, fields, context_fields=(), children=(), parent_key=None, file_id=False):
+        self.table = table
+        self.path = path
+        self.fields = fields
+        self.context_fields = context_fields
+        self.children = children
+        self.parent_key = parent_key
+        self.file_id = file_id
+
+
+CASE_FILE_HEADER_ITEMS = (
+    'filing_date', 'status_code', 'status_date', 'mark_identification', 'mark_drawing_code',
+    'attorney_docket_number', 'attorney_name', 'principal_register_amended_in',
+    'supplemental_register_amended_in', 'trademark_in', 'collective_trademark_in', 'service_mark_in',
+    'collective_service_mark_in', 'collective_membership_mark_in', 'certification_mark_in',
+    'cancellation_pending_in', 'published_concurrent_in', 'concurrent_use_in',
+    'concurrent_use_proceeding_in', 'interference_pending_in', 'opposition_pending_in', 'section_12c_in',
+    'section_2f_in', 'section_2f_in_part_in', 'renewal_filed_in', 'section_8_filed_in',
+    'section_8_partial_accept_in', 'section_8_accepted_in', 'section_15_acknowledged_in',
+    'section_15_filed_in', 'supplemental_register_in', 'foreign_priority_in', 'change_registration_in',
+    'intent_to_use_in', 'intent_to_use_current_in', 'filed_as_use_application_in',
+    'amended_to_use_application_in', 'use_application_currently_in', 'amended_to_itu_application_in',
+    'filing_basis_filed_as_44d_in', 'amended_to_44d_application_in', 'filing_basis_current_44d_in',
+    'filing_basis_filed_as_44e_in', 'filing_basis_current_44e_in', 'amended_to_44e_application_in',
+    'without_basis_currently_in', 'filing_current_no_basis_in', 'color_drawing_filed_in',
+    'color_drawing_current_in', 'drawing_3d_filed_in', 'drawing_3d_current_in',
+    'standard_characters_claimed_in', 'filing_basis_filed_as_66a_in', 'filing_basis_current_66a_in',
+    'current_location', 'location_date', 'employee_name', 'registration_date',
+    'published_for_opposition_date', 'amend_to_register_date', 'abandonment_date', 'cancellation_code',
+    'cancellation_date', 'republished_12c_date', 'domestic_representative_name', 'renewal_date',
+    'law_office_assigned_location_code')
+
+FOREIGN_APPLICATIONS_ITEMS = (
+    'filing_date', 'registration_date', 'registration_expiration_date', 'registration_renewal_date',
+    'registration_renewal_expiration_date', 'entry_number', 'application_number', 'country',
+    'other', 'registration_number', 'renewal_number', 'foreign_priority_claim_in')
+
+CLASSIFICATIONS_ITEMS = (
+    'international_code_total_no', 'us_code_total_no', 'international_code', 'status_code',
+    'status_date', 'first_use_anywhere_date', 'first_use_in_commerce_date', 'primary_code')
+
+CORRESPONDENT_ITEMS = ('address_1', 'address_2', 'address_3', 'address_4', 'address_5')
+
+CASE_FILE_OWNERS_ITEMS = (
+    'entry_number', 'party_type', 'legal_entity_type_code', 'entity_statement', 'party_name',
+    'address_1', 'address_2', 'city', 'state', 'country', 'other', 'postcode', 'dba_aka_text',
+    'composed_of_statement', 'name_change_explanation')
+
+INTERNATIONAL_REGISTRATION_ITEMS = (
+    'international_registration_number', 'international_registration_date',
+    'international_publication_date', 'international_renewal_date', 'auto_protection_date',
+    'international_death_date', 'international_status_code', 'international_status_date',
+    'priority_claimed_in', 'priority_claimed_date', 'first_refusal_in')
+
+MADRID_INTERNATIONAL_FILING_RECORD_ITEMS = (
+    'entry_number', 'reference_number', 'original_filing_date_uspto', 'international_registration_number',
+    'international_registration_date', 'international_status_code',
+    'international_status_date', 'irregularity_reply_by_date', 'international_renewal_date')
+
+MADRID_HISTORY_EVENTS_ITEMS = ('code', 'date', 'description_text', 'entry_number')
+
+CASE_SPEC = (
+    TableSpec('trademark_app_case_files', None,
+              dashed('', ('registration_number', 'transaction_date')), file_id=True),
+    TableSpec('trademark_app_case_file_headers', None, dashed('case-file-header/', CASE_FILE_HEADER_ITEMS)),
+    TableSpec('trademark_app_case_file_statements', 'case-file-statements/case-file-statement',
+              dashed('', ('type_code', 'text'))),
+    TableSpec('trademark_app_case_file_event_statements', 'case-file-event-statements/case-file-event-statement',
+              dashed('', ('code', 'type', 'description_text', 'date', 'number'))),
+    TableSpec('trademark_app_prior_registration_applications',
+              'prior-registration-applications/prior-registration-application',
+              dashed('', ('relationship_type', 'number')),
+              context_fields=dashed('prior-registration-applications/', ('other_related_in',))),
+    TableSpec('trademark_app_foreign_applications', 'foreign-applications/foreign-application',
+              dashed('', FOREIGN_APPLICATIONS_ITEMS)),
+    TableSpec('trademark_app_classifications', 'classifications/classification',
+              dashed('', CLASSIFICATIONS_ITEMS),
+              children=(TableSpec('trademark_app_us_codes', 'us-code', (('us_code', '.'),),
+                                  parent_key='classification_id'),)),
+    TableSpec('trademark_app_correspondents', 'correspondent', dashed('', CORRESPONDENT_ITEMS)),
+    TableSpec('trademark_app_case_file_owners', 'case-file-owners/case-file-owner',
+              dashed('', CASE_FILE_OWNERS_ITEMS) + (('nationality', 'nationality/country'),)),
+    TableSpec('trademark_app_design_searches', 'design-searches/design-search', dashed('', ('code',))),
+    TableSpec('trademark_app_international_registration', 'international-registration',
+              dashed('', INTERNATIONAL_REGISTRATION_ITEMS)),
+    TableSpec('trademark_app_madrid_international_filing_record',
+              'madrid-international-filing-requests/madrid-international-filing-record',
+              dashed('', MADRID_INTERNATIONAL_FILING_RECORD_ITEMS),
+              children=(TableSpec('trademark_app_madrid_history_events',
+                                  'madrid-history-events/madrid-history-event',
+                                  dashed('', MADRID_HISTORY_EVENTS_ITEMS),
+                                  parent_key='madrid_international_filing_record_id'),)),
+)
+
+
+def first_text(element):
+    """
+    Same result as str(element.xpath('text()')[0]), None when there is no text node
+    """
+    if element.text is not None:
+        return element.text
+    for child in element:
+        if child.tail is not None:
+            return child.tail
+    return None
+
+
+def compile_fields(fields):
+    """
+    Turns (column, path) pairs into nested {tag: column or {tag: ...}} lookups
+    """
+    tags = {}
+    for column, path in fields:
+        if path == '.':
+            continue
+        parts = path.split('/')
+        level = tags
+        for part in parts[:-1]:
+            level = level.setdefault(part, {})
+            if not isinstance(level, dict):
+                raise ValueError('%s is used both as a field and a container' % part)
+        if parts[-1] in level:
+            raise ValueError('%s is mapped twice' % path)
+        level[parts[-1]] = column
+    return tags
+
+
+def scan(element, tags, row):
+    for child in element:
+        entry = tags.get(child.tag)
+        if entry is None:
+            continue
+        if type(entry) is dict:
+            scan(child, entry, row)
+        elif row[entry] is None:
+            row[entry] = first_text(child)
+
+
+class CompiledTable(object):
+
+    def __init__(self, spec):
+        self.table = spec.table
+        self.path = spec.path
+        self.file_id = spec.file_id
+        self.parent_key = spec.parent_key
+        self.columns = ['serial_number']
+        if spec.file_id:
+            self.columns.append('file_id')
+        if spec.parent_key:
+            self.columns.append(spec.parent_key)
+        self.context_columns = [column for column, path in spec.context_fields]
+        self.columns.extend(self.context_columns)
+        self.columns.extend([column for column, path in spec.fields])
+        self.tags = compile_fields(spec.fields)
+        self.context_tags = compile_fields(spec.context_fields)
+        self.self_columns = [column for column, path in spec.fields if path == '.']
+        self.children = [CompiledTable(child) for child in spec.children]
+
+    def extract(self, parent, doc_id, file_id, rows, parent_index=None):
+        lst = rows[self.table]
+        if self.path is None:
+            elements = (parent,)
+        else:
+            elements = parent.iterfind(self.path)
+        context = dict.fromkeys(self.context_columns)
+        if self.context_tags:
+            scan(parent, self.context_tags, context)
+        for element in elements:
+            row = dict.fromkeys(self.columns)
+            row['serial_number'] = doc_id
+            if self.file_id:
+                row['file_id'] = file_id
+            if self.parent_key:
+                row[self.parent_key] = parent_index
+            row.update(context)
+            scan(element, self.tags, row)
+            for column in self.self_columns:
+                row[column] = element.text
+            for child in self.children:
+                child.extract(element, doc_id, file_id, rows, len(lst))
+            lst.append(row)
+
+    def tables(self):
+        yield self.table
+        for child in self.children:
+            for table in child.tables():
+                yield table
+
+
+class CaseExtractor(object):
+    """
+    Compiled CASE_SPEC, emits the rows of every table for a <case-file> element
+    """
+
+    def __init__(self, spec=CASE_SPEC):
+        self.compiled = [CompiledTable(table_spec) for table_spec in spec]
+        self.table_names = [table for compiled in self.compiled for table in compiled.tables()]
+
+    def extract(self, case, doc_id, file_id):
+        rows = dict((table, []) for table in self.table_names)
+        for compiled in self.compiled:
+            compiled.extract(case, doc_id, file_id, rows)
+        return rows
+
+
+CASE_EXTRACTOR = CaseExtractor()
+
+
+def extract_case(case, doc_id, file_id):
+    """
+    Extracts the rows of every trademark_app_* table from a <case-file> element.
+    Child rows of classifications and madrid filing records reference their parent
+    by its position in the parent table list of the same case.
+    """
+    return CASE_EXTRACTOR.extract(case, doc_id, file_id)
@@ -0,0 +1,312 @@
+"""
+Extracts the rows of CASE_SPEC with lxml's parser target interface instead of iterparse.
+
+The spec is compiled into one tree of tag paths relative to <case-file>. The target follows
+the start, end and data events down that tree and fills the rows of every table as the
+tags stream by, so no element is ever built. The rows are the same extract_case returns.
+"""
+from lxml import etree
+
+from case_spec import CASE_SPEC, CompiledTable
+
+CHUNK_SIZE = 64 * 1024
+# only the first text node counts, or only the text before the first child
+FIRST_TEXT = 0
+ELEMENT_TEXT = 1
+
+
+class PathNode(object):
+    """
+    A tag path inside <case-file>: the tables whose row element it is, the columns it fills
+    and the deeper paths
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.tables = []
+        # (table, column, mode), table None for the serial number of the case-file
+        self.fields = []
+        self.contexts = []
+        # set by compile_target: whether the element text is read, and only up to its first child
+        self.reads = False
+        self.element_text = False
+        self.leaf = False
+        # (key in CaseTarget.current, column) of the fields and contexts
+        self.columns = ()
+
+    def child(self, tag):
+        node = self.children.get(tag)
+        if node is None:
+            node = self.children[tag] = PathNode()
+        return node
+
+    def path(self, path):
+        node = self
+        for tag in path.split('/'):
+            node = node.child(tag)
+        return node
+
+
+class TargetTable(object):
+
+    def __init__(self, compiled, parent=None):
+        self.table = compiled.table
+        self.columns = compiled.columns
+        self.context_columns = compiled.context_columns
+        self.file_id = compiled.file_id
+        self.parent_key = compiled.parent_key
+        self.parent = parent
+        self.children = []
+        self.context_key = (self.table, 'context')
+
+
+def compile_target(spec=CASE_SPEC):
+    """
+    Root PathNode of <case-file> and the TargetTables of spec in the order of extract_case
+    """
+    root = PathNode()
+    tables = []
+
+    def add(table_spec, parent_node, parent):
+        target = TargetTable(CompiledTable(table_spec), parent)
+        tables.append(target)
+        if parent is not None:
+            parent.children.append(target)
+        node = parent_node if table_spec.path is None else parent_node.path(table_spec.path)
+        node.tables.append(target)
+        for column, path in table_spec.fields:
+            if path == '.':
+                field_node, mode = node, ELEMENT_TEXT
+            else:
+                field_node, mode = node.path(path), FIRST_TEXT
+            if any(field[2] != mode for field in field_node.fields):
+                raise ValueError('%s is read both as first text and as element text' % path)
+            field_node.fields.append((target, column, mode))
+        for column, path in table_spec.context_fields:
+            parent_node.path(path).contexts.append((target, column))
+        for child in table_spec.children:
+            add(child, node, target)
+
+    for table_spec in spec:
+        add(table_spec, root, None)
+    root.path('serial-number').fields.append((None, 'serial_number', FIRST_TEXT))
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        node.reads = bool(node.fields or node.contexts)
+        node.element_text = any(field[2] == ELEMENT_TEXT for field in node.fields)
+        node.leaf = node.reads and not node.children and not node.tables
+        node.columns = tuple((target and target.table, column) for target, column, mode in node.fields) + \
+            tuple((target.context_key, column) for target, column in node.contexts)
+        nodes.extend(node.children.values())
+    return root, tables
+
+
+class CaseTarget(object):
+    """
+    Parser target collecting the rows of every <case-file> into cases as
+    (serial number, rows) pairs
+    """
+
+    def __init__(self, file_id, spec=CASE_SPEC):
+        self.root, self.tables = compile_target(spec)
+        self.file_id = file_id
+        self.top_tables = [target for target in self.tables if target.parent is None]
+        self.templates = {}
+        for target in self.tables:
+            row = self.templates[target.table] = dict.fromkeys(target.columns)
+            if target.file_id:
+                row['file_id'] = file_id
+        self.cases = []
+        self.rows = None
+        # the dict each field is set in: the last row of each table, the context of each
+        # table, and the case-file under None
+        self.current = {}
+        # the open element: its path node, the text chunks it still reads (None when it reads
+        # none) and the context starts it closes; the entries of its ancestors are on the stack
+        self.node = None
+        self.chunks = None
+        self.starts = None
+        self.stack = []
+        # an open element without tables or deeper paths, read without a stack entry, and
+        # the chunks of its parent
+        self.leaf = None
+        self.leaf_chunks = None
+        # depth inside an element no table reads, and the chunks of the element around it
+        self.skip = 0
+        self.skip_chunks = None
+
+    def start(self, tag, attrib):
+        if self.skip:
+            self.skip += 1
+            return
+        node = self.leaf or self.node
+        if node is None:
+            if tag == 'case-file':
+                self.start_case()
+            return
+        chunks = self.chunks
+        if chunks is not None and (chunks or node.element_text):
+            self.finish(node, chunks)
+            chunks = None
+        child = node.children.get(tag)
+        if child is None:
+            self.skip = 1
+            self.skip_chunks = chunks
+            self.chunks = None
+            return
+        if child.leaf:
+            self.leaf = child
+            self.leaf_chunks = chunks
+            self.chunks = []
+            return
+        self.stack.append((node, chunks, self.starts))
+        starts = None
+        for target in child.tables:
+            starts = self.start_row(target, starts)
+        self.node = child
+        self.chunks = [] if child.reads else None
+        self.starts = starts
+
+    def start_case(self):
+        self.rows = dict((target.table, []) for target in self.tables)
+        self.current = {None: {'serial_number': None}}
+        starts = self.open_contexts(self.top_tables, None)
+        for target in self.root.tables:
+            starts = self.start_row(target, starts)
+        self.node = self.root
+        self.chunks = None
+        self.starts = starts
+        self.stack = []
+
+    def start_row(self, target, starts):
+        row = self.templates[target.table].copy()
+        if target.parent is not None:
+            row[target.parent_key] = len(self.rows[target.parent.table]) - 1
+        self.rows[target.table].append(row)
+        self.current[target.table] = row
+        if target.children:
+            return self.open_contexts(target.children, starts)
+        return starts
+
+    def open_contexts(self, targets, starts):
+        """
+        Starts collecting the context of targets, read from the element their rows are in
+        and copied to those rows at its end
+        """
+        for target in targets:
+            if target.context_columns:
+                starts = starts or []
+                starts.append((target, len(self.rows[target.table])))
+                self.current[target.context_key] = dict.fromkeys(target.context_columns)
+        return starts
+
+    def finish(self, node, chunks):
+        """
+        Sets the text read by the element of node, if any, into the columns it fills still None
+        and stops reading
+        """
+        self.chunks = None
+        if not chunks:
+            return
+        value = ''.join(chunks)
+        current = self.current
+        for key, column in node.columns:
+            row = current[key]
+            if row[column] is None:
+                row[column] = value
+
+    def data(self, data):
+        chunks = self.chunks
+        if chunks is not None:
+            chunks.append(data)
+
+    def comment(self, text):
+        # a comment ends element.text and the tail of a child like an element does
+        chunks = self.chunks
+        node = self.leaf or self.node
+        if chunks is not None and (chunks or node.element_text):
+            self.finish(node, chunks)
+
+    def pi(self, target, data=None):
+        self.comment(data)
+
+    def end(self, tag):
+        if self.skip:
+            self.skip -= 1
+            if not self.skip:
+                self.chunks = self.skip_chunks
+            return
+        leaf = self.leaf
+        if leaf is not None:
+            chunks = self.chunks
+            if chunks:
+                # finish inlined for the most frequent element
+                value = ''.join(chunks)
+                current = self.current
+                for key, column in leaf.columns:
+                    row = current[key]
+                    if row[column] is None:
+                        row[column] = value
+            self.leaf = None
+            self.chunks = self.leaf_chunks
+            return
+        if self.node is None:
+            return
+        if self.chunks:
+            self.finish(self.node, self.chunks)
+        starts = self.starts
+        if starts is not None:
+            for target, start in starts:
+                context = self.current[target.context_key]
+                for row in self.rows[target.table][start:]:
+                    row.update(context)
+        if self.stack:
+            self.node, self.chunks, self.starts = self.stack.pop()
+        else:
+            self.end_case()
+
+    def end_case(self):
+        serial_number = int(self.current[None]['serial_number'])
+        for lst in self.rows.values():
+            for row in lst:
+                row['serial_number'] = serial_number
+        self.cases.append((serial_number, self.rows))
+        self.rows = None
+        self.current = {}
+        self.node = None
+        self.chunks = None
+        self.starts = None
+
+    def close(self):
+        return None
+
+
+class TargetReader(object):
+    """
+    Case-files as the rows CaseTarget extracts while the file is read in chunks
+    """
+
+    def cases(self, source, file_id):
+        target = CaseTarget(file_id)
+        parser = etree.XMLParser(target=target)
+        while True:
+            data = source.read(CHUNK_SIZE)
+            if not data:
+                break
+            parser.feed(data)
+            for case in target.cases:
+                yield case
+            del target.cases[:]
+        parser.close()
+        for case in target.cases:
+            yield case
+
+    def transaction_date(self, rows):
+        return rows['trademark_app_case_files'][0]['transaction_date']
+
+    def extract(self, rows, doc_id, file_id):
+        return rows
+
+    def release(self, rows):
+        pass
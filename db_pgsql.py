@@ -1,12 +1,156 @@
+import io
 import logging
+import os
+import threading
 import time
+from collections import defaultdict
+from contextlib import contextmanager
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from psycopg2.extensions import AsIs
-from psycopg2.extras import execute_values
+from psycopg2.extras import Json, execute_values
 
+from helpers import xml_filename_from_url
+import metrics
 from settings import db_config
 
+# advisory locks of new serial numbers are keyed (LOCK_SPACE, serial_number / LOCK_BLOCK),
+# new applications come in runs of consecutive serials and share few locks
+LOCK_SPACE = 0x746d
+LOCK_BLOCK = 16
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+POOL_SIZE = 12
+SEARCH_PATH = 'trademark_app_python'
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).translate(COPY_ESCAPES)
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """
+    Connection remembering the statements prepared in its session
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PreparedConnection, self).__init__(*args, **kwargs)
+        self.prepared = {}
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool that waits for a free connection instead of failing when all are in use
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            0, size, connection_factory=PreparedConnection, options='-c search_path=%s' % SEARCH_PATH, **db_config)
+
+    def getconn(self):
+        self.semaphore.acquire()
+        try:
+            return self.pool.getconn()
+        except psycopg2.Error:
+            self.semaphore.release()
+            raise
+
+    def putconn(self, cnx):
+        close = cnx.closed != 0
+        if not close and cnx.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            cnx.rollback()
+        self.pool.putconn(cnx, close=close)
+        self.semaphore.release()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def init_pool(size=POOL_SIZE):
+    """
+    Creates the process-wide pool, sized to the number of workers using it
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.pool.closeall()
+        _pool = ConnectionPool(size)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def get_pool():
+    with _pool_lock:
+        # a pool inherited from a parent process can not be used
+        if _pool is not None and _pool_pid == os.getpid():
+            return _pool
+    return init_pool()
+
+
+class UnitOfWork(object):
+    """
+    One transaction held across many case-files and committed every cases case-files or
+    seconds seconds, whichever comes first. Each case-file runs in a savepoint, so a bad
+    one rolls back alone. While it is open, Db.commit leaves committing to it.
+    """
+
+    def __init__(self, dbc, cases, seconds):
+        self.dbc = dbc
+        self.cases = cases
+        self.seconds = seconds
+        self.count = 0
+        self.started = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.dbc.unit = None
+        if exc_type is None:
+            self.commit()
+        else:
+            self.dbc.cnx.rollback()
+
+    @contextmanager
+    def case(self):
+        cur = self.dbc.cnx.cursor()
+        try:
+            cur.execute('SAVEPOINT tm_case')
+            try:
+                yield
+            except psycopg2.Error:
+                cur.execute('ROLLBACK TO SAVEPOINT tm_case')
+                raise
+            cur.execute('RELEASE SAVEPOINT tm_case')
+            self.count += 1
+        finally:
+            cur.close()
+
+    def due(self):
+        return self.count >= self.cases or time.time() - self.started >= self.seconds
+
+    def commit(self):
+        self.dbc.cnx.commit()
+        self.count = 0
+        self.started = time.time()
+
+
+def prepared_query(q):
+    """
+    Numbers the %s placeholders of q as $1, $2... for PREPARE
+    """
+    parts = q.split('%s')
+    return ''.join(part + ('$%s' % i if i < len(parts) else '') for i, part in enumerate(parts, 1))
+
 
 class Db(object):
     """
@@ -15,31 +159,96 @@ class Db(object):
 
     def __init__(self):
         self.logger = logging.getLogger(__name__)
+        self.pool = get_pool()
+        self.cnx = None
+        # UnitOfWork in progress on the connection
+        self.unit = None
         try:
-            self.cnx = psycopg2.connect(**db_config)
-            cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cur.execute("SET SEARCH_PATH = %s" % 'trademark_app_python')
-            self.cnx.commit()
+            self.cnx = self.pool.getconn()
             # self.logger.info('Connected to database')
         except psycopg2.Error as err:
             self.logger.error(err)
-        finally:
-            cur.close()
 
-    def file_check(self, file):
-        zip_filename = file['url'].split('/')[-1]
-        if 'apc18840407-' in zip_filename:
-            xml_filename = zip_filename.replace('apc18840407-20', 'apc').replace('zip', 'xml')
+    def close(self):
+        """
+        Gives the connection back to the pool
+        """
+        if self.cnx is not None:
+            self.pool.putconn(self.cnx)
+            self.cnx = None
+
+    def unit_of_work(self, cases, seconds):
+        """
+        Holds one transaction across case-files until the returned UnitOfWork is closed:
+
+            with dbc.unit_of_work(1000, 30) as unit:
+                for case in cases:
+                    with unit.case():
+                        ...
+                    if unit.due():
+                        unit.commit()
+        """
+        self.unit = UnitOfWork(self, cases, seconds)
+        return self.unit
+
+    def commit(self):
+        """
+        Commits, unless a unit of work holds the transaction
+        """
+        if self.unit is None:
+            self.cnx.commit()
+
+    def execute(self, cur, q, params):
+        """
+        Executes q as a server-side prepared statement, preparing it once per connection
+        """
+        name = self.cnx.prepared.get(q)
+        if name is None:
+            name = 'tm_%s' % len(self.cnx.prepared)
+            cur.execute('PREPARE {0} AS {1}'.format(name, prepared_query(q)))
+            self.cnx.prepared[q] = name
+        if len(params) == 0:
+            cur.execute('EXECUTE {0}'.format(name))
         else:
-            xml_filename = zip_filename.replace('zip', 'xml')
-        q = "SELECT id, status, filename, date_string FROM trademark_fileinfo WHERE url = %s or filename = %s"
+            cur.execute('EXECUTE {0} ({1})'.format(name, ', '.join(['%s'] * len(params))), params)
+
+    def file_check(self, file):
+        xml_filename = xml_filename_from_url(file['url'])
+        q = "SELECT id, status, filename, date_string, checkpoint_case, checkpoint_serial FROM trademark_fileinfo " \
+            "WHERE url = %s or filename = %s"
         cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(q, (file['url'], xml_filename))
+        self.execute(cur, q, (file['url'], xml_filename))
         result = cur.fetchone()
         self.cnx.commit()
         cur.close()
         return result
 
+    def files_check(self, files):
+        """
+        file_check for all listed files with one query.
+        Returns {url: file_check result or None}.
+        """
+        if len(files) == 0:
+            return {}
+        q = "SELECT v.url, f.id, f.status, f.filename, f.date_string, f.checkpoint_case, f.checkpoint_serial " \
+            "FROM (VALUES %s) AS v (url, filename) LEFT JOIN LATERAL (" \
+            "SELECT * FROM trademark_fileinfo fi WHERE fi.url = v.url OR fi.filename = v.filename " \
+            "ORDER BY fi.id LIMIT 1) f ON true"
+        start_time = time.time()
+        cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        try:
+            rows = execute_values(cur, q, [(file['url'], xml_filename_from_url(file['url'])) for file in files],
+                                  page_size=len(files), fetch=True)
+            self.cnx.commit()
+        finally:
+            cur.close()
+        result = {}
+        for row in rows:
+            url = row.pop('url')
+            result[url] = row if row['id'] is not None else None
+        self.logger.debug('Checked %s files [%s sec]', len(files), time.time() - start_time)
+        return result
+
     def file_insert(self, file, xml_filename):
         q = "INSERT INTO trademark_fileinfo (filename, filesize, url, date_string) VALUES (%s, %s, %s, %s) RETURNING id"
         try:
@@ -62,7 +271,7 @@ class Db(object):
         q = "UPDATE trademark_fileinfo SET status = %s, modified = now() WHERE id = %s RETURNING id, status"
         try:
             cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cur.execute(q, (status, id))
+            self.execute(cur, q, (status, id))
             result = cur.rowcount
             self.cnx.commit()
             self.logger.debug('Updated status for file_info in database')
@@ -73,16 +282,93 @@ class Db(object):
             cur.close()
         return result
 
+    def file_checkpoint(self, id, case, serial_number):
+        """
+        Records that the case-files up to number case, the last one being serial_number,
+        are written. Does not commit, so the checkpoint commits with the rows it covers.
+        """
+        q = "UPDATE trademark_fileinfo SET checkpoint_case = %s, checkpoint_serial = %s WHERE id = %s"
+        cur = self.cnx.cursor()
+        try:
+            self.execute(cur, q, (case, serial_number, id))
+        finally:
+            cur.close()
+
+    def file_update_stats(self, id, stats):
+        q = "UPDATE trademark_fileinfo SET stats = %s, modified = now() WHERE id = %s"
+        try:
+            cur = self.cnx.cursor()
+            cur.execute(q, (Json(stats), id))
+            result = cur.rowcount
+            self.cnx.commit()
+        except psycopg2.Error as err:
+            self.logger.error(err)
+            self.cnx.rollback()
+            result = None
+        finally:
+            cur.close()
+        return result
+
     def serial_get(self, serial_number, file_id):
         q = "SELECT cf.id, cf.created, filename, cf.status, transaction_date FROM trademark_app_case_files cf " \
             "INNER JOIN trademark_fileinfo fi on fi.id = cf.file_id WHERE serial_number = %s"
         cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(q, (serial_number,))
+        self.execute(cur, q, (serial_number,))
         result = cur.fetchone()
         self.cnx.commit()
         cur.close()
         return result
 
+    def serials_get(self, serial_numbers):
+        """
+        Looks up many serial numbers with one query.
+        Returns {serial_number: {'transaction_date': ..., 'status': ...}} for the known ones.
+        """
+        if len(serial_numbers) == 0:
+            return {}
+        q = "SELECT serial_number, transaction_date, status FROM trademark_app_case_files " \
+            "WHERE serial_number = ANY(%s)"
+        start_time = time.time()
+        cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        with metrics.current().timer('lookup'):
+            self.execute(cur, q, (list(serial_numbers),))
+            result = dict((row.pop('serial_number'), row) for row in cur.fetchall())
+        self.cnx.commit()
+        cur.close()
+        self.logger.debug('Looked up %s serials, %s found [%s sec]',
+                          len(serial_numbers), len(result), time.time() - start_time)
+        return result
+
+    def serials_lock(self, serial_numbers):
+        """
+        Locks serial numbers for the current transaction without waiting: known ones by their
+        case_files row, new ones by an advisory lock on their block of LOCK_BLOCK serials.
+        Returns ({serial_number: stored version}, set of new serial numbers) for the serials
+        locked, the others are being written by another transaction.
+        Does not commit, the locks are held until the caller commits.
+        """
+        if len(serial_numbers) == 0:
+            return {}, set()
+        q_stored = "SELECT serial_number, transaction_date, status, content_hash, table_hashes " \
+                   "FROM trademark_app_case_files WHERE serial_number = ANY(%s) FOR UPDATE SKIP LOCKED"
+        # CASE makes sure only serials without a row take an advisory lock
+        q_new = "SELECT s FROM unnest(%s::int8[]) AS s WHERE CASE " \
+                "WHEN EXISTS (SELECT 1 FROM trademark_app_case_files WHERE serial_number = s) THEN false " \
+                "ELSE pg_try_advisory_xact_lock(%s, (s / %s)::int4) END"
+        cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        try:
+            with metrics.current().timer('lock'):
+                self.execute(cur, q_stored, (list(serial_numbers),))
+                stored = dict((row.pop('serial_number'), row) for row in cur.fetchall())
+                others = [s for s in serial_numbers if s not in stored]
+                new = set()
+                if len(others) > 0:
+                    self.execute(cur, q_new, (others, LOCK_SPACE, LOCK_BLOCK))
+                    new = set(row['s'] for row in cur.fetchall())
+        finally:
+            cur.close()
+        return stored, new
+
     def case_file_update_status(self, serial_number, status):
         if serial_number is None or status is None:
             logging.error('UPDATE ERROR: Missing serial_number or status')
@@ -123,6 +409,91 @@ class Db(object):
             cur.close()
         return rowcount
 
+    def delete_serials(self, serial_numbers):
+        """
+        Deletes whole case-files, child tables follow with ON DELETE CASCADE.
+        Does not commit, the caller owns the transaction.
+        """
+        if len(serial_numbers) == 0:
+            return 0
+        q = 'DELETE FROM trademark_app_case_files WHERE serial_number = ANY(%s)'
+        start_time = time.time()
+        cur = self.cnx.cursor()
+        try:
+            with metrics.current().timer('delete', table='trademark_app_case_files'):
+                self.execute(cur, q, (list(serial_numbers),))
+            rowcount = cur.rowcount
+            metrics.current().inc('tm_rows_deleted_total', rowcount, table='trademark_app_case_files')
+            self.logger.debug('Deleted %s case files [%s sec]', rowcount, time.time() - start_time)
+        finally:
+            cur.close()
+        return rowcount
+
+    def delete_table_serials(self, table, serial_numbers, parent=None):
+        """
+        Deletes the rows of serial_numbers from one child table or partition, counted under
+        parent for a partition.
+        Does not commit, the caller owns the transaction.
+        """
+        if len(serial_numbers) == 0:
+            return 0
+        q = 'DELETE FROM {0} WHERE serial_number = ANY(%s)'.format(table)
+        cur = self.cnx.cursor()
+        try:
+            with metrics.current().timer('delete', table=parent or table):
+                self.execute(cur, q, (list(serial_numbers),))
+            rowcount = cur.rowcount
+            metrics.current().inc('tm_rows_deleted_total', rowcount, table=parent or table)
+        finally:
+            cur.close()
+        return rowcount
+
+    def update_case_files(self, rows):
+        """
+        Updates the case_files rows of case-files kept in place, with one statement.
+        Does not commit, the caller owns the transaction.
+        """
+        if len(rows) == 0:
+            return 0
+        q = "UPDATE trademark_app_case_files cf SET registration_number = v.registration_number, " \
+            "transaction_date = v.transaction_date::date, file_id = v.file_id::int, status = false, " \
+            "content_hash = v.content_hash, table_hashes = v.table_hashes::jsonb, modified = now() " \
+            "FROM (VALUES %s) AS v (serial_number, registration_number, transaction_date, file_id, " \
+            "content_hash, table_hashes) WHERE cf.serial_number = v.serial_number"
+        values = [(row['serial_number'], row['registration_number'], row['transaction_date'], row['file_id'],
+                   row['content_hash'], row['table_hashes']) for row in rows]
+        cur = self.cnx.cursor()
+        try:
+            with metrics.current().timer('update', table='trademark_app_case_files'):
+                execute_values(cur, q, values, page_size=len(values))
+            rowcount = cur.rowcount
+            metrics.current().inc('tm_rows_updated_total', rowcount, table='trademark_app_case_files')
+        finally:
+            cur.close()
+        return rowcount
+
+    def parties_insert(self, parties, columns):
+        """
+        Inserts the parties (list of dicts with party_hash and columns) not stored yet, in
+        hash order so concurrent batches wait on each other instead of deadlocking.
+        Does not commit, the caller owns the transaction.
+        """
+        if len(parties) == 0:
+            return 0
+        columns = ['party_hash'] + list(columns)
+        q = 'INSERT INTO trademark_parties ({0}) VALUES %s ON CONFLICT (party_hash) DO NOTHING'.format(
+            ', '.join(columns))
+        values = [tuple(party[c] for c in columns) for party in sorted(parties, key=lambda p: p['party_hash'])]
+        cur = self.cnx.cursor()
+        try:
+            with metrics.current().timer('write', table='trademark_parties'):
+                execute_values(cur, q, values, page_size=len(values))
+            rowcount = cur.rowcount
+            metrics.current().inc('tm_rows_written_total', rowcount, table='trademark_parties')
+        finally:
+            cur.close()
+        return rowcount
+
     def insert_listdict(self, lst, table):
         if len(lst) == 0:
             return None
@@ -138,9 +509,12 @@ class Db(object):
             execute_values(cur, q, values)
             rowcount = cur.rowcount
             # self.cur.execute(q)
-            self.cnx.commit()
+            self.commit()
             self.logger.debug('Inserted %s rows in table %s [%s sec]', rowcount, table, time.time() - start_time)
         except psycopg2.Error as err:
+            if self.unit is not None:
+                # the unit of work rolls back the whole case-file
+                raise
             self.logger.error('Insert failed for table_name %s', table)
             self.logger.error(err)
             self.cnx.rollback()
@@ -158,17 +532,19 @@ class Db(object):
             return None
         keys = d.keys()
         columns = ', '.join(keys)
-        values = ', '.join(['%({})s'.format(k) for k in keys])
+        values = ', '.join(['%s'] * len(keys))
         start_time = time.time()
         q = 'INSERT INTO {0} ({1}) values ({2}) RETURNING id'.format(table, columns, values)
         try:
             cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            q = cur.mogrify(q, d)
-            cur.execute(q)
-            self.cnx.commit()
+            self.execute(cur, q, list(d.values()))
+            self.commit()
             last_row = cur.fetchone()
             self.logger.debug('Inserted id [%s] in table %s [%s sec]', last_row['id'], table, time.time() - start_time)
         except psycopg2.Error as err:
+            if self.unit is not None:
+                # the unit of work rolls back the whole case-file
+                raise
             self.logger.error('Insert failed for table_name %s', table)
             self.logger.error(err)
             self.cnx.rollback()
@@ -178,3 +554,284 @@ class Db(object):
         if last_row:
             last_row = last_row['id']
         return last_row
+
+    def partitions(self, tables):
+        """
+        {partitioned table: set of its partition names} for the partitioned ones of tables
+        """
+        q = "SELECT i.inhparent::regclass::text AS parent, i.inhrelid::regclass::text AS partition " \
+            "FROM pg_inherits i JOIN pg_class p ON p.oid = i.inhparent " \
+            "WHERE p.relkind = 'p' AND i.inhparent = ANY(%s::regclass[])"
+        cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        try:
+            cur.execute(q, (list(tables),))
+            result = defaultdict(set)
+            for row in cur.fetchall():
+                result[row['parent']].add(row['partition'])
+            self.cnx.commit()
+        finally:
+            cur.close()
+        return dict(result)
+
+    def reserve_ids(self, table, count):
+        """
+        Takes count values from the id sequence of table, so rows can be written with COPY
+        and still be referenced by their child rows.
+        """
+        if count == 0:
+            return []
+        q = "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)"
+        cur = self.cnx.cursor()
+        try:
+            self.execute(cur, q, (table, count))
+            result = [row[0] for row in cur.fetchall()]
+        finally:
+            cur.close()
+        return result
+
+    def copy_rows(self, rows, table, columns, parent=None):
+        """
+        Writes rows (list of dicts) into table with COPY FROM STDIN. The rows of a partition
+        are counted under its partitioned parent table.
+        Does not commit, the caller owns the transaction.
+        """
+        if len(rows) == 0:
+            return 0
+        buf = io.StringIO()
+        for d in rows:
+            buf.write('\t'.join([copy_value(d[c]) for c in columns]))
+            buf.write('\n')
+        buf.seek(0)
+        start_time = time.time()
+        q = 'COPY {0} ({1}) FROM STDIN'.format(table, ', '.join(['"{}"'.format(c) for c in columns]))
+        cur = self.cnx.cursor()
+        try:
+            with metrics.current().timer('write', table=parent or table):
+                cur.copy_expert(q, buf)
+            rowcount = cur.rowcount
+            metrics.current().inc('tm_rows_written_total', rowcount, table=parent or table)
+            self.logger.debug('Copied %s rows in table %s [%s sec]', rowcount, table, time.time() - start_time)
+        finally:
+            cur.close()
+        return rowcount
+
+    def stage_create(self, tables):
+        """
+        Creates empty staging copies of tables. Temporary tables are not WAL-logged
+        and are private to the connection, so concurrent workers never share them.
+        """
+        cur = self.cnx.cursor()
+        try:
+            for table in tables:
+                stage = table.replace('trademark_app_', 'trademark_stage_', 1)
+                cur.execute('CREATE TEMPORARY TABLE IF NOT EXISTS {0} (LIKE {1} INCLUDING DEFAULTS)'.format(
+                    stage, table))
+                cur.execute('TRUNCATE {0}'.format(stage))
+            self.cnx.commit()
+        finally:
+            cur.close()
+
+    def stage_delete_serials(self, tables, serial_numbers):
+        if len(serial_numbers) == 0:
+            return 0
+        cur = self.cnx.cursor()
+        try:
+            for table in tables:
+                stage = table.replace('trademark_app_', 'trademark_stage_', 1)
+                cur.execute('DELETE FROM {0} WHERE serial_number = ANY(%s)'.format(stage), (list(serial_numbers),))
+        finally:
+            cur.close()
+        return len(serial_numbers)
+
+    def stage_merge(self, tables, groups, force=False):
+        """
+        Moves the staged case-files that are new or newer than the live ones into the
+        live tables in one transaction. Case-files already live keep their case_files
+        row, only the table groups whose hash changed are replaced. Their rows are locked
+        first, so the decision holds against workers writing the same serials.
+        """
+        # rows replaced while waiting are new rows, locked by the next round
+        q_lock = "SELECT l.serial_number FROM trademark_app_case_files l " \
+                 "JOIN trademark_stage_case_files s ON s.serial_number = l.serial_number " \
+                 "ORDER BY l.serial_number FOR UPDATE OF l"
+        q_decide = "CREATE TEMPORARY TABLE trademark_stage_decision ON COMMIT DROP AS " \
+                   "SELECT s.serial_number, l.serial_number IS NOT NULL AS existing, " \
+                   "COALESCE(l.content_hash = s.content_hash, false) AS unchanged, " \
+                   "l.transaction_date IS NOT DISTINCT FROM s.transaction_date AS same_date, " \
+                   "l.table_hashes AS live_hashes, s.table_hashes AS stage_hashes " \
+                   "FROM trademark_stage_case_files s " \
+                   "LEFT JOIN trademark_app_case_files l ON l.serial_number = s.serial_number " \
+                   "WHERE l.serial_number IS NULL OR s.transaction_date > l.transaction_date " \
+                   "OR (l.transaction_date IS NULL AND s.transaction_date IS NOT NULL) " \
+                   "OR (%s AND NOT l.status)"
+        q_count = "SELECT count(*) FILTER (WHERE NOT existing) AS new, " \
+                  "count(*) FILTER (WHERE existing AND NOT unchanged) AS updated, " \
+                  "count(*) FILTER (WHERE unchanged) AS unchanged, " \
+                  "(SELECT count(*) FROM trademark_stage_case_files) - count(*) AS stale " \
+                  "FROM trademark_stage_decision"
+        q_changed = "existing AND NOT unchanged AND live_hashes->>'{group}' IS DISTINCT FROM stage_hashes->>'{group}'"
+        q_delete = "DELETE FROM {table} WHERE serial_number IN " \
+                   "(SELECT serial_number FROM trademark_stage_decision WHERE %s)" % q_changed
+        q_insert = "INSERT INTO {table} SELECT * FROM {stage} WHERE serial_number IN " \
+                   "(SELECT serial_number FROM trademark_stage_decision WHERE NOT existing OR %s)" % q_changed
+        q_insert_new = "INSERT INTO trademark_app_case_files SELECT * FROM trademark_stage_case_files " \
+                       "WHERE serial_number IN (SELECT serial_number FROM trademark_stage_decision WHERE NOT existing)"
+        q_update = "UPDATE trademark_app_case_files l SET registration_number = s.registration_number, " \
+                   "transaction_date = s.transaction_date, file_id = s.file_id, status = false, " \
+                   "content_hash = s.content_hash, table_hashes = s.table_hashes, modified = now() " \
+                   "FROM trademark_stage_case_files s, trademark_stage_decision d " \
+                   "WHERE s.serial_number = l.serial_number AND d.serial_number = l.serial_number " \
+                   "AND d.existing AND NOT (d.unchanged AND d.same_date)"
+        cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        file_metrics = metrics.current()
+        try:
+            cur.execute('ANALYZE trademark_stage_case_files')
+            locked = None
+            with file_metrics.timer('lock'):
+                while True:
+                    cur.execute(q_lock)
+                    if cur.rowcount == locked:
+                        break
+                    locked = cur.rowcount
+            cur.execute(q_decide, (force,))
+            cur.execute(q_count)
+            result = cur.fetchone()
+            deleted = {}
+            for group, group_tables in groups.items():
+                for table in group_tables:
+                    with file_metrics.timer('delete', table=table):
+                        cur.execute(q_delete.format(group=group, table=table))
+                    deleted[table] = cur.rowcount
+            with file_metrics.timer('update', table='trademark_app_case_files'):
+                cur.execute(q_update)
+            updated = cur.rowcount
+            written = {}
+            with file_metrics.timer('merge', table='trademark_app_case_files'):
+                cur.execute(q_insert_new)
+            written['trademark_app_case_files'] = cur.rowcount
+            for group, group_tables in groups.items():
+                for table in group_tables:
+                    stage = table.replace('trademark_app_', 'trademark_stage_', 1)
+                    with file_metrics.timer('merge', table=table):
+                        cur.execute(q_insert.format(group=group, table=table, stage=stage))
+                    written[table] = cur.rowcount
+            for table in tables:
+                cur.execute('TRUNCATE {0}'.format(table.replace('trademark_app_', 'trademark_stage_', 1)))
+            self.cnx.commit()
+            for table, rowcount in deleted.items():
+                file_metrics.inc('tm_rows_deleted_total', rowcount, table=table)
+            file_metrics.inc('tm_rows_updated_total', updated, table='trademark_app_case_files')
+            for table, rowcount in written.items():
+                file_metrics.inc('tm_rows_written_total', rowcount, table=table)
+        except psycopg2.Error:
+            self.cnx.rollback()
+            raise
+        finally:
+            cur.close()
+        return result
+
+    def table_empty(self, table):
+        cur = self.cnx.cursor()
+        try:
+            cur.execute('SELECT NOT EXISTS (SELECT 1 FROM {0})'.format(table))
+            result = cur.fetchone()[0]
+            self.cnx.commit()
+        finally:
+            cur.close()
+        return result
+
+    def bootstrap_drop(self, tables):
+        """
+        Saves the definitions of the foreign keys and non-unique indexes of tables in
+        trademark_bootstrap and drops them, in one transaction. Returns the number dropped.
+        Those of partitioned tables are saved once and recreated on all partitions.
+        The serial_number indexes stay, replaced serials are deleted through them.
+        """
+        q_save = "INSERT INTO trademark_bootstrap (name, table_name, kind, definition) " \
+                 "SELECT quote_ident(c.conname), c.conrelid::regclass::text, 'foreign_key', " \
+                 "pg_get_constraintdef(c.oid) FROM pg_constraint c " \
+                 "WHERE c.contype = 'f' AND c.conrelid = ANY(%s::regclass[]) " \
+                 "UNION ALL " \
+                 "SELECT i.indexrelid::regclass::text, i.indrelid::regclass::text, 'index', " \
+                 "replace(pg_get_indexdef(i.indexrelid), ' ON ONLY ', ' ON ') FROM pg_index i " \
+                 "WHERE NOT i.indisunique AND i.indrelid = ANY(%s::regclass[]) " \
+                 "AND NOT (i.indnkeyatts = 1 AND i.indkey[0] = (SELECT a.attnum FROM pg_attribute a " \
+                 "WHERE a.attrelid = i.indrelid AND a.attname = 'serial_number')) " \
+                 "ON CONFLICT (name) DO NOTHING RETURNING name, table_name, kind"
+        cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        try:
+            cur.execute(q_save, (list(tables), list(tables)))
+            saved = cur.fetchall()
+            # foreign keys first, the indexes do not depend on them
+            for row in sorted(saved, key=lambda row: row['kind'] != 'foreign_key'):
+                if row['kind'] == 'foreign_key':
+                    cur.execute('ALTER TABLE {0} DROP CONSTRAINT {1}'.format(row['table_name'], row['name']))
+                else:
+                    cur.execute('DROP INDEX {0}'.format(row['name']))
+            self.cnx.commit()
+        except psycopg2.Error:
+            self.cnx.rollback()
+            raise
+        finally:
+            cur.close()
+        return len(saved)
+
+    def bootstrap_definitions(self):
+        q = "SELECT name, table_name, kind, definition FROM trademark_bootstrap ORDER BY table_name, name"
+        cur = self.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        try:
+            cur.execute(q)
+            result = cur.fetchall()
+            self.cnx.commit()
+        finally:
+            cur.close()
+        return result
+
+    def bootstrap_restore(self, definition, maintenance_work_mem):
+        """
+        Creates a saved index, or adds a saved foreign key as NOT VALID when it is missing and
+        validates it. The definition is deleted in the same transaction.
+        """
+        q_exists = "SELECT EXISTS (SELECT 1 FROM pg_constraint " \
+                   "WHERE quote_ident(conname) = %s AND conrelid = %s::regclass), " \
+                   "(SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass)"
+        name, table = definition['name'], definition['table_name']
+        cur = self.cnx.cursor()
+        try:
+            cur.execute('SET LOCAL maintenance_work_mem = %s', (maintenance_work_mem,))
+            if definition['kind'] == 'index':
+                with metrics.current().timer('index', table=table):
+                    cur.execute(definition['definition'])
+            else:
+                cur.execute(q_exists, (name, table, table))
+                exists, partitioned = cur.fetchone()
+                if partitioned:
+                    # partitioned tables can not take a NOT VALID foreign key
+                    with metrics.current().timer('validate', table=table):
+                        cur.execute('ALTER TABLE {0} ADD CONSTRAINT {1} {2}'.format(
+                            table, name, definition['definition']))
+                else:
+                    if not exists:
+                        # without the validating scan, adding takes a moment
+                        cur.execute('ALTER TABLE {0} ADD CONSTRAINT {1} {2} NOT VALID'.format(
+                            table, name, definition['definition']))
+                        self.cnx.commit()
+                        cur.execute('SET LOCAL maintenance_work_mem = %s', (maintenance_work_mem,))
+                    with metrics.current().timer('validate', table=table):
+                        cur.execute('ALTER TABLE {0} VALIDATE CONSTRAINT {1}'.format(table, name))
+            cur.execute('DELETE FROM trademark_bootstrap WHERE name = %s', (name,))
+            self.cnx.commit()
+        except psycopg2.Error:
+            self.cnx.rollback()
+            raise
+        finally:
+            cur.close()
+
+    def analyze(self, table):
+        cur = self.cnx.cursor()
+        try:
+            with metrics.current().timer('analyze', table=table):
+                cur.execute('ANALYZE {0}'.format(table))
+            self.cnx.commit()
+        finally:
+            cur.close()
@@ -0,0 +1,155 @@
+import logging
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+CHUNK_SIZE = 1024 * 1024
+POOL_SIZE = 12
+RETRIES = 5
+BACKOFF = 2
+TIMEOUT = (10, 60)
+
+
+class DownloadError(Exception):
+    pass
+
+
+def parse_size(size):
+    """
+    Size in bytes from the listing of bulkdata.uspto.gov, None when it can not be read
+    """
+    try:
+        return int(str(size).replace(',', '').strip())
+    except ValueError:
+        return None
+
+
+class CountingReader(object):
+    """
+    Counts the bytes read from fileobj as downloaded
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.metrics = metrics.current()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.metrics.inc('tm_bytes_downloaded_total', len(data))
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+def validator(response):
+    """
+    ETag, or Last-Modified, of response for If-Range, None when it has neither or a weak ETag
+    """
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+class Downloader(object):
+    """
+    Downloads bulkdata files over a pooled session, resuming partial .part files with HTTP Range.
+    The validator of the response that started a .part file is kept in a .part.validator
+    file and sent as If-Range, so a file changed since is downloaded again from the start.
+    """
+
+    def __init__(self, session=None, chunk_size=CHUNK_SIZE, retries=RETRIES, backoff=BACKOFF,
+                 timeout=TIMEOUT, pool_size=POOL_SIZE):
+        self.logger = logging.getLogger(__name__)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            # no adapter retries, download() retries itself so that it resumes the .part file
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def download(self, url, filename, expected_size=None):
+        part_filename = filename + '.part'
+        start_time = time.time()
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.current().timer('download'):
+                    self.fetch(url, part_filename)
+                break
+            except (requests.RequestException, IOError) as err:
+                if attempt == self.retries:
+                    raise DownloadError('Download of %s failed: %s' % (url, err))
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning('Download of %s interrupted (%s), resuming in %s sec', url, err, delay)
+                time.sleep(delay)
+        size = os.path.getsize(part_filename)
+        if os.path.isfile(part_filename + '.validator'):
+            os.remove(part_filename + '.validator')
+        if expected_size is not None and size != expected_size:
+            os.remove(part_filename)
+            raise DownloadError('Size of %s is %s bytes, expected %s' % (url, size, expected_size))
+        os.replace(part_filename, filename)
+        self.logger.info('File %s downloaded in [%s sec].', filename, time.time() - start_time)
+        return filename
+
+    def fetch(self, url, part_filename):
+        validator_filename = part_filename + '.validator'
+        offset = os.path.getsize(part_filename) if os.path.isfile(part_filename) else 0
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%s-' % offset
+            if os.path.isfile(validator_filename):
+                with open(validator_filename) as f:
+                    headers['If-Range'] = f.read()
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if offset and r.status_code == 416:
+                # the part file is already complete
+                return
+            r.raise_for_status()
+            if offset and r.status_code != 206:
+                self.logger.debug('Range not supported or %s changed, downloading from start', url)
+                offset = 0
+            elif offset:
+                self.logger.info('Resuming %s at byte %s', url, offset)
+            if not offset:
+                # a new .part file, resumed only while the remote file keeps this validator
+                current = validator(r)
+                if current:
+                    with open(validator_filename, 'w') as f:
+                        f.write(current)
+                elif os.path.isfile(validator_filename):
+                    os.remove(validator_filename)
+            file_metrics = metrics.current()
+            with open(part_filename, 'ab' if offset else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    file_metrics.inc('tm_bytes_downloaded_total', len(chunk))
+
+    def open_stream(self, url):
+        """
+        Raw response body of url, for parsing while downloading. Only opening it is retried,
+        a stream broken later can not be resumed.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.session.get(url, stream=True, timeout=self.timeout)
+                r.raise_for_status()
+                break
+            except requests.RequestException as err:
+                if attempt == self.retries:
+                    raise DownloadError('Opening %s failed: %s' % (url, err))
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning('Opening %s failed (%s), retrying in %s sec', url, err, delay)
+                time.sleep(delay)
+        r.raw.decode_content = True
+        return CountingReader(r.raw)
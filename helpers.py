@@ -1,16 +1,17 @@
 import requests
 from urllib.parse import urlsplit
 
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/56.0.2924.87 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q = 0.9, image / webp, * / *;q = 0.8"}
+
 
 def download_html(url):
     print('Downloading %s' % url)
     html_content = None
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) "
-                      "Chrome/56.0.2924.87 Safari/537.36",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q = 0.9, image / webp, * / *;q = 0.8"}
     try:
-        r = requests.get(url, headers=headers, allow_redirects=True)
+        r = requests.get(url, headers=HEADERS, allow_redirects=True)
         if r.status_code != 200:
             print('[%s] Downloading %s' % r.status_code, url)
             print(r.headers)
@@ -27,6 +28,37 @@ def download_html(url):
             return html_content
 
 
+def download_html_if_modified(url, etag=None, last_modified=None):
+    """
+    Downloads url unless it is unchanged since the response that sent etag and last_modified.
+    Returns (status_code, html_content, etag, last_modified), status_code 304 when unchanged
+    and None when the request failed.
+    """
+    headers = dict(HEADERS)
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        r = requests.get(url, headers=headers, allow_redirects=True)
+    except requests.exceptions.RequestException:
+        print('Failed to open url %s' % url)
+        return None, None, etag, last_modified
+    if r.status_code == 304:
+        return r.status_code, None, etag, last_modified
+    if r.status_code != 200:
+        print('[%s] Downloading %s' % (r.status_code, url))
+        return r.status_code, None, etag, last_modified
+    return r.status_code, r.content.decode(), r.headers.get('ETag'), r.headers.get('Last-Modified')
+
+
+def xml_filename_from_url(url):
+    zip_filename = url.split('/')[-1]
+    if 'apc18840407-' in zip_filename:
+        return zip_filename.replace('apc18840407-20', 'apc').replace('zip', 'xml')
+    return zip_filename.replace('zip', 'xml')
+
+
 def get_host_from_url(url):
     base_url = "{0.scheme}://{0.netloc}/".format(urlsplit(url))
     return base_url
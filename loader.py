@@ -0,0 +1,493 @@
+import datetime
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from operator import itemgetter
+
+import psycopg2
+
+import metrics
+
+BATCH_SIZE = 1000
+# seconds after which a batch is written even when it has fewer than BATCH_SIZE case-files
+BATCH_SECONDS = 30
+# seconds to wait before writing again case-files another worker is writing
+DEFER_DELAY = 0.2
+# serial numbers per partition of the tables partitioned by serial_number, named <table>_s<series>
+SERIES_SIZE = 1000000
+
+# Parent tables come before their children, trademark_app_case_files before everything
+TABLES = ('trademark_app_case_files', 'trademark_app_case_file_headers', 'trademark_app_case_file_statements',
+          'trademark_app_case_file_event_statements', 'trademark_app_prior_registration_applications',
+          'trademark_app_foreign_applications', 'trademark_app_classifications', 'trademark_app_us_codes',
+          'trademark_app_correspondents', 'trademark_app_case_file_owners', 'trademark_app_design_searches',
+          'trademark_app_international_registration', 'trademark_app_madrid_international_filing_record',
+          'trademark_app_madrid_history_events')
+
+# child table: (column holding the parent id, parent table)
+PARENT_KEYS = {
+    'trademark_app_us_codes': ('classification_id', 'trademark_app_classifications'),
+    'trademark_app_madrid_history_events': ('madrid_international_filing_record_id',
+                                            'trademark_app_madrid_international_filing_record'),
+}
+PARENT_TABLES = tuple(parent for key, parent in PARENT_KEYS.values())
+
+
+def table_group(table):
+    """
+    Name of the group a table is hashed and rewritten with, children go with their parent
+    """
+    if table in PARENT_KEYS:
+        table = PARENT_KEYS[table][1]
+    return table.replace('trademark_app_', '', 1)
+
+
+# group: tables, for every table but trademark_app_case_files
+GROUPS = OrderedDict()
+for _table in TABLES[1:]:
+    GROUPS.setdefault(table_group(_table), []).append(_table)
+
+# Columns that change with every issue of a case-file without changing its content
+UNHASHED_COLUMNS = ('serial_number', 'file_id', 'transaction_date', 'content_hash', 'table_hashes')
+
+# First-use dates are often partial (19900000) and stay varchar
+PARTIAL_DATE_COLUMNS = ('first_use_anywhere_date', 'first_use_in_commerce_date')
+INDICATORS = {'T': True, 'Y': True, 'F': False, 'N': False}
+
+_dates = {}
+
+
+def is_date_column(column):
+    return (column == 'date' or column.endswith('_date') or column.endswith('_date_uspto')) \
+        and column not in PARTIAL_DATE_COLUMNS
+
+
+def is_indicator_column(column):
+    return column.endswith('_in')
+
+
+def parse_date(value):
+    """
+    date of a YYYYMMDD string, None when it is empty or not a valid date
+    """
+    if value is None or isinstance(value, datetime.date):
+        return value
+    value = value.strip()
+    if len(value) != 8 or not value.isdigit():
+        return None
+    try:
+        return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:]))
+    except ValueError:
+        return None
+
+
+def to_date(value):
+    try:
+        return _dates[value]
+    except KeyError:
+        result = _dates[value] = parse_date(value)
+        return result
+
+
+def convert_dates(values):
+    """
+    Converts a whole column, parsing each distinct string only once. The cache is kept
+    between batches, a daily file holds only a few thousand distinct dates.
+    """
+    for value in set(values).difference(_dates):
+        _dates[value] = parse_date(value)
+    return [_dates[value] for value in values]
+
+
+def convert_indicators(values):
+    return [value if value is None or isinstance(value, bool) else INDICATORS.get(value.strip().upper())
+            for value in values]
+
+
+def convert_columns(tables):
+    """
+    Replaces the date and indicator strings of all rows of a batch, column by column
+    """
+    for rows in tables.values():
+        if len(rows) == 0:
+            continue
+        for column in rows[0].keys():
+            if is_date_column(column):
+                convert = convert_dates
+            elif is_indicator_column(column):
+                convert = convert_indicators
+            else:
+                continue
+            for row, value in zip(rows, convert([row[column] for row in rows])):
+                row[column] = value
+
+
+def is_newer(transaction_date, stored_transaction_date):
+    transaction_date = to_date(transaction_date)
+    stored_transaction_date = to_date(stored_transaction_date)
+    if transaction_date is None:
+        return False
+    return stored_transaction_date is None or transaction_date > stored_transaction_date
+
+
+def row_digest(digest, row):
+    digest.update(repr([(k, v) for k, v in row.items() if k not in UNHASHED_COLUMNS]).encode('utf-8'))
+
+
+def case_hashes(rows):
+    """
+    Hashes of the extracted rows of a case-file: one per table group and one over the
+    whole case-file. Returns (content_hash, {group: hash}).
+    """
+    digests = OrderedDict((group, hashlib.blake2b(digest_size=8)) for group in GROUPS)
+    for table, table_rows in rows.items():
+        if table == 'trademark_app_case_files':
+            continue
+        digest = digests[table_group(table)]
+        digest.update(table.encode('utf-8'))
+        for row in table_rows:
+            row_digest(digest, row)
+    table_hashes = dict((group, digest.hexdigest()) for group, digest in digests.items())
+    content = hashlib.blake2b(digest_size=16)
+    row_digest(content, rows['trademark_app_case_files'][0])
+    for group in GROUPS:
+        content.update(table_hashes[group].encode('utf-8'))
+    return content.hexdigest(), table_hashes
+
+
+class CopyLoader(object):
+    """
+    Collects the rows of many case-files and writes every table with COPY in batches
+    """
+
+    def __init__(self, dbc, batch_size=BATCH_SIZE, file_id=None, index=None, force=False, cascade=True,
+                 batch_seconds=BATCH_SECONDS, parties=None):
+        self.logger = logging.getLogger(__name__)
+        self.dbc = dbc
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.batch_started = time.time()
+        self.force = force
+        # False while a bootstrap has dropped the foreign keys deleting the child rows
+        self.cascade = cascade
+        # partitioned table: names of its partitions
+        self.partitions = dbc.partitions(TABLES)
+        # checkpoints are written only when file_id is given
+        self.file_id = file_id
+        # a SerialIndex answering lookups instead of the database
+        self.index = index
+        # a PartyResolver writing name and address columns to trademark_parties
+        self.parties = parties
+        self.position = None
+        self.checkpointed = 0
+        self.pending = OrderedDict()
+        self.cases_written = 0
+
+    def lookup(self, serial_numbers):
+        if self.index is not None:
+            return self.index.lookup(serial_numbers)
+        return self.dbc.serials_get(serial_numbers)
+
+    def pending_case(self, serial_number):
+        case = self.pending.get(serial_number)
+        if case is None:
+            return None
+        return case['rows']['trademark_app_case_files'][0]
+
+    def advance(self, case, serial_number):
+        """
+        Marks the first case case-files of the file as handled, the last one being
+        serial_number. They are either added before the next flush or skipped.
+        """
+        self.position = (case, serial_number)
+        if len(self.pending) == 0 and case - self.checkpointed >= self.batch_size:
+            # a long run of skipped case-files
+            self.checkpoint()
+            self.dbc.cnx.commit()
+
+    def checkpoint(self):
+        if self.file_id is not None and self.position is not None:
+            self.dbc.file_checkpoint(self.file_id, *self.position)
+            self.checkpointed = self.position[0]
+
+    def add(self, serial_number, rows, replace=False):
+        content_hash, table_hashes = case_hashes(rows)
+        case_row = rows['trademark_app_case_files'][0]
+        case_row['content_hash'] = content_hash
+        case_row['table_hashes'] = json.dumps(table_hashes, sort_keys=True)
+        previous = self.pending.pop(serial_number, None)
+        if previous is not None:
+            # a newer version of a case-file that is not written yet
+            replace = replace or previous['replace']
+        elif len(self.pending) == 0:
+            self.batch_started = time.time()
+        self.pending[serial_number] = {'rows': rows, 'replace': replace, 'patch': None}
+        if len(self.pending) >= self.batch_size or time.time() - self.batch_started >= self.batch_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending case-files in one transaction. Those whose serial another worker
+        is writing stay pending, the checkpoint waits until they are written.
+        """
+        if len(self.pending) == 0:
+            return 0
+        cases = list(self.pending.items())
+        self.pending = OrderedDict()
+        start_time = self.batch_started = time.time()
+        self.convert(cases)
+        with metrics.current().timer('flush'):
+            try:
+                written = self.write_locked(cases)
+                if len(self.pending) == 0:
+                    self.checkpoint()
+                self.dbc.cnx.commit()
+                self.committed(written)
+            except psycopg2.Error as err:
+                self.dbc.cnx.rollback()
+                self.logger.warning('Batch of %s cases failed, writing them one by one: %s', len(cases), err)
+                self.pending = OrderedDict()
+                written = self.write_each(cases)
+                if len(self.pending) == 0:
+                    self.checkpoint()
+                self.dbc.cnx.commit()
+        self.cases_written += len(written)
+        self.logger.info('Wrote %s cases, %s deferred in [%6.3f sec]', len(written), len(self.pending),
+                         time.time() - start_time)
+        return len(written)
+
+    def write_locked(self, cases):
+        """
+        Locks the serial numbers of cases and decides each case again against the version
+        stored now, so a case-file never overwrites a newer one another worker wrote since
+        the lookup. Serials another transaction holds are not waited for but queued again.
+        Returns the cases written.
+        """
+        stored, new = self.dbc.serials_lock([serial_number for serial_number, case in cases])
+        result = []
+        for serial_number, case in cases:
+            if serial_number in stored:
+                if not self.decide(case, stored[serial_number]):
+                    continue
+            elif serial_number in new:
+                case['replace'] = False
+                case['patch'] = None
+            else:
+                metrics.current().inc('tm_cases_deferred_total')
+                self.pending[serial_number] = case
+                continue
+            result.append((serial_number, case))
+        self.write(result)
+        return result
+
+    def decide(self, case, stored):
+        """
+        Sets how case replaces stored, the version in the database: whole, by the table
+        groups whose hash changed, or only its case_files row when the content is the same.
+        Returns False when case is not newer than stored or is the same version.
+        """
+        case_row = case['rows']['trademark_app_case_files'][0]
+        if not is_newer(case_row['transaction_date'], stored['transaction_date']) \
+                and not (self.force and stored['status'] is False):
+            metrics.current().inc('tm_cases_skipped_total')
+            return False
+        case['replace'] = True
+        case['patch'] = None
+        if not stored.get('table_hashes'):
+            return True
+        if stored['content_hash'] == case_row['content_hash']:
+            metrics.current().inc('tm_cases_unchanged_total')
+            if to_date(stored['transaction_date']) == to_date(case_row['transaction_date']):
+                return False
+        table_hashes = json.loads(case_row['table_hashes'])
+        case['patch'] = [group for group in GROUPS if stored['table_hashes'].get(group) != table_hashes[group]]
+        case['replace'] = False
+        return True
+
+    def convert(self, cases):
+        tables = OrderedDict((table, []) for table in TABLES)
+        for serial_number, case in cases:
+            for table, rows in case['rows'].items():
+                tables[table].extend(rows)
+        convert_columns(tables)
+
+    def write_each(self, cases):
+        """
+        Writes cases one by one in a unit of work, so only the bad case-files are lost
+        """
+        written = []
+        uncommitted = []
+        with self.dbc.unit_of_work(self.batch_size, self.batch_seconds) as unit:
+            for case in cases:
+                try:
+                    with unit.case():
+                        uncommitted.extend(self.write_locked([case]))
+                except psycopg2.Error as err:
+                    self.pending.pop(case[0], None)
+                    self.logger.error('Could not insert %s', case[0])
+                    self.logger.error(err)
+                if unit.due():
+                    unit.commit()
+                    self.committed(uncommitted)
+                    written.extend(uncommitted)
+                    uncommitted = []
+        self.committed(uncommitted)
+        written.extend(uncommitted)
+        return written
+
+    def write(self, cases):
+        self.retire([serial_number for serial_number, case in cases if case['replace']])
+        self.patch([(serial_number, case) for serial_number, case in cases if case['patch'] is not None])
+        if self.parties is not None:
+            self.parties.resolve(self.dbc, cases)
+        for table, rows in self.table_rows(cases).items():
+            if len(rows) > 0:
+                columns = list(rows[0].keys())
+                parent = table if table in self.partitions else None
+                for target, target_rows in self.route(table, rows, key=itemgetter('serial_number')).items():
+                    self.dbc.copy_rows(target_rows, target, columns, parent=parent)
+
+    def committed(self, cases):
+        if self.parties is not None:
+            self.parties.committed(cases)
+        if self.index is not None:
+            for serial_number, case in cases:
+                self.index.update(serial_number, case['rows']['trademark_app_case_files'][0]['transaction_date'])
+
+    def retire(self, serial_numbers):
+        if not self.cascade:
+            for table in TABLES[1:]:
+                self.delete_table_serials(table, serial_numbers)
+        self.dbc.delete_serials(serial_numbers)
+
+    def delete_table_serials(self, table, serial_numbers):
+        parent = table if table in self.partitions else None
+        for target, target_serials in self.route(table, serial_numbers).items():
+            self.dbc.delete_table_serials(target, target_serials, parent=parent)
+
+    def patch(self, cases):
+        """
+        Deletes the changed table groups of cases and updates their case_files rows in place,
+        the new rows of the changed groups are copied with the rest of the batch
+        """
+        if len(cases) == 0:
+            return
+        serials = defaultdict(list)
+        for serial_number, case in cases:
+            for group in case['patch']:
+                for table in GROUPS[group]:
+                    serials[table].append(serial_number)
+        for table in TABLES:
+            if table in serials:
+                self.delete_table_serials(table, serials[table])
+        self.dbc.update_case_files([case['rows']['trademark_app_case_files'][0] for serial_number, case in cases])
+
+    def target(self, table):
+        return table
+
+    def route(self, table, items, key=None):
+        """
+        Groups items of table, serial numbers or rows whose serial number key gives, by the
+        partition holding them. A table that is not partitioned gets them all.
+        """
+        partitions = self.partitions.get(table)
+        if partitions is None:
+            return {self.target(table): items}
+        routed = OrderedDict()
+        for item in items:
+            serial_number = key(item) if key is not None else item
+            partition = '%s_s%s' % (table, serial_number // SERIES_SIZE)
+            # serials of a series without its partition go to the default one
+            routed.setdefault(partition if partition in partitions else table, []).append(item)
+        return routed
+
+    def table_rows(self, cases):
+        """
+        Merges the rows of all cases per table and replaces the per-case parent
+        positions of child rows with ids reserved from the parent sequences.
+        """
+        tables = OrderedDict((table, []) for table in TABLES)
+        parent_positions = {}
+        for serial_number, case in cases:
+            offsets = dict((parent, len(tables[parent])) for parent in PARENT_TABLES)
+            for table, rows in case['rows'].items():
+                if case['patch'] is not None and table_group(table) not in case['patch']:
+                    continue
+                if table in PARENT_KEYS:
+                    key, parent = PARENT_KEYS[table]
+                    for row in rows:
+                        parent_positions[id(row)] = offsets[parent] + row[key]
+                tables[table].extend(rows)
+        parent_ids = {}
+        for parent in PARENT_TABLES:
+            ids = self.dbc.reserve_ids(parent, len(tables[parent]))
+            parent_ids[parent] = ids
+            tables[parent] = [dict(row, id=row_id) for row, row_id in zip(tables[parent], ids)]
+        for table, (key, parent) in PARENT_KEYS.items():
+            ids = parent_ids[parent]
+            tables[table] = [dict(row, **{key: ids[parent_positions[id(row)]]}) for row in tables[table]]
+        return tables
+
+    def close(self):
+        self.flush()
+        while len(self.pending) > 0:
+            # serials another worker is still writing
+            time.sleep(DEFER_DELAY)
+            self.flush()
+        return self.cases_written
+
+
+class StagingLoader(CopyLoader):
+    """
+    Copies a whole file into temporary staging tables and merges it into the live
+    tables in one transaction when the file is done. New, newer and stale serials
+    are told apart in SQL, only repeated serials inside the file are decided here.
+    """
+
+    def __init__(self, dbc, batch_size=BATCH_SIZE, force=False):
+        super(StagingLoader, self).__init__(dbc, batch_size=batch_size)
+        self.force = force
+        # the staging copies are not partitioned, stage_merge inserts through the parents
+        self.partitions = {}
+        self.staged = {}
+        self.dbc.stage_create(TABLES)
+
+    def lookup(self, serial_numbers):
+        return dict((s, self.staged[s]) for s in serial_numbers if s in self.staged)
+
+    def add(self, serial_number, rows, replace=False):
+        self.staged[serial_number] = {'transaction_date': rows['trademark_app_case_files'][0]['transaction_date'],
+                                      'status': False}
+        super(StagingLoader, self).add(serial_number, rows, replace=replace)
+
+    def write_locked(self, cases):
+        # the staging tables are private, stage_merge decides against the live tables
+        self.write(cases)
+        return cases
+
+    def checkpoint(self):
+        # staged rows are lost with the connection, there is nothing to resume from
+        pass
+
+    def retire(self, serial_numbers):
+        # replace means a serial already staged from an earlier batch of this file
+        self.dbc.stage_delete_serials(TABLES, serial_numbers)
+
+    def target(self, table):
+        return stage_table(table)
+
+    def close(self):
+        self.flush()
+        start_time = time.time()
+        result = self.dbc.stage_merge(TABLES, GROUPS, self.force)
+        self.logger.info('Merged staging tables: %s new, %s updated, %s unchanged, %s stale [%6.3f sec]',
+                         result['new'], result['updated'], result['unchanged'], result['stale'],
+                         time.time() - start_time)
+        self.staged = {}
+        return result['new'] + result['updated']
+
+
+def stage_table(table):
+    return table.replace('trademark_app_', 'trademark_stage_', 1)
@@ -0,0 +1,265 @@
+"""
+Counters and latency histograms for the stages of the parser.
+
+Every record goes to the metrics of the file being processed by the current thread and
+to the process-wide REGISTRY, which is exposed in the Prometheus text format, either
+written to a file for the node_exporter textfile collector or served over HTTP.
+"""
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+HELP = {
+    'tm_stage_seconds': ('histogram', 'Time spent per stage and target table, '
+                                      'stages nest: file > parse > flush > write.'),
+    'tm_bytes_downloaded_total': ('counter', 'Bytes downloaded from bulkdata.'),
+    'tm_cases_parsed_total': ('counter', 'Case-files extracted from the XML.'),
+    'tm_cases_skipped_total': ('counter', 'Case-files not newer than the stored version.'),
+    'tm_cases_deferred_total': ('counter', 'Case-files put back because another worker was writing the same serial.'),
+    'tm_cases_unchanged_total': ('counter', 'Newer case-files with the same content hash as the stored version.'),
+    'tm_party_cache_hits_total': ('counter', 'Parties of written case-files found in the party cache.'),
+    'tm_party_cache_misses_total': ('counter', 'Parties of written case-files inserted unless already stored.'),
+    'tm_rows_written_total': ('counter', 'Rows written per table.'),
+    'tm_rows_updated_total': ('counter', 'Rows updated in place per table.'),
+    'tm_rows_deleted_total': ('counter', 'Rows deleted per table, children deleted by cascade not included.'),
+    'tm_files_total': ('counter', 'Files processed per final status.'),
+    'tm_files_in_progress': ('gauge', 'Files being processed now.'),
+    'tm_queue_depth': ('gauge', 'Batches parsed and waiting for a loader thread.'),
+    'tm_peak_rss_bytes': ('gauge', 'Peak resident memory of the parser processes.'),
+}
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metrics(object):
+    """
+    Thread-safe counters, gauges and histograms, forwarding every record to parent
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = defaultdict(float)
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, label_key(labels))] += value
+        if self.parent is not None:
+            self.parent.inc(name, value, **labels)
+
+    def add(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] += value
+        if self.parent is not None:
+            self.parent.add(name, value, **labels)
+
+    def maximum(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.gauges[key] = max(self.gauges.get(key, 0), value)
+        if self.parent is not None:
+            self.parent.maximum(name, value, **labels)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # one count per bucket, then sum and count
+                histogram = self.histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+            index = bisect.bisect_left(BUCKETS, seconds)
+            if index < len(BUCKETS):
+                histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        if self.parent is not None:
+            self.parent.observe(name, seconds, **labels)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe('tm_stage_seconds', time.time() - start_time, stage=stage, **labels)
+
+    def snapshot(self):
+        """
+        Picklable copy of the values, for merging the metrics of another process
+        """
+        with self.lock:
+            return {'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                    'histograms': dict((k, list(v)) for k, v in self.histograms.items())}
+
+    def merge(self, snapshot):
+        for (name, labels), value in snapshot['counters'].items():
+            self.inc(name, value, **dict(labels))
+        for (name, labels), values in snapshot['histograms'].items():
+            with self.lock:
+                histogram = self.histograms.setdefault((name, labels), [0] * len(BUCKETS) + [0.0, 0])
+                for i, value in enumerate(values):
+                    histogram[i] += value
+            if self.parent is not None:
+                self.parent.merge({'counters': {}, 'histograms': {(name, labels): values}})
+        for (name, labels), value in snapshot.get('gauges', {}).items():
+            if name == 'tm_peak_rss_bytes':
+                self.maximum(name, value, **dict(labels))
+
+    def summary(self):
+        """
+        Totals per stage and table, as stored in trademark_fileinfo.stats
+        """
+        result = {'seconds': {}, 'rows_written': {}, 'rows_updated': {}, 'rows_deleted': {}}
+        with self.lock:
+            for (name, labels), values in self.histograms.items():
+                stage = dict(labels)['stage']
+                result['seconds'][stage] = round(result['seconds'].get(stage, 0) + values[-2], 3)
+            for (name, labels), value in self.counters.items():
+                labels = dict(labels)
+                if name == 'tm_rows_written_total':
+                    result['rows_written'][labels['table']] = int(value)
+                elif name == 'tm_rows_updated_total':
+                    result['rows_updated'][labels['table']] = int(value)
+                elif name == 'tm_rows_deleted_total':
+                    result['rows_deleted'][labels['table']] = int(value)
+                elif name != 'tm_files_total':
+                    result[name[3:-6]] = int(value)
+            if ('tm_peak_rss_bytes', ()) in self.gauges:
+                result['peak_rss_bytes'] = int(self.gauges[('tm_peak_rss_bytes', ())])
+        return result
+
+    def render(self):
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            series = defaultdict(list)
+            for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+                series[name].append((labels, ['%s%s %s' % (name, format_labels(labels), format_value(value))]))
+            for (name, labels), values in self.histograms.items():
+                samples = []
+                cumulative = 0
+                for bucket, count in zip(BUCKETS, values):
+                    cumulative += count
+                    samples.append('%s_bucket%s %s' % (
+                        name, format_labels(labels + (('le', format_value(bucket)),)), cumulative))
+                samples.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', '+Inf'),)), values[-1]))
+                samples.append('%s_sum%s %s' % (name, format_labels(labels), format_value(values[-2])))
+                samples.append('%s_count%s %s' % (name, format_labels(labels), values[-1]))
+                series[name].append((labels, samples))
+        for name in sorted(series):
+            metric_type, description = HELP.get(name, ('untyped', name))
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, samples in sorted(series[name]):
+                lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes, None where it can not be read
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def record_peak_rss(metrics):
+    rss = peak_rss()
+    if rss is not None:
+        metrics.maximum('tm_peak_rss_bytes', rss)
+    return rss
+
+
+REGISTRY = Metrics()
+_local = threading.local()
+
+
+def current():
+    """
+    Metrics of the file processed by this thread, REGISTRY outside of a file
+    """
+    return getattr(_local, 'metrics', None) or REGISTRY
+
+
+@contextmanager
+def scope(bound=None):
+    """
+    Collects the metrics of one file in this thread, reusing the scope already open,
+    or into bound, the metrics of a file processed by another thread
+    """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        yield metrics
+        return
+    _local.metrics = bound or Metrics(parent=REGISTRY)
+    try:
+        yield _local.metrics
+    finally:
+        _local.metrics = None
+
+
+def write_textfile(filename, registry=REGISTRY):
+    """
+    Writes the metrics atomically, so the collector never reads half a file
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.write(registry.render())
+    os.replace(tmp_filename, filename)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+def start_http_server(port, host=''):
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,3 @@
+-- Per-file summary of the parser metrics, written when a file is processed
+
+ALTER TABLE trademark_fileinfo ADD COLUMN IF NOT EXISTS stats jsonb NULL;
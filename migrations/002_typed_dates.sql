@@ -0,0 +1,204 @@
+-- Dates and indicators get real types. YYYYMMDD strings that are not valid dates and
+-- indicators other than T/Y/F/N become NULL. First-use dates are often partial
+-- (19900000) and stay varchar.
+
+CREATE FUNCTION pg_temp.tm_date(value text) RETURNS date LANGUAGE plpgsql IMMUTABLE AS $$
+BEGIN
+    IF value !~ '^\s*\d{8}\s*$' THEN
+        RETURN NULL;
+    END IF;
+    RETURN to_date(trim(value), 'YYYYMMDD');
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END $$;
+
+CREATE FUNCTION pg_temp.tm_indicator(value text) RETURNS bool LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE upper(trim(value)) WHEN 'T' THEN true WHEN 'Y' THEN true WHEN 'F' THEN false WHEN 'N' THEN false END
+$$;
+
+ALTER TABLE trademark_app_case_files
+	ALTER COLUMN transaction_date DROP DEFAULT,
+	ALTER COLUMN transaction_date TYPE date USING pg_temp.tm_date(transaction_date);
+
+ALTER TABLE trademark_app_case_file_event_statements
+	ALTER COLUMN "date" DROP DEFAULT,
+	ALTER COLUMN "date" TYPE date USING pg_temp.tm_date("date");
+
+ALTER TABLE trademark_app_case_file_headers
+	ALTER COLUMN filing_date DROP DEFAULT,
+	ALTER COLUMN filing_date TYPE date USING pg_temp.tm_date(filing_date),
+	ALTER COLUMN status_date DROP DEFAULT,
+	ALTER COLUMN status_date TYPE date USING pg_temp.tm_date(status_date),
+	ALTER COLUMN principal_register_amended_in DROP DEFAULT,
+	ALTER COLUMN principal_register_amended_in TYPE bool USING pg_temp.tm_indicator(principal_register_amended_in),
+	ALTER COLUMN supplemental_register_amended_in DROP DEFAULT,
+	ALTER COLUMN supplemental_register_amended_in TYPE bool USING pg_temp.tm_indicator(supplemental_register_amended_in),
+	ALTER COLUMN trademark_in DROP DEFAULT,
+	ALTER COLUMN trademark_in TYPE bool USING pg_temp.tm_indicator(trademark_in),
+	ALTER COLUMN collective_trademark_in DROP DEFAULT,
+	ALTER COLUMN collective_trademark_in TYPE bool USING pg_temp.tm_indicator(collective_trademark_in),
+	ALTER COLUMN service_mark_in DROP DEFAULT,
+	ALTER COLUMN service_mark_in TYPE bool USING pg_temp.tm_indicator(service_mark_in),
+	ALTER COLUMN collective_service_mark_in DROP DEFAULT,
+	ALTER COLUMN collective_service_mark_in TYPE bool USING pg_temp.tm_indicator(collective_service_mark_in),
+	ALTER COLUMN collective_membership_mark_in DROP DEFAULT,
+	ALTER COLUMN collective_membership_mark_in TYPE bool USING pg_temp.tm_indicator(collective_membership_mark_in),
+	ALTER COLUMN certification_mark_in DROP DEFAULT,
+	ALTER COLUMN certification_mark_in TYPE bool USING pg_temp.tm_indicator(certification_mark_in),
+	ALTER COLUMN cancellation_pending_in DROP DEFAULT,
+	ALTER COLUMN cancellation_pending_in TYPE bool USING pg_temp.tm_indicator(cancellation_pending_in),
+	ALTER COLUMN published_concurrent_in DROP DEFAULT,
+	ALTER COLUMN published_concurrent_in TYPE bool USING pg_temp.tm_indicator(published_concurrent_in),
+	ALTER COLUMN concurrent_use_in DROP DEFAULT,
+	ALTER COLUMN concurrent_use_in TYPE bool USING pg_temp.tm_indicator(concurrent_use_in),
+	ALTER COLUMN concurrent_use_proceeding_in DROP DEFAULT,
+	ALTER COLUMN concurrent_use_proceeding_in TYPE bool USING pg_temp.tm_indicator(concurrent_use_proceeding_in),
+	ALTER COLUMN interference_pending_in DROP DEFAULT,
+	ALTER COLUMN interference_pending_in TYPE bool USING pg_temp.tm_indicator(interference_pending_in),
+	ALTER COLUMN opposition_pending_in DROP DEFAULT,
+	ALTER COLUMN opposition_pending_in TYPE bool USING pg_temp.tm_indicator(opposition_pending_in),
+	ALTER COLUMN section_12c_in DROP DEFAULT,
+	ALTER COLUMN section_12c_in TYPE bool USING pg_temp.tm_indicator(section_12c_in),
+	ALTER COLUMN section_2f_in DROP DEFAULT,
+	ALTER COLUMN section_2f_in TYPE bool USING pg_temp.tm_indicator(section_2f_in),
+	ALTER COLUMN section_2f_in_part_in DROP DEFAULT,
+	ALTER COLUMN section_2f_in_part_in TYPE bool USING pg_temp.tm_indicator(section_2f_in_part_in),
+	ALTER COLUMN renewal_filed_in DROP DEFAULT,
+	ALTER COLUMN renewal_filed_in TYPE bool USING pg_temp.tm_indicator(renewal_filed_in),
+	ALTER COLUMN section_8_filed_in DROP DEFAULT,
+	ALTER COLUMN section_8_filed_in TYPE bool USING pg_temp.tm_indicator(section_8_filed_in),
+	ALTER COLUMN section_8_partial_accept_in DROP DEFAULT,
+	ALTER COLUMN section_8_partial_accept_in TYPE bool USING pg_temp.tm_indicator(section_8_partial_accept_in),
+	ALTER COLUMN section_8_accepted_in DROP DEFAULT,
+	ALTER COLUMN section_8_accepted_in TYPE bool USING pg_temp.tm_indicator(section_8_accepted_in),
+	ALTER COLUMN section_15_acknowledged_in DROP DEFAULT,
+	ALTER COLUMN section_15_acknowledged_in TYPE bool USING pg_temp.tm_indicator(section_15_acknowledged_in),
+	ALTER COLUMN section_15_filed_in DROP DEFAULT,
+	ALTER COLUMN section_15_filed_in TYPE bool USING pg_temp.tm_indicator(section_15_filed_in),
+	ALTER COLUMN supplemental_register_in DROP DEFAULT,
+	ALTER COLUMN supplemental_register_in TYPE bool USING pg_temp.tm_indicator(supplemental_register_in),
+	ALTER COLUMN foreign_priority_in DROP DEFAULT,
+	ALTER COLUMN foreign_priority_in TYPE bool USING pg_temp.tm_indicator(foreign_priority_in),
+	ALTER COLUMN change_registration_in DROP DEFAULT,
+	ALTER COLUMN change_registration_in TYPE bool USING pg_temp.tm_indicator(change_registration_in),
+	ALTER COLUMN intent_to_use_in DROP DEFAULT,
+	ALTER COLUMN intent_to_use_in TYPE bool USING pg_temp.tm_indicator(intent_to_use_in),
+	ALTER COLUMN intent_to_use_current_in DROP DEFAULT,
+	ALTER COLUMN intent_to_use_current_in TYPE bool USING pg_temp.tm_indicator(intent_to_use_current_in),
+	ALTER COLUMN filed_as_use_application_in DROP DEFAULT,
+	ALTER COLUMN filed_as_use_application_in TYPE bool USING pg_temp.tm_indicator(filed_as_use_application_in),
+	ALTER COLUMN amended_to_use_application_in DROP DEFAULT,
+	ALTER COLUMN amended_to_use_application_in TYPE bool USING pg_temp.tm_indicator(amended_to_use_application_in),
+	ALTER COLUMN use_application_currently_in DROP DEFAULT,
+	ALTER COLUMN use_application_currently_in TYPE bool USING pg_temp.tm_indicator(use_application_currently_in),
+	ALTER COLUMN amended_to_itu_application_in DROP DEFAULT,
+	ALTER COLUMN amended_to_itu_application_in TYPE bool USING pg_temp.tm_indicator(amended_to_itu_application_in),
+	ALTER COLUMN filing_basis_filed_as_44d_in DROP DEFAULT,
+	ALTER COLUMN filing_basis_filed_as_44d_in TYPE bool USING pg_temp.tm_indicator(filing_basis_filed_as_44d_in),
+	ALTER COLUMN amended_to_44d_application_in DROP DEFAULT,
+	ALTER COLUMN amended_to_44d_application_in TYPE bool USING pg_temp.tm_indicator(amended_to_44d_application_in),
+	ALTER COLUMN filing_basis_current_44d_in DROP DEFAULT,
+	ALTER COLUMN filing_basis_current_44d_in TYPE bool USING pg_temp.tm_indicator(filing_basis_current_44d_in),
+	ALTER COLUMN filing_basis_filed_as_44e_in DROP DEFAULT,
+	ALTER COLUMN filing_basis_filed_as_44e_in TYPE bool USING pg_temp.tm_indicator(filing_basis_filed_as_44e_in),
+	ALTER COLUMN filing_basis_current_44e_in DROP DEFAULT,
+	ALTER COLUMN filing_basis_current_44e_in TYPE bool USING pg_temp.tm_indicator(filing_basis_current_44e_in),
+	ALTER COLUMN amended_to_44e_application_in DROP DEFAULT,
+	ALTER COLUMN amended_to_44e_application_in TYPE bool USING pg_temp.tm_indicator(amended_to_44e_application_in),
+	ALTER COLUMN without_basis_currently_in DROP DEFAULT,
+	ALTER COLUMN without_basis_currently_in TYPE bool USING pg_temp.tm_indicator(without_basis_currently_in),
+	ALTER COLUMN filing_current_no_basis_in DROP DEFAULT,
+	ALTER COLUMN filing_current_no_basis_in TYPE bool USING pg_temp.tm_indicator(filing_current_no_basis_in),
+	ALTER COLUMN color_drawing_filed_in DROP DEFAULT,
+	ALTER COLUMN color_drawing_filed_in TYPE bool USING pg_temp.tm_indicator(color_drawing_filed_in),
+	ALTER COLUMN color_drawing_current_in DROP DEFAULT,
+	ALTER COLUMN color_drawing_current_in TYPE bool USING pg_temp.tm_indicator(color_drawing_current_in),
+	ALTER COLUMN drawing_3d_filed_in DROP DEFAULT,
+	ALTER COLUMN drawing_3d_filed_in TYPE bool USING pg_temp.tm_indicator(drawing_3d_filed_in),
+	ALTER COLUMN drawing_3d_current_in DROP DEFAULT,
+	ALTER COLUMN drawing_3d_current_in TYPE bool USING pg_temp.tm_indicator(drawing_3d_current_in),
+	ALTER COLUMN standard_characters_claimed_in DROP DEFAULT,
+	ALTER COLUMN standard_characters_claimed_in TYPE bool USING pg_temp.tm_indicator(standard_characters_claimed_in),
+	ALTER COLUMN filing_basis_filed_as_66a_in DROP DEFAULT,
+	ALTER COLUMN filing_basis_filed_as_66a_in TYPE bool USING pg_temp.tm_indicator(filing_basis_filed_as_66a_in),
+	ALTER COLUMN filing_basis_current_66a_in DROP DEFAULT,
+	ALTER COLUMN filing_basis_current_66a_in TYPE bool USING pg_temp.tm_indicator(filing_basis_current_66a_in),
+	ALTER COLUMN location_date DROP DEFAULT,
+	ALTER COLUMN location_date TYPE date USING pg_temp.tm_date(location_date),
+	ALTER COLUMN registration_date DROP DEFAULT,
+	ALTER COLUMN registration_date TYPE date USING pg_temp.tm_date(registration_date),
+	ALTER COLUMN published_for_opposition_date DROP DEFAULT,
+	ALTER COLUMN published_for_opposition_date TYPE date USING pg_temp.tm_date(published_for_opposition_date),
+	ALTER COLUMN amend_to_register_date DROP DEFAULT,
+	ALTER COLUMN amend_to_register_date TYPE date USING pg_temp.tm_date(amend_to_register_date),
+	ALTER COLUMN abandonment_date DROP DEFAULT,
+	ALTER COLUMN abandonment_date TYPE date USING pg_temp.tm_date(abandonment_date),
+	ALTER COLUMN cancellation_date DROP DEFAULT,
+	ALTER COLUMN cancellation_date TYPE date USING pg_temp.tm_date(cancellation_date),
+	ALTER COLUMN republished_12c_date DROP DEFAULT,
+	ALTER COLUMN republished_12c_date TYPE date USING pg_temp.tm_date(republished_12c_date),
+	ALTER COLUMN renewal_date DROP DEFAULT,
+	ALTER COLUMN renewal_date TYPE date USING pg_temp.tm_date(renewal_date);
+
+ALTER TABLE trademark_app_classifications
+	ALTER COLUMN status_date DROP DEFAULT,
+	ALTER COLUMN status_date TYPE date USING pg_temp.tm_date(status_date);
+
+ALTER TABLE trademark_app_foreign_applications
+	ALTER COLUMN filing_date DROP DEFAULT,
+	ALTER COLUMN filing_date TYPE date USING pg_temp.tm_date(filing_date),
+	ALTER COLUMN registration_date DROP DEFAULT,
+	ALTER COLUMN registration_date TYPE date USING pg_temp.tm_date(registration_date),
+	ALTER COLUMN registration_expiration_date DROP DEFAULT,
+	ALTER COLUMN registration_expiration_date TYPE date USING pg_temp.tm_date(registration_expiration_date),
+	ALTER COLUMN registration_renewal_date DROP DEFAULT,
+	ALTER COLUMN registration_renewal_date TYPE date USING pg_temp.tm_date(registration_renewal_date),
+	ALTER COLUMN registration_renewal_expiration_date DROP DEFAULT,
+	ALTER COLUMN registration_renewal_expiration_date TYPE date USING pg_temp.tm_date(registration_renewal_expiration_date),
+	ALTER COLUMN foreign_priority_claim_in DROP DEFAULT,
+	ALTER COLUMN foreign_priority_claim_in TYPE bool USING pg_temp.tm_indicator(foreign_priority_claim_in);
+
+ALTER TABLE trademark_app_international_registration
+	ALTER COLUMN international_registration_date DROP DEFAULT,
+	ALTER COLUMN international_registration_date TYPE date USING pg_temp.tm_date(international_registration_date),
+	ALTER COLUMN international_publication_date DROP DEFAULT,
+	ALTER COLUMN international_publication_date TYPE date USING pg_temp.tm_date(international_publication_date),
+	ALTER COLUMN international_renewal_date DROP DEFAULT,
+	ALTER COLUMN international_renewal_date TYPE date USING pg_temp.tm_date(international_renewal_date),
+	ALTER COLUMN auto_protection_date DROP DEFAULT,
+	ALTER COLUMN auto_protection_date TYPE date USING pg_temp.tm_date(auto_protection_date),
+	ALTER COLUMN international_death_date DROP DEFAULT,
+	ALTER COLUMN international_death_date TYPE date USING pg_temp.tm_date(international_death_date),
+	ALTER COLUMN international_status_date DROP DEFAULT,
+	ALTER COLUMN international_status_date TYPE date USING pg_temp.tm_date(international_status_date),
+	ALTER COLUMN priority_claimed_in DROP DEFAULT,
+	ALTER COLUMN priority_claimed_in TYPE bool USING pg_temp.tm_indicator(priority_claimed_in),
+	ALTER COLUMN priority_claimed_date DROP DEFAULT,
+	ALTER COLUMN priority_claimed_date TYPE date USING pg_temp.tm_date(priority_claimed_date),
+	ALTER COLUMN first_refusal_in DROP DEFAULT,
+	ALTER COLUMN first_refusal_in TYPE bool USING pg_temp.tm_indicator(first_refusal_in);
+
+ALTER TABLE trademark_app_madrid_history_events
+	ALTER COLUMN "date" DROP DEFAULT,
+	ALTER COLUMN "date" TYPE date USING pg_temp.tm_date("date");
+
+ALTER TABLE trademark_app_madrid_international_filing_record
+	ALTER COLUMN original_filing_date_uspto DROP DEFAULT,
+	ALTER COLUMN original_filing_date_uspto TYPE date USING pg_temp.tm_date(original_filing_date_uspto),
+	ALTER COLUMN international_registration_date DROP DEFAULT,
+	ALTER COLUMN international_registration_date TYPE date USING pg_temp.tm_date(international_registration_date),
+	ALTER COLUMN international_status_date DROP DEFAULT,
+	ALTER COLUMN international_status_date TYPE date USING pg_temp.tm_date(international_status_date),
+	ALTER COLUMN irregularity_reply_by_date DROP DEFAULT,
+	ALTER COLUMN irregularity_reply_by_date TYPE date USING pg_temp.tm_date(irregularity_reply_by_date),
+	ALTER COLUMN international_renewal_date DROP DEFAULT,
+	ALTER COLUMN international_renewal_date TYPE date USING pg_temp.tm_date(international_renewal_date);
+
+ALTER TABLE trademark_app_prior_registration_applications
+	ALTER COLUMN other_related_in DROP DEFAULT,
+	ALTER COLUMN other_related_in TYPE bool USING pg_temp.tm_indicator(other_related_in);
+
+-- Rows are loaded in file order, so dates follow the physical order closely enough for BRIN
+CREATE INDEX ON trademark_app_case_files USING brin (transaction_date);
+CREATE INDEX ON trademark_app_case_file_event_statements USING brin ("date");
+CREATE INDEX ON trademark_app_madrid_history_events USING brin ("date");
@@ -0,0 +1,4 @@
+-- Last committed case-file of a file being parsed, for resuming after a crash
+
+ALTER TABLE trademark_fileinfo ADD COLUMN IF NOT EXISTS checkpoint_case int8 NULL;
+ALTER TABLE trademark_fileinfo ADD COLUMN IF NOT EXISTS checkpoint_serial int8 NULL;
@@ -0,0 +1,5 @@
+-- Content hash of each case-file and the hash of each of its table groups,
+-- rows loaded before have none and are rewritten in full once
+
+ALTER TABLE trademark_app_case_files ADD COLUMN IF NOT EXISTS content_hash varchar(32) NULL;
+ALTER TABLE trademark_app_case_files ADD COLUMN IF NOT EXISTS table_hashes jsonb NULL;
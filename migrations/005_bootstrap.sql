@@ -0,0 +1,13 @@
+-- The UNIQUE constraint on serial_number already indexes it
+DROP INDEX IF EXISTS trademark_app_case_files_serial_number_idx;
+
+-- Secondary indexes and foreign keys dropped by --bootstrap, recreated when it finishes
+
+CREATE TABLE IF NOT EXISTS trademark_bootstrap (
+	name varchar(128) NOT NULL,
+	table_name varchar(128) NOT NULL,
+	kind varchar(15) NOT NULL,
+	definition text NOT NULL,
+	created timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT trademark_bootstrap_pkey PRIMARY KEY (name)
+);
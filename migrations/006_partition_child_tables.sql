@@ -0,0 +1,37 @@
+-- Partitions the largest child tables by serial_number range, one partition per serial
+-- number series (<table>_s<series>) and <table>_default for any other serial.
+-- Copies every row of the three tables, run it while no parser is loading.
+
+DO $$
+DECLARE
+	t text;
+	s int;
+	seq text;
+BEGIN
+	FOREACH t IN ARRAY ARRAY['trademark_app_case_file_event_statements', 'trademark_app_case_file_owners',
+	                         'trademark_app_classifications'] LOOP
+		CONTINUE WHEN (SELECT relkind FROM pg_class WHERE oid = t::regclass) = 'p';
+		seq := pg_get_serial_sequence(t, 'id');
+		EXECUTE format('ALTER TABLE %I RENAME TO %I', t, t || '_unpartitioned');
+		EXECUTE format('ALTER TABLE %I RENAME CONSTRAINT %I TO %I', t || '_unpartitioned', t || '_pkey',
+		               t || '_unpartitioned_pkey');
+		EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS) PARTITION BY RANGE (serial_number)',
+		               t, t || '_unpartitioned');
+		EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', seq, t);
+		FOR s IN 70..99 LOOP
+			EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%s) TO (%s)',
+			               t || '_s' || s, t, s * 1000000, (s + 1) * 1000000);
+		END LOOP;
+		EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', t || '_default', t);
+		EXECUTE format('INSERT INTO %I SELECT * FROM %I', t, t || '_unpartitioned');
+		EXECUTE format('DROP TABLE %I', t || '_unpartitioned');
+		EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I PRIMARY KEY (id, serial_number)', t, t || '_pkey');
+		EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I FOREIGN KEY (serial_number) '
+		               'REFERENCES trademark_app_case_files(serial_number) ON DELETE CASCADE',
+		               t, t || '_serial_number_fkey');
+		EXECUTE format('CREATE INDEX ON %I USING btree (serial_number)', t);
+	END LOOP;
+END $$;
+
+CREATE INDEX IF NOT EXISTS trademark_app_case_file_event_statements_date_idx
+	ON trademark_app_case_file_event_statements USING brin ("date");
@@ -0,0 +1,31 @@
+-- Names and addresses stored once for --parties, the case-file rows reference them by hash
+
+CREATE TABLE IF NOT EXISTS trademark_parties (
+	party_hash uuid NOT NULL,
+	"name" text NULL,
+	address_1 varchar(1024) NULL,
+	address_2 varchar(1024) NULL,
+	address_3 varchar(1024) NULL,
+	address_4 varchar(1024) NULL,
+	address_5 varchar(1024) NULL,
+	city varchar(50) NULL,
+	state varchar(50) NULL,
+	country varchar(5) NULL,
+	postcode varchar(20) NULL,
+	created timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT trademark_parties_pkey PRIMARY KEY (party_hash)
+);
+
+ALTER TABLE trademark_app_case_file_headers ADD COLUMN IF NOT EXISTS attorney_party_hash uuid NULL;
+ALTER TABLE trademark_app_case_file_headers ADD COLUMN IF NOT EXISTS domestic_representative_party_hash uuid NULL;
+ALTER TABLE trademark_app_case_file_owners ADD COLUMN IF NOT EXISTS party_hash uuid NULL;
+ALTER TABLE trademark_app_correspondents ADD COLUMN IF NOT EXISTS party_hash uuid NULL;
+
+CREATE INDEX IF NOT EXISTS trademark_app_case_file_headers_attorney_party_hash_idx
+	ON trademark_app_case_file_headers USING btree (attorney_party_hash);
+CREATE INDEX IF NOT EXISTS trademark_app_case_file_heade_domestic_representative_party_idx
+	ON trademark_app_case_file_headers USING btree (domestic_representative_party_hash);
+CREATE INDEX IF NOT EXISTS trademark_app_case_file_owners_party_hash_idx
+	ON trademark_app_case_file_owners USING btree (party_hash);
+CREATE INDEX IF NOT EXISTS trademark_app_correspondents_party_hash_idx
+	ON trademark_app_correspondents USING btree (party_hash);
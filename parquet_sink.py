@@ -0,0 +1,211 @@
+"""
+Writes the parsed tables to Parquet instead of PostgreSQL, for analytics that read the
+whole archive column by column.
+
+Every trademark_app_* table is a dataset partitioned by source file:
+
+    <directory>/<table>/source_file=<xml filename>/part.parquet
+
+A partition holds the rows the database path writes for the file loaded alone: the last
+version of every serial number in the file, with the same columns and types. Ids are made
+unique across files as file_id * 2**32 + the position of the row in the file, the child
+rows reference them like in the database. Readers that want the current state of the
+archive keep the row of each serial_number with the latest transaction_date.
+
+The export of a file is tracked by its partitions alone, trademark_fileinfo keeps the status
+of the database load. The case_files partition is published last, so a file is exported once
+it exists. The export still registers every file in trademark_fileinfo, the id it gets there
+is the file_id of the ids above; the serial index and the case-file tables are not read.
+
+pyarrow is optional, it is only needed with --parquet.
+"""
+import logging
+import os
+import time
+from array import array
+from collections import OrderedDict
+
+from loader import BATCH_SIZE, PARENT_KEYS, PARENT_TABLES, TABLES, convert_columns, is_date_column, \
+    is_indicator_column
+import metrics
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ROW_GROUP_SIZE = 128 * 1024
+INT_COLUMNS = ('id', 'serial_number', 'file_id') + tuple(key for key, parent in PARENT_KEYS.values())
+
+
+def partition_filename(directory, table, source_file):
+    return os.path.join(directory, table, 'source_file=%s' % source_file, 'part.parquet')
+
+
+def exported(directory, source_file):
+    """
+    True when all partitions of source_file are published under directory
+    """
+    return os.path.isfile(partition_filename(directory, 'trademark_app_case_files', source_file))
+
+
+def column_type(column):
+    if column in INT_COLUMNS:
+        return pyarrow.int64()
+    if is_date_column(column):
+        return pyarrow.date32()
+    if is_indicator_column(column):
+        return pyarrow.bool_()
+    return pyarrow.string()
+
+
+class TableWriter(object):
+    """
+    Column buffers of one table, written as row groups of row_group_size rows
+    """
+
+    def __init__(self, table, filename, row_group_size=ROW_GROUP_SIZE):
+        self.table = table
+        self.filename = filename
+        self.row_group_size = row_group_size
+        self.schema = None
+        self.columns = None
+        self.writer = None
+        self.rows = 0
+        self.buffered = 0
+
+    def append(self, rows):
+        if self.schema is None:
+            self.schema = pyarrow.schema([(column, column_type(column)) for column in rows[0].keys()])
+            self.columns = OrderedDict((column, []) for column in self.schema.names)
+        for column, values in self.columns.items():
+            values.extend(row[column] for row in rows)
+        self.rows += len(rows)
+        self.buffered += len(rows)
+        if self.buffered >= self.row_group_size:
+            self.write()
+
+    def write(self):
+        if self.buffered == 0:
+            return
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename + '.tmp', self.schema)
+        with metrics.current().timer('write', table=self.table):
+            table = pyarrow.Table.from_pydict(self.columns, schema=self.schema)
+            self.writer.write_table(table, row_group_size=self.row_group_size)
+        for values in self.columns.values():
+            del values[:]
+        self.buffered = 0
+
+    def close(self, drop=None):
+        """
+        Writes the last row group and publishes the file, without the rows whose
+        positions are in drop
+        """
+        self.write()
+        if self.writer is None:
+            return 0
+        self.writer.close()
+        if drop:
+            table = pyarrow.parquet.read_table(self.filename + '.tmp')
+            keep = [True] * table.num_rows
+            for start, end in drop:
+                keep[start:end] = [False] * (end - start)
+            table = table.filter(pyarrow.array(keep))
+            pyarrow.parquet.write_table(table, self.filename + '.tmp', row_group_size=self.row_group_size)
+        os.replace(self.filename + '.tmp', self.filename)
+        return self.rows - sum(end - start for start, end in drop or ())
+
+
+class ParquetLoader(object):
+    """
+    Loader writing the case-files of one source file to its partition of every table
+    dataset. Case-files are only compared with earlier ones of the same file.
+    """
+
+    def __init__(self, directory, source_file, file_id=None, batch_size=BATCH_SIZE, row_group_size=ROW_GROUP_SIZE):
+        if pyarrow is None:
+            raise ImportError('The Parquet sink needs pyarrow')
+        self.logger = logging.getLogger(__name__)
+        self.batch_size = batch_size
+        self.file_id = file_id
+        self.id_base = (file_id or 0) << 32
+        self.writers = OrderedDict(
+            (table, TableWriter(table, partition_filename(directory, table, source_file), row_group_size))
+            for table in TABLES)
+        self.pending = OrderedDict()
+        # serial_number: (number of the written case, transaction date)
+        self.seen = {}
+        # first row of every written case in every table
+        self.starts = dict((table, array('q')) for table in TABLES)
+        self.superseded = []
+        self.cases_written = 0
+
+    def lookup(self, serial_numbers):
+        return dict((s, {'transaction_date': self.seen[s][1], 'status': False})
+                    for s in serial_numbers if s in self.seen)
+
+    def pending_case(self, serial_number):
+        case = self.pending.get(serial_number)
+        if case is None:
+            return None
+        return case['trademark_app_case_files'][0]
+
+    def advance(self, case, serial_number):
+        pass
+
+    def add(self, serial_number, rows, replace=False):
+        if self.pending.pop(serial_number, None) is None and serial_number in self.seen:
+            # replaces a case-file already in the column buffers
+            self.superseded.append(self.seen.pop(serial_number)[0])
+        self.pending[serial_number] = rows
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return 0
+        cases = list(self.pending.items())
+        self.pending = OrderedDict()
+        tables = OrderedDict((table, []) for table in TABLES)
+        parent_positions = {}
+        for serial_number, rows in cases:
+            self.seen[serial_number] = (len(self.starts['trademark_app_case_files']),
+                                        rows['trademark_app_case_files'][0]['transaction_date'])
+            for table in TABLES:
+                self.starts[table].append(self.writers[table].rows + len(tables[table]))
+            offsets = dict((parent, self.writers[parent].rows + len(tables[parent])) for parent in PARENT_TABLES)
+            for table, table_rows in rows.items():
+                if table in PARENT_KEYS:
+                    key, parent = PARENT_KEYS[table]
+                    for row in table_rows:
+                        parent_positions[id(row)] = offsets[parent] + row[key]
+                tables[table].extend(table_rows)
+        convert_columns(tables)
+        for parent in PARENT_TABLES:
+            first = self.writers[parent].rows
+            tables[parent] = [dict(row, id=self.id_base + first + i) for i, row in enumerate(tables[parent])]
+        for table, (key, parent) in PARENT_KEYS.items():
+            tables[table] = [dict(row, **{key: self.id_base + parent_positions[id(row)]}) for row in tables[table]]
+        for table, rows in tables.items():
+            if len(rows) > 0:
+                self.writers[table].append(rows)
+        self.cases_written += len(cases)
+        return len(cases)
+
+    def close(self):
+        self.flush()
+        start_time = time.time()
+        file_metrics = metrics.current()
+        # the case_files partition marks the file as exported, it goes last
+        for table, writer in reversed(self.writers.items()):
+            starts = self.starts[table]
+            drop = [(starts[case], starts[case + 1] if case + 1 < len(starts) else writer.rows)
+                    for case in self.superseded]
+            rowcount = writer.close([span for span in drop if span[0] < span[1]])
+            file_metrics.inc('tm_rows_written_total', rowcount, table=table)
+        self.logger.info('Wrote %s cases to Parquet [%6.3f sec]', self.cases_written - len(self.superseded),
+                         time.time() - start_time)
+        return self.cases_written - len(self.superseded)
@@ -0,0 +1,148 @@
+"""
+Owners, attorneys, domestic representatives and correspondents stored once in trademark_parties.
+
+A party is keyed by the hash of its normalized name and address. With --parties the rows of
+the case-file tables keep only that hash instead of the name and address columns, and the
+loaders insert the parties a bounded LRU cache of the process has not seen yet.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+
+CACHE_SIZE = 200000
+
+PARTY_COLUMNS = ('name', 'address_1', 'address_2', 'address_3', 'address_4', 'address_5', 'city', 'state',
+                 'country', 'postcode')
+
+OWNER_FIELDS = {'name': 'party_name', 'address_1': 'address_1', 'address_2': 'address_2', 'city': 'city',
+                'state': 'state', 'country': 'country', 'postcode': 'postcode'}
+CORRESPONDENT_FIELDS = dict((column, column) for column in PARTY_COLUMNS if column.startswith('address_'))
+
+# table: (hash column, {party column: row column}) for each party of a row
+PARTY_FIELDS = {
+    'trademark_app_case_file_headers': (('attorney_party_hash', {'name': 'attorney_name'}),
+                                        ('domestic_representative_party_hash',
+                                         {'name': 'domestic_representative_name'})),
+    'trademark_app_correspondents': (('party_hash', CORRESPONDENT_FIELDS),),
+    'trademark_app_case_file_owners': (('party_hash', OWNER_FIELDS),),
+}
+
+
+def normalize(value):
+    """
+    Upper case with the whitespace collapsed, '' for None
+    """
+    if value is None:
+        return ''
+    return ' '.join(value.split()).upper()
+
+
+def party_hash(party):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update('\x1f'.join(normalize(party.get(column)) for column in PARTY_COLUMNS).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class LRUCache(object):
+    """
+    Thread-safe set of at most size keys, dropping the least recently used
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.keys = OrderedDict()
+
+    def missing(self, keys):
+        """
+        The keys not in the cache, those in it become the most recently used
+        """
+        result = []
+        with self.lock:
+            for key in keys:
+                if key in self.keys:
+                    self.keys.move_to_end(key)
+                else:
+                    result.append(key)
+        return result
+
+    def add(self, keys):
+        with self.lock:
+            for key in keys:
+                self.keys[key] = True
+                self.keys.move_to_end(key)
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def party_cache(size=CACHE_SIZE):
+    """
+    Cache shared by the loaders of this process
+    """
+    with _caches_lock:
+        cache = _caches.get(size)
+        if cache is None:
+            cache = _caches[size] = LRUCache(size)
+        return cache
+
+
+def extract_parties(rows):
+    """
+    Replaces the name and address columns of the rows of a case-file by party hashes.
+    Returns {party_hash: party} of the parties the rows reference.
+    """
+    parties = {}
+    for table, fields in PARTY_FIELDS.items():
+        for row in rows.get(table, ()):
+            values = [(hash_column, dict((column, row.pop(row_column)) for column, row_column in columns.items()))
+                      for hash_column, columns in fields]
+            for hash_column, party in values:
+                if all(value is None for value in party.values()):
+                    row[hash_column] = None
+                    continue
+                key = row[hash_column] = party_hash(party)
+                parties[key] = party
+    return parties
+
+
+class PartyResolver(object):
+    """
+    Resolves the parties of the case-files a loader writes through the cache, inserting only the
+    unseen ones in the transaction of the batch. Parties enter the cache once that is committed.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def resolve(self, dbc, cases):
+        parties = {}
+        for serial_number, case in cases:
+            if case.get('parties') is None:
+                # kept on the case, whose rows lose their party columns, for a retry of the batch
+                case['parties'] = extract_parties(case['rows'])
+            parties.update(case['parties'])
+        missing = self.cache.missing(parties)
+        file_metrics = metrics.current()
+        file_metrics.inc('tm_party_cache_hits_total', len(parties) - len(missing))
+        file_metrics.inc('tm_party_cache_misses_total', len(missing))
+        values = []
+        for key in missing:
+            party = dict.fromkeys(PARTY_COLUMNS)
+            party.update(parties[key])
+            party['party_hash'] = key
+            values.append(party)
+        return dbc.parties_insert(values, PARTY_COLUMNS)
+
+    def committed(self, cases):
+        for serial_number, case in cases:
+            if case.get('parties'):
+                self.cache.add(case['parties'])
@@ -0,0 +1,144 @@
+"""
+Parses and loads a file in separate threads.
+
+The parsing thread cuts the case-files into batches and puts them on a bounded queue,
+loader threads with their own connections write them. When the loaders fall behind
+the queue fills up and the parser waits, when the parser falls behind the loaders wait.
+Both waits are recorded as stages, the depth of the queue as the tm_queue_depth gauge.
+"""
+import logging
+import queue
+import threading
+from collections import OrderedDict
+
+from db_pgsql import Db
+from loader import BATCH_SECONDS, BATCH_SIZE, CopyLoader
+import metrics
+
+QUEUE_SIZE = 4
+
+
+class PipelineLoader(CopyLoader):
+    """
+    CopyLoader handing its batches to loader threads. The checkpoint of the file moves
+    only over batches written together with all batches before them.
+    """
+
+    def __init__(self, dbc, batch_size=BATCH_SIZE, file_id=None, index=None, force=False, cascade=True,
+                 batch_seconds=BATCH_SECONDS, parties=None, loaders=2, queue_size=QUEUE_SIZE):
+        super(PipelineLoader, self).__init__(dbc, batch_size=batch_size, file_id=file_id, index=index, force=force,
+                                             cascade=cascade, batch_seconds=batch_seconds, parties=parties)
+        self.loaders = loaders
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.metrics = metrics.current()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.batches = 0
+        # batch number: position of the file after the batch
+        self.positions = {}
+        self.written = set()
+        self.next_written = 0
+        self.error = None
+
+    def start(self):
+        for i in range(self.loaders):
+            thread = threading.Thread(target=self.work, name='loader-%s' % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return 0
+        if len(self.threads) == 0:
+            self.start()
+        cases = self.pending
+        self.pending = OrderedDict()
+        batch = self.next_batch()
+        with self.metrics.timer('backpressure'):
+            while True:
+                if self.error is not None:
+                    raise self.error
+                try:
+                    self.queue.put((batch, cases), timeout=1)
+                    break
+                except queue.Full:
+                    pass
+        self.metrics.add('tm_queue_depth', 1)
+        return len(cases)
+
+    def next_batch(self):
+        with self.lock:
+            batch = self.batches
+            self.batches += 1
+            self.positions[batch] = self.position
+            if self.position is not None:
+                self.checkpointed = self.position[0]
+        return batch
+
+    def checkpoint(self):
+        # a run of skipped case-files, done as soon as the batches before it are
+        self.done(self.next_batch(), self.dbc)
+
+    def done(self, batch, dbc):
+        """
+        Marks batch as written and moves the checkpoint over the batches written in order
+        """
+        with self.lock:
+            self.written.add(batch)
+            position = None
+            while self.next_written in self.written:
+                self.written.remove(self.next_written)
+                position = self.positions.pop(self.next_written) or position
+                self.next_written += 1
+            if self.file_id is not None and position is not None:
+                dbc.file_checkpoint(self.file_id, *position)
+                dbc.cnx.commit()
+
+    def work(self):
+        dbc = Db()
+        loader = CopyLoader(dbc, batch_size=self.batch_size, index=self.index, force=self.force,
+                            cascade=self.cascade, batch_seconds=self.batch_seconds, parties=self.parties)
+        try:
+            with metrics.scope(self.metrics):
+                while True:
+                    with self.metrics.timer('starved'):
+                        item = self.queue.get()
+                    if item is None:
+                        break
+                    self.metrics.add('tm_queue_depth', -1)
+                    if self.error is not None:
+                        continue
+                    batch, cases = item
+                    try:
+                        loader.pending = cases
+                        # waits for the serials other workers hold
+                        loader.close()
+                        self.done(batch, dbc)
+                    except BaseException as err:
+                        logging.getLogger(__name__).exception('Loader thread failed')
+                        self.error = err
+        finally:
+            with self.lock:
+                self.cases_written += loader.cases_written
+            dbc.close()
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+        return self.cases_written
+
+    def abort(self):
+        self.pending = OrderedDict()
+        self.error = self.error or RuntimeError('Parsing aborted')
+        self.stop()
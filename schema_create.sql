@@ -4,16 +4,18 @@ CREATE TABLE trademark_app_case_files (
 	id bigserial NOT NULL,
 	serial_number int8 NOT NULL,
 	registration_number varchar(30) NULL DEFAULT NULL::character varying,
-	transaction_date varchar(30) NULL DEFAULT NULL::character varying,
+	transaction_date date NULL,
 	created timestamptz NOT NULL DEFAULT now(),
 	modified timestamptz NOT NULL DEFAULT now(),
 	status bool NOT NULL DEFAULT false,
 	file_id int4 NULL,
+	content_hash varchar(32) NULL,
+	table_hashes jsonb NULL,
 	CONSTRAINT id PRIMARY KEY (id),
 	CONSTRAINT serial_number UNIQUE (serial_number)
 );
 CREATE INDEX ON trademark_app_case_files USING btree (file_id);
-CREATE INDEX ON trademark_app_case_files USING btree (serial_number);
+CREATE INDEX ON trademark_app_case_files USING brin (transaction_date);
 
 
 -- trademark_fileinfo definition
@@ -27,12 +29,48 @@ CREATE TABLE trademark_fileinfo (
 	url varchar(255) NULL,
 	date_string date NULL,
 	modified timestamptz NOT NULL DEFAULT now(),
+	stats jsonb NULL,
+	checkpoint_case int8 NULL,
+	checkpoint_serial int8 NULL,
 	CONSTRAINT trademark_fileinfo_pkey PRIMARY KEY (id)
 );
 CREATE UNIQUE INDEX ON trademark_fileinfo USING btree (url);
 CREATE INDEX ON trademark_fileinfo USING btree (filename);
 
 
+-- trademark_bootstrap definition
+
+CREATE TABLE trademark_bootstrap (
+	name varchar(128) NOT NULL,
+	table_name varchar(128) NOT NULL,
+	kind varchar(15) NOT NULL,
+	definition text NOT NULL,
+	created timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT trademark_bootstrap_pkey PRIMARY KEY (name)
+);
+
+
+-- trademark_parties definition
+-- Names and addresses of owners, attorneys, domestic representatives and correspondents
+-- loaded with --parties, keyed by the hash of the normalized values
+
+CREATE TABLE trademark_parties (
+	party_hash uuid NOT NULL,
+	"name" text NULL,
+	address_1 varchar(1024) NULL,
+	address_2 varchar(1024) NULL,
+	address_3 varchar(1024) NULL,
+	address_4 varchar(1024) NULL,
+	address_5 varchar(1024) NULL,
+	city varchar(50) NULL,
+	state varchar(50) NULL,
+	country varchar(5) NULL,
+	postcode varchar(20) NULL,
+	created timestamptz NOT NULL DEFAULT now(),
+	CONSTRAINT trademark_parties_pkey PRIMARY KEY (party_hash)
+);
+
+
 -- trademark_app_case_file_event_statements definition
 
 CREATE TABLE trademark_app_case_file_event_statements (
@@ -41,15 +79,16 @@ CREATE TABLE trademark_app_case_file_event_statements (
 	code varchar(30) NULL DEFAULT NULL::character varying,
 	"type" varchar(3) NULL DEFAULT NULL::character varying,
 	description_text varchar(100) NULL DEFAULT NULL::character varying,
-	"date" varchar(20) NULL DEFAULT NULL::character varying,
+	"date" date NULL,
 	"number" varchar(20) NULL DEFAULT NULL::character varying,
 	created timestamptz NOT NULL DEFAULT now(),
 	modified timestamptz NOT NULL DEFAULT now(),
 	status bool NOT NULL DEFAULT true,
-	CONSTRAINT trademark_app_case_file_event_statements_pkey PRIMARY KEY (id),
+	CONSTRAINT trademark_app_case_file_event_statements_pkey PRIMARY KEY (id, serial_number),
 	CONSTRAINT trademark_app_case_file_event_statements_serial_number_fkey FOREIGN KEY (serial_number) REFERENCES trademark_app_case_files(serial_number) ON DELETE CASCADE
-);
+) PARTITION BY RANGE (serial_number);
 CREATE INDEX ON trademark_app_case_file_event_statements USING btree (serial_number);
+CREATE INDEX ON trademark_app_case_file_event_statements USING brin ("date");
 
 
 -- trademark_app_case_file_headers definition
@@ -57,80 +96,84 @@ CREATE INDEX ON trademark_app_case_file_event_statements USING btree (serial_num
 CREATE TABLE trademark_app_case_file_headers (
 	id bigserial NOT NULL,
 	serial_number int8 NOT NULL,
-	filing_date varchar(20) NULL DEFAULT NULL::character varying,
+	filing_date date NULL,
 	status_code varchar(30) NULL DEFAULT NULL::character varying,
-	status_date varchar(20) NULL DEFAULT NULL::character varying,
+	status_date date NULL,
 	mark_identification varchar(1024) NULL DEFAULT NULL::character varying,
 	mark_drawing_code varchar(20) NULL DEFAULT NULL::character varying,
 	attorney_docket_number varchar(50) NULL DEFAULT NULL::character varying,
 	attorney_name varchar(4096) NULL DEFAULT NULL::character varying,
-	principal_register_amended_in varchar(70) NULL DEFAULT NULL::character varying,
-	supplemental_register_amended_in varchar(3) NULL DEFAULT NULL::character varying,
-	trademark_in varchar(3) NULL DEFAULT NULL::character varying,
-	collective_trademark_in varchar(3) NULL DEFAULT NULL::character varying,
-	service_mark_in varchar(3) NULL DEFAULT NULL::character varying,
-	collective_service_mark_in varchar(3) NULL DEFAULT NULL::character varying,
-	collective_membership_mark_in varchar(3) NULL DEFAULT NULL::character varying,
-	certification_mark_in varchar(3) NULL DEFAULT NULL::character varying,
-	cancellation_pending_in varchar(3) NULL DEFAULT NULL::character varying,
-	published_concurrent_in varchar(3) NULL DEFAULT NULL::character varying,
-	concurrent_use_in varchar(3) NULL DEFAULT NULL::character varying,
-	concurrent_use_proceeding_in varchar(3) NULL,
-	interference_pending_in varchar(3) NULL DEFAULT NULL::character varying,
-	opposition_pending_in varchar(3) NULL DEFAULT NULL::character varying,
-	section_12c_in varchar(3) NULL DEFAULT NULL::character varying,
-	section_2f_in varchar(3) NULL DEFAULT NULL::character varying,
-	section_2f_in_part_in varchar(3) NULL DEFAULT NULL::character varying,
-	renewal_filed_in varchar(3) NULL,
-	section_8_filed_in varchar(3) NULL DEFAULT NULL::character varying,
-	section_8_partial_accept_in varchar(3) NULL DEFAULT NULL::character varying,
-	section_8_accepted_in varchar(3) NULL DEFAULT NULL::character varying,
-	section_15_acknowledged_in varchar(3) NULL DEFAULT NULL::character varying,
-	section_15_filed_in varchar(3) NULL DEFAULT NULL::character varying,
-	supplemental_register_in varchar(3) NULL DEFAULT NULL::character varying,
-	foreign_priority_in varchar(3) NULL DEFAULT NULL::character varying,
-	change_registration_in varchar(3) NULL,
-	intent_to_use_in varchar(3) NULL,
-	intent_to_use_current_in varchar(3) NULL DEFAULT NULL::character varying,
-	filed_as_use_application_in varchar(3) NULL DEFAULT NULL::character varying,
-	amended_to_use_application_in varchar(3) NULL DEFAULT NULL::character varying,
-	use_application_currently_in varchar(3) NULL DEFAULT NULL::character varying,
-	amended_to_itu_application_in varchar(3) NULL DEFAULT NULL::character varying,
-	filing_basis_filed_as_44d_in varchar(3) NULL DEFAULT NULL::character varying,
-	amended_to_44d_application_in varchar(3) NULL DEFAULT NULL::character varying,
-	filing_basis_current_44d_in varchar(3) NULL DEFAULT NULL::character varying,
-	filing_basis_filed_as_44e_in varchar(3) NULL DEFAULT NULL::character varying,
-	filing_basis_current_44e_in varchar(3) NULL DEFAULT NULL::character varying,
-	amended_to_44e_application_in varchar(3) NULL DEFAULT NULL::character varying,
-	without_basis_currently_in varchar(3) NULL DEFAULT NULL::character varying,
-	filing_current_no_basis_in varchar(3) NULL DEFAULT NULL::character varying,
-	color_drawing_filed_in varchar(3) NULL DEFAULT NULL::character varying,
-	color_drawing_current_in varchar(3) NULL DEFAULT NULL::character varying,
-	drawing_3d_filed_in varchar(3) NULL DEFAULT NULL::character varying,
-	drawing_3d_current_in varchar(3) NULL DEFAULT NULL::character varying,
-	standard_characters_claimed_in varchar(3) NULL DEFAULT NULL::character varying,
-	filing_basis_filed_as_66a_in varchar(3) NULL DEFAULT NULL::character varying,
-	filing_basis_current_66a_in varchar(3) NULL DEFAULT NULL::character varying,
+	principal_register_amended_in bool NULL,
+	supplemental_register_amended_in bool NULL,
+	trademark_in bool NULL,
+	collective_trademark_in bool NULL,
+	service_mark_in bool NULL,
+	collective_service_mark_in bool NULL,
+	collective_membership_mark_in bool NULL,
+	certification_mark_in bool NULL,
+	cancellation_pending_in bool NULL,
+	published_concurrent_in bool NULL,
+	concurrent_use_in bool NULL,
+	concurrent_use_proceeding_in bool NULL,
+	interference_pending_in bool NULL,
+	opposition_pending_in bool NULL,
+	section_12c_in bool NULL,
+	section_2f_in bool NULL,
+	section_2f_in_part_in bool NULL,
+	renewal_filed_in bool NULL,
+	section_8_filed_in bool NULL,
+	section_8_partial_accept_in bool NULL,
+	section_8_accepted_in bool NULL,
+	section_15_acknowledged_in bool NULL,
+	section_15_filed_in bool NULL,
+	supplemental_register_in bool NULL,
+	foreign_priority_in bool NULL,
+	change_registration_in bool NULL,
+	intent_to_use_in bool NULL,
+	intent_to_use_current_in bool NULL,
+	filed_as_use_application_in bool NULL,
+	amended_to_use_application_in bool NULL,
+	use_application_currently_in bool NULL,
+	amended_to_itu_application_in bool NULL,
+	filing_basis_filed_as_44d_in bool NULL,
+	amended_to_44d_application_in bool NULL,
+	filing_basis_current_44d_in bool NULL,
+	filing_basis_filed_as_44e_in bool NULL,
+	filing_basis_current_44e_in bool NULL,
+	amended_to_44e_application_in bool NULL,
+	without_basis_currently_in bool NULL,
+	filing_current_no_basis_in bool NULL,
+	color_drawing_filed_in bool NULL,
+	color_drawing_current_in bool NULL,
+	drawing_3d_filed_in bool NULL,
+	drawing_3d_current_in bool NULL,
+	standard_characters_claimed_in bool NULL,
+	filing_basis_filed_as_66a_in bool NULL,
+	filing_basis_current_66a_in bool NULL,
 	current_location varchar(70) NULL DEFAULT NULL::character varying,
-	location_date varchar(20) NULL DEFAULT NULL::character varying,
+	location_date date NULL,
 	employee_name varchar(70) NULL DEFAULT NULL::character varying,
-	registration_date varchar(20) NULL DEFAULT NULL::character varying,
-	published_for_opposition_date varchar(20) NULL DEFAULT NULL::character varying,
-	amend_to_register_date varchar(20) NULL DEFAULT NULL::character varying,
-	abandonment_date varchar(20) NULL DEFAULT NULL::character varying,
+	registration_date date NULL,
+	published_for_opposition_date date NULL,
+	amend_to_register_date date NULL,
+	abandonment_date date NULL,
 	cancellation_code varchar(20) NULL DEFAULT NULL::character varying,
-	cancellation_date varchar(20) NULL DEFAULT NULL::character varying,
-	republished_12c_date varchar(20) NULL DEFAULT NULL::character varying,
+	cancellation_date date NULL,
+	republished_12c_date date NULL,
 	domestic_representative_name varchar(1024) NULL DEFAULT NULL::character varying,
-	renewal_date varchar(20) NULL DEFAULT NULL::character varying,
+	renewal_date date NULL,
 	law_office_assigned_location_code text NULL,
 	created timestamptz NOT NULL DEFAULT now(),
 	modified timestamptz NOT NULL DEFAULT now(),
 	status bool NOT NULL DEFAULT true,
+	attorney_party_hash uuid NULL,
+	domestic_representative_party_hash uuid NULL,
 	CONSTRAINT trademark_app_case_file_headers_pkey PRIMARY KEY (id),
 	CONSTRAINT trademark_app_case_file_headers_serial_number_fkey FOREIGN KEY (serial_number) REFERENCES trademark_app_case_files(serial_number) ON DELETE CASCADE
 );
 CREATE INDEX ON trademark_app_case_file_headers USING btree (serial_number);
+CREATE INDEX ON trademark_app_case_file_headers USING btree (attorney_party_hash);
+CREATE INDEX ON trademark_app_case_file_headers USING btree (domestic_representative_party_hash);
 
 
 -- trademark_app_case_file_owners definition
@@ -157,10 +200,12 @@ CREATE TABLE trademark_app_case_file_owners (
 	modified timestamptz NOT NULL DEFAULT now(),
 	status bool NOT NULL DEFAULT true,
 	id bigserial NOT NULL,
-	CONSTRAINT trademark_app_case_file_owners_pkey PRIMARY KEY (id),
+	party_hash uuid NULL,
+	CONSTRAINT trademark_app_case_file_owners_pkey PRIMARY KEY (id, serial_number),
 	CONSTRAINT trademark_app_case_file_owners_serial_number_fkey FOREIGN KEY (serial_number) REFERENCES trademark_app_case_files(serial_number) ON DELETE CASCADE
-);
+) PARTITION BY RANGE (serial_number);
 CREATE INDEX ON trademark_app_case_file_owners USING btree (serial_number);
+CREATE INDEX ON trademark_app_case_file_owners USING btree (party_hash);
 
 
 -- trademark_app_case_file_statements definition
@@ -187,7 +232,7 @@ CREATE TABLE trademark_app_classifications (
 	us_code_total_no varchar(20) NULL DEFAULT NULL::character varying,
 	international_code varchar(1024) NULL DEFAULT NULL::character varying,
 	status_code varchar(30) NULL DEFAULT NULL::character varying,
-	status_date varchar(20) NULL DEFAULT NULL::character varying,
+	status_date date NULL,
 	first_use_anywhere_date varchar(20) NULL DEFAULT NULL::character varying,
 	first_use_in_commerce_date varchar(20) NULL DEFAULT NULL::character varying,
 	primary_code varchar(30) NULL DEFAULT NULL::character varying,
@@ -195,9 +240,9 @@ CREATE TABLE trademark_app_classifications (
 	modified timestamptz NOT NULL DEFAULT now(),
 	status bool NOT NULL DEFAULT true,
 	id bigserial NOT NULL,
-	CONSTRAINT trademark_app_classifications_pkey PRIMARY KEY (id),
+	CONSTRAINT trademark_app_classifications_pkey PRIMARY KEY (id, serial_number),
 	CONSTRAINT trademark_app_classifications_serial_number_fkey FOREIGN KEY (serial_number) REFERENCES trademark_app_case_files(serial_number) ON DELETE CASCADE
-);
+) PARTITION BY RANGE (serial_number);
 CREATE INDEX ON trademark_app_classifications USING btree (serial_number);
 
 
@@ -214,10 +259,12 @@ CREATE TABLE trademark_app_correspondents (
 	modified timestamptz NOT NULL DEFAULT now(),
 	status bool NOT NULL DEFAULT true,
 	id bigserial NOT NULL,
+	party_hash uuid NULL,
 	CONSTRAINT trademark_app_correspondents_pkey PRIMARY KEY (id),
 	CONSTRAINT trademark_app_correspondents_serial_number_fkey FOREIGN KEY (serial_number) REFERENCES trademark_app_case_files(serial_number) ON DELETE CASCADE
 );
 CREATE INDEX ON trademark_app_correspondents USING btree (serial_number);
+CREATE INDEX ON trademark_app_correspondents USING btree (party_hash);
 
 
 -- trademark_app_design_searches definition
@@ -239,18 +286,18 @@ CREATE INDEX ON trademark_app_design_searches USING btree (serial_number);
 
 CREATE TABLE trademark_app_foreign_applications (
 	serial_number int8 NOT NULL,
-	filing_date varchar(20) NULL DEFAULT NULL::character varying,
-	registration_date varchar(20) NULL DEFAULT NULL::character varying,
-	registration_expiration_date varchar(20) NULL DEFAULT NULL::character varying,
-	registration_renewal_date varchar(20) NULL DEFAULT NULL::character varying,
-	registration_renewal_expiration_date varchar(20) NULL DEFAULT NULL::character varying,
+	filing_date date NULL,
+	registration_date date NULL,
+	registration_expiration_date date NULL,
+	registration_renewal_date date NULL,
+	registration_renewal_expiration_date date NULL,
 	entry_number varchar(20) NULL DEFAULT NULL::character varying,
 	application_number varchar(20) NULL DEFAULT NULL::character varying,
 	country varchar(5) NULL DEFAULT NULL::character varying,
 	other varchar(30) NULL DEFAULT NULL::character varying,
 	registration_number varchar(20) NULL DEFAULT NULL::character varying,
 	renewal_number varchar(20) NULL DEFAULT NULL::character varying,
-	foreign_priority_claim_in varchar(3) NULL DEFAULT NULL::character varying,
+	foreign_priority_claim_in bool NULL,
 	created timestamptz NOT NULL DEFAULT now(),
 	modified timestamptz NOT NULL DEFAULT now(),
 	status bool NOT NULL DEFAULT true,
@@ -265,16 +312,16 @@ CREATE INDEX ON trademark_app_foreign_applications USING btree (serial_number);
 CREATE TABLE trademark_app_international_registration (
 	serial_number int8 NOT NULL,
 	international_registration_number varchar(30) NULL DEFAULT NULL::character varying,
-	international_registration_date varchar(20) NULL DEFAULT NULL::character varying,
-	international_publication_date varchar(20) NULL DEFAULT NULL::character varying,
-	international_renewal_date varchar(20) NULL DEFAULT NULL::character varying,
-	auto_protection_date varchar(20) NULL DEFAULT NULL::character varying,
-	international_death_date varchar(20) NULL DEFAULT NULL::character varying,
+	international_registration_date date NULL,
+	international_publication_date date NULL,
+	international_renewal_date date NULL,
+	auto_protection_date date NULL,
+	international_death_date date NULL,
 	international_status_code varchar(30) NULL DEFAULT NULL::character varying,
-	international_status_date varchar(20) NULL DEFAULT NULL::character varying,
-	priority_claimed_in varchar(30) NULL DEFAULT NULL::character varying,
-	priority_claimed_date varchar(20) NULL DEFAULT NULL::character varying,
-	first_refusal_in varchar(30) NULL DEFAULT NULL::character varying,
+	international_status_date date NULL,
+	priority_claimed_in bool NULL,
+	priority_claimed_date date NULL,
+	first_refusal_in bool NULL,
 	created timestamptz NOT NULL DEFAULT now(),
 	modified timestamptz NOT NULL DEFAULT now(),
 	status bool NOT NULL DEFAULT true,
@@ -290,7 +337,7 @@ CREATE INDEX ON trademark_app_international_registration USING btree (serial_num
 CREATE TABLE trademark_app_madrid_history_events (
 	serial_number int8 NOT NULL,
 	code varchar(30) NULL DEFAULT NULL::character varying,
-	"date" varchar(20) NULL DEFAULT NULL::character varying,
+	"date" date NULL,
 	description_text varchar(70) NULL DEFAULT NULL::character varying,
 	entry_number varchar(30) NULL DEFAULT NULL::character varying,
 	created timestamptz NOT NULL DEFAULT now(),
@@ -303,6 +350,7 @@ CREATE TABLE trademark_app_madrid_history_events (
 );
 CREATE INDEX ON trademark_app_madrid_history_events USING btree (serial_number);
 CREATE INDEX ON trademark_app_madrid_history_events USING btree (madrid_international_filing_record_id);
+CREATE INDEX ON trademark_app_madrid_history_events USING brin ("date");
 
 
 -- trademark_app_madrid_international_filing_record definition
@@ -311,13 +359,13 @@ CREATE TABLE trademark_app_madrid_international_filing_record (
 	serial_number int8 NOT NULL,
 	entry_number varchar(20) NULL DEFAULT NULL::character varying,
 	reference_number varchar(30) NULL DEFAULT NULL::character varying,
-	original_filing_date_uspto varchar(20) NULL DEFAULT NULL::character varying,
+	original_filing_date_uspto date NULL,
 	international_registration_number varchar(30) NULL DEFAULT NULL::character varying,
-	international_registration_date varchar(20) NULL DEFAULT NULL::character varying,
+	international_registration_date date NULL,
 	international_status_code text NULL,
-	international_status_date varchar(20) NULL DEFAULT NULL::character varying,
-	irregularity_reply_by_date varchar(20) NULL DEFAULT NULL::character varying,
-	international_renewal_date varchar(20) NULL DEFAULT NULL::character varying,
+	international_status_date date NULL,
+	irregularity_reply_by_date date NULL,
+	international_renewal_date date NULL,
 	created timestamptz NOT NULL DEFAULT now(),
 	modified timestamptz NOT NULL DEFAULT now(),
 	status bool NOT NULL DEFAULT true,
@@ -333,7 +381,7 @@ CREATE INDEX ON trademark_app_madrid_international_filing_record USING btree (se
 CREATE TABLE trademark_app_prior_registration_applications (
 	id bigserial NOT NULL,
 	serial_number int8 NOT NULL,
-	other_related_in varchar(3) NULL DEFAULT NULL::character varying,
+	other_related_in bool NULL,
 	relationship_type varchar(3) NULL DEFAULT NULL::character varying,
 	"number" varchar(20) NULL DEFAULT NULL::character varying,
 	created timestamptz NOT NULL DEFAULT now(),
@@ -359,3 +407,22 @@ CREATE TABLE trademark_app_us_codes (
 	CONSTRAINT trademark_app_us_codes_serial_number_fkey FOREIGN KEY (serial_number) REFERENCES trademark_app_case_files(serial_number) ON DELETE CASCADE
 );
 CREATE INDEX ON trademark_app_us_codes USING btree (serial_number);
+
+
+-- Partitions of the tables partitioned by serial_number: one per serial number series,
+-- <table>_s<series> holding its million serials, and <table>_default for any other serial
+
+DO $$
+DECLARE
+	t text;
+	s int;
+BEGIN
+	FOREACH t IN ARRAY ARRAY['trademark_app_case_file_event_statements', 'trademark_app_case_file_owners',
+	                         'trademark_app_classifications'] LOOP
+		FOR s IN 70..99 LOOP
+			EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%s) TO (%s)',
+			               t || '_s' || s, t, s * 1000000, (s + 1) * 1000000);
+		END LOOP;
+		EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', t || '_default', t);
+	END LOOP;
+END $$;
@@ -0,0 +1,285 @@
+"""
+Serial numbers, transaction dates and statuses of all stored case-files, held in sorted
+arrays of 13 bytes per serial, so --parseall decides whether a case-file is new, newer or
+stale without asking the database.
+
+The index is read once with COPY and saved as a snapshot next to the data files. The next
+run maps the snapshot into memory and only reads the case-files modified since.
+"""
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+import psycopg2.extras
+
+import metrics
+
+HEADER = struct.Struct('<8sqd')
+MAGIC = b'TMSIDX01'
+NO_DATE = 0
+# changes kept in a dict before they are merged into the sorted delta columns
+RECENT_SIZE = 4096
+# fewest delta serials merged into the main columns
+MERGE_SIZE = 65536
+
+
+def date_ordinal(value):
+    return value.toordinal() if value is not None else NO_DATE
+
+
+class IndexBuilder(object):
+    """
+    File-like target for COPY TO, appending each line to the arrays
+    """
+
+    def __init__(self):
+        self.serials = array('q')
+        self.dates = array('i')
+        self.statuses = bytearray()
+        self.tail = ''
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('ascii')
+        lines = (self.tail + data).split('\n')
+        self.tail = lines.pop()
+        for line in lines:
+            serial_number, transaction_date, status = line.split('\t')
+            self.serials.append(int(serial_number))
+            self.dates.append(int(transaction_date))
+            self.statuses.append(status == 't')
+
+
+def as_array(typecode, column):
+    """
+    column as an array, copying the memoryview of a mapped snapshot
+    """
+    if isinstance(column, memoryview):
+        return array(typecode, column.tobytes()) if typecode != 'B' else bytearray(column)
+    return column
+
+
+def merge(columns, changes):
+    """
+    New sorted (serials, dates, statuses) columns with changes applied, (serial, ordinal, status)
+    tuples sorted by serial. A change of a serial already in columns replaces it.
+    """
+    serials, dates, statuses = (as_array('q', columns[0]), as_array('i', columns[1]), as_array('B', columns[2]))
+    merged = (array('q'), array('i'), bytearray())
+    start = 0
+    # slices are copied whole, only the changes are appended one by one
+    for serial_number, ordinal, status in changes:
+        end = bisect.bisect_left(serials, serial_number, start)
+        for target, source, value in zip(merged, (serials, dates, statuses), (serial_number, ordinal, status)):
+            target.extend(source[start:end])
+            target.append(value)
+        start = end + 1 if end < len(serials) and serials[end] == serial_number else end
+    for target, source in zip(merged, (serials, dates, statuses)):
+        target.extend(source[start:])
+    return merged
+
+
+class SerialIndex(object):
+    """
+    Sorted serial numbers with their transaction dates and statuses, and the changes
+    committed during the run on top of them. The changes are kept in a small dict, merged
+    into sorted delta columns when it is full, which are merged into the main columns once
+    they hold more than an eighth of them, so every serial costs 13 bytes.
+    """
+
+    def __init__(self, serials, dates, statuses, since, snapshot=None):
+        self.logger = logging.getLogger(__name__)
+        # (serials, dates, statuses), replaced as a whole so readers never mix two versions
+        self.columns = (serials, dates, statuses)
+        # database time the arrays are complete up to, as epoch seconds
+        self.since = since
+        self.snapshot = snapshot
+        # the memoryviews of the snapshot, released when it is closed
+        self.mapped = (serials, dates, statuses) if snapshot is not None else ()
+        self.delta = (array('q'), array('i'), bytearray())
+        self.recent = {}
+        self.lock = threading.Lock()
+
+    @property
+    def serials(self):
+        return self.columns[0]
+
+    def find(self, serial_number, serials=None):
+        if serials is None:
+            serials = self.serials
+        i = bisect.bisect_left(serials, serial_number)
+        if i < len(serials) and serials[i] == serial_number:
+            return i
+        return None
+
+    def get(self, serial_number):
+        """
+        (date ordinal, status) of serial_number, None when it is not known
+        """
+        # read in the opposite order of compact(), which moves changes down the levels
+        change = self.recent.get(serial_number)
+        if change is not None:
+            return change
+        delta = self.delta
+        i = self.find(serial_number, delta[0])
+        if i is not None:
+            return delta[1][i], bool(delta[2][i])
+        serials, dates, statuses = self.columns
+        i = self.find(serial_number, serials)
+        if i is None:
+            return None
+        return dates[i], bool(statuses[i])
+
+    def lookup(self, serial_numbers):
+        """
+        Same result as Db.serials_get, without the hashes
+        """
+        result = {}
+        with metrics.current().timer('lookup'):
+            for serial_number in serial_numbers:
+                found = self.get(serial_number)
+                if found is not None:
+                    ordinal, status = found
+                    result[serial_number] = {
+                        'transaction_date': datetime.date.fromordinal(ordinal) if ordinal != NO_DATE else None,
+                        'status': status}
+        return result
+
+    def update(self, serial_number, transaction_date, status=False):
+        with self.lock:
+            self.recent[serial_number] = (date_ordinal(transaction_date), status)
+            if len(self.recent) >= RECENT_SIZE:
+                self.compact()
+
+    def compact(self, main=False):
+        """
+        Merges the recent changes into the delta columns, and those into the main columns
+        when they are large enough or main is True. Called with the lock held.
+        """
+        if len(self.recent) > 0:
+            self.delta = merge(self.delta, sorted((serial_number,) + change
+                                                  for serial_number, change in self.recent.items()))
+            self.recent = {}
+        if len(self.delta[0]) > 0 and (main or len(self.delta[0]) >= max(MERGE_SIZE, len(self.serials) // 8)):
+            self.columns = merge(self.columns, zip(*self.delta))
+            self.delta = (array('q'), array('i'), bytearray())
+
+    def refresh(self, dbc):
+        """
+        Reads the case-files modified since the index was loaded, written by other processes
+        """
+        start_time = time.time()
+        builder, since = copy_index(dbc, 'WHERE modified >= to_timestamp(%s)' % float(self.since))
+        with self.lock:
+            self.compact()
+            # the rows come sorted by serial and are newer than any change of this process
+            self.delta = merge(self.delta, zip(builder.serials, builder.dates, builder.statuses))
+            self.compact()
+            self.since = since
+        self.logger.info('Refreshed serial index with %s case-files [%6.3f sec]',
+                         len(builder.serials), time.time() - start_time)
+
+    def save(self, filename):
+        """
+        Writes the arrays merged with the changes, atomically
+        """
+        start_time = time.time()
+        with self.lock:
+            self.compact(main=True)
+            serials, dates, statuses = self.columns
+            since = self.since
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(serials), since))
+            f.write(serials)
+            f.write(dates)
+            f.write(statuses)
+        os.replace(tmp_filename, filename)
+        self.logger.info('Saved serial index of %s case-files to %s [%6.3f sec]',
+                         len(serials), filename, time.time() - start_time)
+
+    def close(self):
+        if self.snapshot is not None:
+            self.columns = (array('q'), array('i'), bytearray())
+            for view in self.mapped:
+                view.release()
+            self.mapped = ()
+            self.snapshot.close()
+            self.snapshot = None
+
+
+def copy_index(dbc, where=''):
+    """
+    Reads serial numbers, transaction dates and statuses with COPY, sorted by serial.
+    Returns the builder and the time up to which the result is complete: the start of the
+    oldest open transaction, whose rows may still commit with an earlier modified time.
+    """
+    # dates as the ordinals of datetime.date, day 1 being 0001-01-01
+    q = "COPY (SELECT serial_number, COALESCE(transaction_date - DATE '0001-01-01' + 1, {0}), status " \
+        "FROM trademark_app_case_files {1} ORDER BY serial_number) TO STDOUT".format(NO_DATE, where)
+    q_since = "SELECT extract(epoch FROM least(now(), min(xact_start))) AS since FROM pg_stat_activity " \
+              "WHERE datname = current_database() AND xact_start IS NOT NULL"
+    builder = IndexBuilder()
+    cur = dbc.cnx.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    try:
+        cur.execute(q_since)
+        since = float(cur.fetchone()['since'])
+        cur.copy_expert(q, builder)
+        dbc.cnx.commit()
+    finally:
+        cur.close()
+    return builder, since
+
+
+def from_db(dbc):
+    start_time = time.time()
+    builder, since = copy_index(dbc)
+    index = SerialIndex(builder.serials, builder.dates, builder.statuses, since)
+    index.logger.info('Loaded serial index of %s case-files from the database [%6.3f sec]',
+                      len(builder.serials), time.time() - start_time)
+    return index
+
+
+def from_snapshot(filename):
+    """
+    Maps a saved index into memory, None when the file is not a snapshot
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        magic, count, since = HEADER.unpack(header)
+        if magic != MAGIC or os.fstat(f.fileno()).st_size != HEADER.size + count * 13:
+            return None
+        if count == 0:
+            return SerialIndex(array('q'), array('i'), bytearray(), since)
+        snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(snapshot)
+    offset = HEADER.size
+    serials = view[offset:offset + count * 8].cast('q')
+    offset += count * 8
+    dates = view[offset:offset + count * 4].cast('i')
+    offset += count * 4
+    statuses = view[offset:offset + count]
+    view.release()
+    return SerialIndex(serials, dates, statuses, since, snapshot=snapshot)
+
+
+def load(dbc, filename):
+    """
+    Index from the snapshot in filename brought up to date, from the database without one
+    """
+    if os.path.isfile(filename):
+        index = from_snapshot(filename)
+        if index is not None:
+            index.logger.info('Mapped serial index of %s case-files from %s', len(index.serials), filename)
+            index.refresh(dbc)
+            return index
+        logging.getLogger(__name__).warning('%s is not a serial index snapshot, reading the database', filename)
+    return from_db(dbc)
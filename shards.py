@@ -0,0 +1,129 @@
+"""
+Splits one large XML file into byte ranges that can be parsed by separate processes.
+
+A shard owns every <case-file> whose opening tag starts inside its byte range. The
+ShardReader hands iterparse only those case-files, wrapped in a <shard> root element,
+so each shard is a well formed document on its own.
+"""
+import os
+
+CASE_OPEN = b'<case-file>'
+CASE_CLOSE = b'</case-file>'
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def shard_ranges(filename, count):
+    size = os.path.getsize(filename)
+    count = max(1, count)
+    step = size // count + 1
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def case_offset(filename, ordinal, chunk_size=CHUNK_SIZE):
+    """
+    Byte offset of the case-file number ordinal (counted from 0), found by scanning
+    the bytes instead of parsing them. None when the file has fewer case-files.
+    """
+    keep = len(CASE_OPEN) - 1
+    seen = 0
+    with open(filename, 'rb') as f:
+        data = b''
+        data_offset = 0
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return None
+            data += chunk
+            count = data.count(CASE_OPEN)
+            if seen + count > ordinal:
+                idx = -1
+                for i in range(ordinal - seen + 1):
+                    idx = data.find(CASE_OPEN, idx + 1)
+                return data_offset + idx
+            seen += count
+            # a tag split between two chunks is found with the next one
+            if len(data) > keep:
+                data_offset += len(data) - keep
+                data = data[-keep:]
+
+
+class ShardReader(object):
+    """
+    File-like object returning the case-files of filename owned by the range [start, end)
+    """
+
+    def __init__(self, filename, start, end, chunk_size=CHUNK_SIZE):
+        self.file = open(filename, 'rb')
+        self.file.seek(start)
+        self.end = end
+        self.chunk_size = chunk_size
+        self.output = bytearray(b'<shard>')
+        self.scan = b''
+        self.scan_offset = start
+        self.pos = 0
+        self.in_case = False
+        self.eof = False
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size is None or size < 0 or len(self.output) < size):
+            self.fill()
+        if size is None or size < 0:
+            size = len(self.output)
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        return data
+
+    def fill(self):
+        if not self.eof:
+            chunk = self.file.read(self.chunk_size)
+            if chunk:
+                self.scan = self.scan[self.pos:] + chunk
+                self.scan_offset += self.pos
+                self.pos = 0
+            else:
+                self.eof = True
+        while True:
+            if not self.in_case:
+                idx = self.scan.find(CASE_OPEN, self.pos)
+                if idx >= 0 and self.scan_offset + idx < self.end:
+                    self.pos = idx
+                    self.in_case = True
+                    continue
+                keep = len(CASE_OPEN) - 1
+                if idx >= 0 or self.eof or self.scan_offset + len(self.scan) - keep >= self.end:
+                    self.finish()
+                else:
+                    self.pos = max(self.pos, len(self.scan) - keep)
+                return
+            idx = self.scan.find(CASE_CLOSE, self.pos)
+            if idx >= 0:
+                end = idx + len(CASE_CLOSE)
+                self.output += self.scan[self.pos:end]
+                self.pos = end
+                self.in_case = False
+                continue
+            keep = len(CASE_CLOSE) - 1
+            if self.eof:
+                # truncated case-file, let the parser report it
+                self.output += self.scan[self.pos:]
+                self.finish()
+            elif len(self.scan) - keep > self.pos:
+                self.output += self.scan[self.pos:len(self.scan) - keep]
+                self.pos = len(self.scan) - keep
+            return
+
+    def finish(self):
+        self.output += b'</shard>'
+        self.scan = b''
+        self.pos = 0
+        self.done = True
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -5,26 +5,46 @@ __date__ = '2018-11-08'
 
 import argparse
 import concurrent.futures as cf
-from datetime import datetime
+import json
 import logging
 import logging.config
+import multiprocessing
 import os
 from pprint import pprint
 import re
-import requests
 import sys
 import time
 import zipfile
 
 from lxml import etree, html
 
-from db_pgsql import Db
-from helpers import download_html, get_text_or_none
+import bootstrap
+from case_spec import extract_case
+from case_target import TargetReader
+from db_pgsql import Db, init_pool
+from downloader import DownloadError, Downloader, parse_size
+from helpers import download_html_if_modified, get_text_or_none, xml_filename_from_url
+from loader import BATCH_SECONDS, BATCH_SIZE, CopyLoader, StagingLoader, is_newer, to_date
+import metrics
+from parquet_sink import ParquetLoader, exported
+from parties import CACHE_SIZE, PartyResolver, party_cache
+from pipeline import QUEUE_SIZE, PipelineLoader
+import serial_index
+from shards import ShardReader, case_offset, shard_ranges
+from zipstream import ZipStream
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 WORK_DIR = os.path.join(BASE_DIR, 'work_dir')
 LOG_DIR = os.path.join(BASE_DIR, 'logs')
+SERIAL_INDEX_FILE = os.path.join(WORK_DIR, 'serial_index.bin')
+LISTING_FILE = os.path.join(WORK_DIR, 'listing.json')
 MAIN_URL = 'https://bulkdata.uspto.gov/data/trademark/dailyxml/applications/'
+LOOKUP_SIZE = 500
+SHARD_MIN_SIZE = 64 * 1024 * 1024
+
+
+class CheckpointError(Exception):
+    pass
 
 
 def print_dict(dictionary):
@@ -32,293 +52,324 @@ def print_dict(dictionary):
         print(k, type(v), v)
 
 
-def parse_case(case, doc_id, file_id, dbc):
-    def parse_case_files():
-        case_files = {'serial_number': doc_id,
-                      'file_id': file_id,
-                      'registration_number': get_text_or_none(case, 'registration-number/text()'),
-                      'transaction_date': get_text_or_none(case, 'transaction-date/text()')}
-        return dbc.insert_dict(case_files, 'trademark_app_case_files')
-
-    def parse_headers():
-        case_file_headers = {'serial_number': doc_id}
-        case_file_header_items = (
-            'filing_date', 'status_code', 'status_date', 'mark_identification', 'mark_drawing_code',
-            'attorney_docket_number', 'attorney_name', 'principal_register_amended_in',
-            'supplemental_register_amended_in', 'trademark_in', 'collective_trademark_in', 'service_mark_in',
-            'collective_service_mark_in', 'collective_membership_mark_in', 'certification_mark_in',
-            'cancellation_pending_in', 'published_concurrent_in', 'concurrent_use_in',
-            'concurrent_use_proceeding_in', 'interference_pending_in', 'opposition_pending_in', 'section_12c_in',
-            'section_2f_in', 'section_2f_in_part_in', 'renewal_filed_in', 'section_8_filed_in',
-            'section_8_partial_accept_in', 'section_8_accepted_in', 'section_15_acknowledged_in',
-            'section_15_filed_in', 'supplemental_register_in', 'foreign_priority_in', 'change_registration_in',
-            'intent_to_use_in', 'intent_to_use_current_in', 'filed_as_use_application_in',
-            'amended_to_use_application_in', 'use_application_currently_in', 'amended_to_itu_application_in',
-            'filing_basis_filed_as_44d_in', 'amended_to_44d_application_in', 'filing_basis_current_44d_in',
-            'filing_basis_filed_as_44e_in', 'filing_basis_current_44e_in', 'amended_to_44e_application_in',
-            'without_basis_currently_in', 'filing_current_no_basis_in', 'color_drawing_filed_in',
-            'color_drawing_current_in', 'drawing_3d_filed_in', 'drawing_3d_current_in',
-            'standard_characters_claimed_in', 'filing_basis_filed_as_66a_in', 'filing_basis_current_66a_in',
-            'current_location', 'location_date', 'employee_name', 'registration_date',
-            'published_for_opposition_date', 'amend_to_register_date', 'abandonment_date', 'cancellation_code',
-            'cancellation_date', 'republished_12c_date', 'domestic_representative_name', 'renewal_date',
-            'law_office_assigned_location_code')
-        for hitem in case_file_header_items:
-            search_term = 'case-file-header/' + hitem.replace('_', '-') + '/text()'
-            case_file_headers[hitem] = get_text_or_none(case, search_term)
-        return dbc.insert_dict(case_file_headers, 'trademark_app_case_file_headers')
-
-    def parse_statements():
-        cfs_elements = case.findall('case-file-statements/case-file-statement')
-        lst = []
-        for child in cfs_elements:
-            case_file_statements = {'serial_number': doc_id,
-                                    'type_code': get_text_or_none(child, 'type-code/text()'),
-                                    'text': get_text_or_none(child, 'text/text()')}
-            lst.append(case_file_statements)
-        dbc.insert_listdict(lst, 'trademark_app_case_file_statements')
-
-    def parse_event_statements():
-        cfes_elements = case.findall('case-file-event-statements/case-file-event-statement')
-        lst = []
-        for child in cfes_elements:
-            case_file_event_statements = {'serial_number': doc_id,
-                                          'code': get_text_or_none(child, 'code/text()'),
-                                          'type': get_text_or_none(child, 'type/text()'),
-                                          'description_text': get_text_or_none(child, 'description-text/text()'),
-                                          'date': get_text_or_none(child, 'date/text()'),
-                                          'number': get_text_or_none(child, 'number/text()')}
-            lst.append(case_file_event_statements)
-        dbc.insert_listdict(lst, 'trademark_app_case_file_event_statements')
-
-    def parse_prior_registration_applications():
-        pra_elements = case.findall('prior-registration-applications/prior-registration-application')
-        other_related_in = get_text_or_none(case, 'prior-registration-applications/other-related-in/text()')
-        lst = []
-        for child in pra_elements:
-            prior_registration_applications = {'serial_number': doc_id,
-                                               'other_related_in': other_related_in,
-                                               'relationship_type': get_text_or_none(child,
-                                                                                     'relationship-type/text()'),
-                                               'number': get_text_or_none(child, 'number/text()')}
-            lst.append(prior_registration_applications)
-        dbc.insert_listdict(lst, 'trademark_app_prior_registration_applications')
-
-    def parse_foreign_applications():
-        fa_elements = case.findall('foreign-applications/foreign-application')
-        lst = []
-        for child in fa_elements:
-            foreign_applications = {'serial_number': doc_id}
-            foreign_applications_items = (
-                'filing_date', 'registration_date', 'registration_expiration_date', 'registration_renewal_date',
-                'registration_renewal_expiration_date', 'entry_number', 'application_number', 'country',
-                'other', 'registration_number', 'renewal_number', 'foreign_priority_claim_in')
-            for hitem in foreign_applications_items:
-                search_term = hitem.replace('_', '-') + '/text()'
-                foreign_applications[hitem] = get_text_or_none(child, search_term)
-            lst.append(foreign_applications)
-        dbc.insert_listdict(lst, 'trademark_app_foreign_applications')
-
-    def parse_classifications():
-        classification_elements = case.findall('classifications/classification')
-        for child in classification_elements:
-            classifications = {'serial_number': doc_id}
-            classifications_items = (
-                'international_code_total_no', 'us_code_total_no', 'international_code', 'status_code',
-                'status_date', 'first_use_anywhere_date', 'first_use_in_commerce_date', 'primary_code')
-            for hitem in classifications_items:
-                search_term = hitem.replace('_', '-') + '/text()'
-                classifications[hitem] = get_text_or_none(child, search_term)
-            classification_id = dbc.insert_dict(classifications, 'trademark_app_classifications')
-            code_elements = child.findall('us-code')
-            lst = []
-            for subchild in code_elements:
-                case_file_us_codes = {'serial_number': doc_id,
-                                      'classification_id': classification_id,
-                                      'us_code': subchild.text}
-                lst.append(case_file_us_codes)
-            dbc.insert_listdict(lst, 'trademark_app_us_codes')
-
-    def parse_correspondents():
-        correspondent_elements = case.findall('correspondent')
-        lst = []
-        for child in correspondent_elements:
-            case_file_correspondent = {'serial_number': doc_id}
-            case_file_correspondent_items = (
-                'address_1', 'address_2', 'address_3', 'address_4', 'address_5')
-            for hitem in case_file_correspondent_items:
-                search_term = hitem.replace('_', '-') + '/text()'
-                case_file_correspondent[hitem] = get_text_or_none(child, search_term)
-            lst.append(case_file_correspondent)
-        dbc.insert_listdict(lst, 'trademark_app_correspondents')
-
-    def parse_owners():
-        cfo_elements = case.findall('case-file-owners/case-file-owner')
-        lst = []
-        for child in cfo_elements:
-            case_file_owners = {'serial_number': doc_id}
-            case_file_owners_items = (
-                'entry_number', 'party_type', 'legal_entity_type_code', 'entity_statement', 'party_name',
-                'address_1', 'address_2', 'city', 'state', 'country', 'other', 'postcode', 'dba_aka_text',
-                'composed_of_statement', 'name_change_explanation')
-            for hitem in case_file_owners_items:
-                search_term = hitem.replace('_', '-') + '/text()'
-                case_file_owners[hitem] = get_text_or_none(child, search_term)
-            case_file_owners['nationality'] = get_text_or_none(child, 'nationality/country/text()')
-            lst.append(case_file_owners)
-        dbc.insert_listdict(lst, 'trademark_app_case_file_owners')
-
-    def parse_design_searches():
-        cfds_elements = case.findall('design-searches/design-search')
-        lst = []
-        for child in cfds_elements:
-            case_file_design_searches = {'serial_number': doc_id,
-                                         'code': get_text_or_none(child, 'code/text()')}
-            lst.append(case_file_design_searches)
-        dbc.insert_listdict(lst, 'trademark_app_design_searches')
-
-    def parse_international_registration():
-        cfir_elements = case.findall('international-registration')
-        lst = []
-        for child in cfir_elements:
-            case_file_international_registration = {'serial_number': doc_id}
-            case_file_international_registration_items = (
-                'international_registration_number', 'international_registration_date',
-                'international_publication_date', 'international_renewal_date', 'auto_protection_date',
-                'international_death_date', 'international_status_code', 'international_status_date',
-                'priority_claimed_in', 'priority_claimed_date', 'first_refusal_in')
-            for hitem in case_file_international_registration_items:
-                search_term = hitem.replace('_', '-') + '/text()'
-                case_file_international_registration[hitem] = get_text_or_none(child, search_term)
-            lst.append(case_file_international_registration)
-        dbc.insert_listdict(lst, 'trademark_app_international_registration')
-
-    def parse_madrid_international_filing_record():
-        mifr_elements = case.findall('madrid-international-filing-requests/madrid-international-filing-record')
-        for child in mifr_elements:
-            madrid_international_filing_record = {'serial_number': doc_id}
-            madrid_international_filing_record_items = (
-                'entry_number', 'reference_number', 'original_filing_date_uspto',
-                'international_registration_number',
-                'international_registration_date', 'international_status_code',
-                'international_status_date', 'irregularity_reply_by_date', 'international_renewal_date')
-            for hitem in madrid_international_filing_record_items:
-                search_term = hitem.replace('_', '-') + '/text()'
-                madrid_international_filing_record[hitem] = get_text_or_none(child, search_term)
-            mifr_id = dbc.insert_dict(madrid_international_filing_record,
-                                      'trademark_app_madrid_international_filing_record')
-            mhe_elements = child.findall('madrid-history-events/madrid-history-event')
-            lst = []
-            for subchild in mhe_elements:
-                madrid_history_events = {'serial_number': doc_id,
-                                         'madrid_international_filing_record_id': mifr_id}
-                madrid_history_events_items = (
-                    'code', 'date', 'description_text', 'entry_number')
-                for hitem in madrid_history_events_items:
-                    search_term = hitem.replace('_', '-') + '/text()'
-                    madrid_history_events[hitem] = get_text_or_none(subchild, search_term)
-                lst.append(madrid_history_events)
-            dbc.insert_listdict(lst, 'trademark_app_madrid_history_events')
-
+def parse_case(case, doc_id, file_id, loader, reader, replace=False):
     start_time = time.time()
-    tm = doc_id
     try:
-        parse_case_files()
-    except KeyboardInterrupt:
-        dbc.cnx.rollback()
-        sys.exit()
-    except SystemExit:
-        dbc.cnx.rollback()
-        sys.exit()
+        rows = reader.extract(case, doc_id, file_id)
     except Exception:
         logger.error('[%s] error while parsing doc_id %s', file_id, doc_id)
         logger.exception('message')
-        dbc.cnx.rollback()
-        tm = None
-    with cf.ThreadPoolExecutor(max_workers=11) as executor:
-        try:
-            # executor.submit(parse_case_files)
-            executor.submit(parse_headers)
-            executor.submit(parse_statements)
-            executor.submit(parse_event_statements)
-            executor.submit(parse_prior_registration_applications)
-            executor.submit(parse_foreign_applications)
-            executor.submit(parse_classifications)
-            executor.submit(parse_correspondents)
-            executor.submit(parse_owners)
-            executor.submit(parse_design_searches)
-            executor.submit(parse_international_registration)
-            executor.submit(parse_madrid_international_filing_record)
-        except KeyboardInterrupt:
-            dbc.cnx.rollback()
-            sys.exit()
-        except SystemExit:
-            dbc.cnx.rollback()
-            sys.exit()
-        except Exception:
-            logger.error('[%s] error while parsing doc_id %s', file_id, doc_id)
-            logger.exception('message')
-            dbc.cnx.rollback()
-            tm = None
-    if tm is not None:
-        dbc.cnx.commit()
-        logger.info(
-            '[%s] Inserted tm %s in [%6.3f sec]', file_id, doc_id, time.time() - start_time
-            )
-    else:
-        logger.warning('[%s] Could not insert %s', file_id, doc_id)
+        return None
+    file_metrics = metrics.current()
+    file_metrics.observe('tm_stage_seconds', time.time() - start_time, stage='extract')
+    file_metrics.inc('tm_cases_parsed_total')
+    loader.add(doc_id, rows, replace=replace)
+    logger.debug('[%s] Parsed tm %s in [%6.3f sec]', file_id, doc_id, time.time() - start_time)
+    return doc_id
+
+
+def case_action(transaction_date_string, serial_db):
+    """
+    Decides what to do with a case-file whose serial number is already known, the same
+    way CopyLoader.decide does once the serial is locked.
+    Returns True when the stored case has to be replaced.
+    """
+    if to_date(transaction_date_string) is None:
+        logger.warning('Missing transaction date in XML')
+    # a date from the database, a string from a case-file of this file not written yet
+    if to_date(serial_db['transaction_date']) is None:
+        logger.warning('Missing transaction date in database')
+    return is_newer(transaction_date_string, serial_db['transaction_date']) \
+        or (serial_db['status'] is False and args.force)
+
+
+def process_cases(cases, file_id, dbc, loader, label, reader):
+    """
+    Decides for a block of (case_number, doc_id, case) read-ahead case-files whether they
+    are new, newer than the known version or stale, using one lookup for the whole block.
+    """
+    serials = loader.lookup([doc_id for case_number, doc_id, case in cases])
+    for case_number, doc_id, case in cases:
+        loader.advance(case_number + 1, doc_id)
+        transaction_date_string = reader.transaction_date(case)
+        pending = loader.pending_case(doc_id)
+        if pending is not None:
+            # Same serial number seen earlier in this file and not yet written
+            serial_db = {'transaction_date': pending['transaction_date'], 'status': False}
+        else:
+            serial_db = serials.get(doc_id)
+        if serial_db is not None:
+            if case_action(transaction_date_string, serial_db):
+                logger.info('[%s] Processing existing serial number %s', label, doc_id)
+                if parse_case(case, doc_id, file_id, loader, reader, replace=True) is not None:
+                    serials[doc_id] = {'transaction_date': transaction_date_string, 'status': False}
+            else:
+                metrics.current().inc('tm_cases_skipped_total')
+        else:
+            logger.info('[%s] Processing new serial number %s', label, doc_id)
+            if parse_case(case, doc_id, file_id, loader, reader) is not None:
+                serials[doc_id] = {'transaction_date': transaction_date_string, 'status': False}
+        reader.release(case)
+
+
+def release(case):
+    """
+    Frees a processed case-file together with the earlier, already cleared siblings
+    iterparse keeps attached to the root, so memory stays flat however large the file
+    """
+    case.clear()
+    parent = case.getparent()
+    if parent is not None:
+        while case.getprevious() is not None:
+            del parent[0]
+
+
+class TreeReader(object):
+    """
+    Case-files as the elements iterparse builds, extracted with CASE_SPEC when they are processed
+    """
+
+    def cases(self, source, file_id):
+        for event, case in etree.iterparse(source, events=('end',), tag='case-file'):
+            yield int(get_text_or_none(case, 'serial-number/text()')), case
+
+    def transaction_date(self, case):
+        return get_text_or_none(case, 'transaction-date/text()')
+
+    def extract(self, case, doc_id, file_id):
+        return extract_case(case, doc_id, file_id)
+
+    def release(self, case):
+        release(case)
+
+
+def create_reader():
+    """
+    Reader for the --parser option
+    """
+    if args.parser == 'target':
+        return TargetReader()
+    return TreeReader()
+
+
+def create_loader(dbc, file_id=None, label=None):
+    """
+    Loader for the --parquet, --staging, --loaders and --parties options, writing checkpoints of file_id
+    when it is given
+    """
+    if args.parquet:
+        return ParquetLoader(args.parquet, label.split(':')[0], file_id=file_id, batch_size=args.batch_size)
+    if args.staging:
+        return StagingLoader(dbc, batch_size=args.batch_size, force=args.force)
+    parties = PartyResolver(party_cache(args.party_cache_size)) if args.parties else None
+    if args.loaders > 0:
+        return PipelineLoader(dbc, batch_size=args.batch_size, file_id=file_id, index=index, force=args.force,
+                              cascade=not args.bootstrap, batch_seconds=args.batch_seconds, parties=parties,
+                              loaders=args.loaders, queue_size=args.queue_size)
+    return CopyLoader(dbc, batch_size=args.batch_size, file_id=file_id, index=index, force=args.force,
+                      cascade=not args.bootstrap, batch_seconds=args.batch_seconds, parties=parties)
+
+
+def parse_source(source, file_id, dbc, label, loader=None, first_case=0, resume=None):
+    """
+    Parses the case-files of source, first_case being the number of its first one in the
+    file. With resume, a (case, serial_number) checkpoint, the case-files before number
+    case are skipped, the last of them must be serial_number.
+    """
+    if loader is None:
+        loader = create_loader(dbc, file_id, label)
+    reader = create_reader()
+    cases = []
+    case_number = first_case
+    try:
+        with metrics.current().timer('parse'):
+            for doc_id, case in reader.cases(source, file_id):
+                if resume is not None and case_number < resume[0]:
+                    if case_number == resume[0] - 1 and doc_id != resume[1]:
+                        raise CheckpointError('Case-file %s is serial %s, the checkpoint has %s' % (
+                            case_number, doc_id, resume[1]))
+                    reader.release(case)
+                    case_number += 1
+                    continue
+                cases.append((case_number, doc_id, case))
+                case_number += 1
+                if len(cases) >= args.lookup_size:
+                    process_cases(cases, file_id, dbc, loader, label, reader)
+                    cases = []
+            process_cases(cases, file_id, dbc, loader, label, reader)
+    except BaseException:
+        if isinstance(loader, PipelineLoader):
+            # the loader threads hold connections of the pool
+            loader.abort()
         raise
+    return loader.close()
+
 
-    # dbc.case_file_update_status(doc_id, 'true')
-    # dbc.cnx.commit()
-    # logger.info('Inserted case %s in [%s sec]', doc_id, time.time() - start_time)
+def init_shard_worker(parsed_args):
+    global args
+    args = parsed_args
 
 
-def parse_file(filename, file_id):
+def parse_shard(filename, file_id, start, end):
+    init_pool(1 + args.loaders)
     dbc = Db()
+    label = '%s:%s-%s' % (os.path.basename(filename), start, end)
+    try:
+        with metrics.scope() as shard_metrics, ShardReader(filename, start, end) as source:
+            # shards end in any order, a checkpoint could not tell which case-files are written
+            parse_source(source, file_id, dbc, label, loader=create_loader(dbc))
+            metrics.record_peak_rss(shard_metrics)
+            # metrics of a shard process are merged into the file by the parent
+            return shard_metrics.snapshot()
+    finally:
+        dbc.close()
+
+
+def parse_file_sharded(filename, file_id):
+    """
+    Parses byte ranges of one large file in separate processes.
+    Returns True only when every shard completed.
+    """
+    ranges = shard_ranges(filename, args.processes)
+    logger.info('[%s] Parsing in %s shards', os.path.basename(filename), len(ranges))
+    context = multiprocessing.get_context('spawn')
+    completed = True
+    with cf.ProcessPoolExecutor(max_workers=args.processes, mp_context=context,
+                                initializer=init_shard_worker, initargs=(args,)) as executor:
+        futures = [executor.submit(parse_shard, filename, file_id, start, end) for start, end in ranges]
+        for future in cf.as_completed(futures):
+            try:
+                metrics.current().merge(future.result())
+            except Exception:
+                logger.error('[%s] Shard failed', os.path.basename(filename))
+                logger.exception('message')
+                completed = False
+    return completed
+
+
+def resume_file(filename, file_id, dbc, label, checkpoint):
+    """
+    Seeks to the last case-file of the checkpoint by scanning for its tag and parses from
+    there. Returns False when the checkpoint does not belong to the file.
+    """
+    case, serial_number = checkpoint
+    offset = case_offset(filename, case - 1)
+    if offset is None:
+        logger.warning('[%s] Less than %s case-files, parsing from the start', label, case)
+        return False
+    logger.info('[%s] Resuming after case-file %s at byte %s', label, case, offset)
+    try:
+        with ShardReader(filename, offset, os.path.getsize(filename)) as source:
+            parse_source(source, file_id, dbc, label, first_case=case - 1, resume=checkpoint)
+    except CheckpointError as err:
+        logger.warning('[%s] %s, parsing from the start', label, err)
+        return False
+    return True
+
+
+def parse_stream(open_source, file_id, dbc, label, checkpoint=None):
+    """
+    Parses the stream returned by open_source, skipping the case-files before the checkpoint
+    """
+    if checkpoint is not None:
+        logger.info('[%s] Resuming after case-file %s', label, checkpoint[0])
+        try:
+            with open_source() as source:
+                return parse_source(source, file_id, dbc, label, resume=checkpoint)
+        except CheckpointError as err:
+            logger.warning('[%s] %s, parsing from the start', label, err)
+    with open_source() as source:
+        return parse_source(source, file_id, dbc, label)
+
+
+def open_zip_member(zip_filename):
+    zip_ref = zipfile.ZipFile(zip_filename, 'r')
+    member = [name for name in zip_ref.namelist() if name.endswith('.xml')][0]
+    source = zip_ref.open(member)
+    zip_ref.close()
+    return source
+
+
+def open_http_stream(url):
+    return ZipStream(downloader.open_stream(url))
+
+
+def parse_file(filename, file_id, url=None, dbc=None, checkpoint=None):
+    """
+    Parses the extracted XML when it is in WORK_DIR, otherwise streams it from the
+    downloaded zip or, with --stream http, from the download itself.
+    """
+    if dbc is None:
+        dbc = Db()
+        try:
+            return parse_file(filename, file_id, url, dbc, checkpoint)
+        finally:
+            dbc.close()
+    with metrics.scope() as file_metrics:
+        status = parse_file_scoped(filename, file_id, url, dbc, checkpoint)
+        file_metrics.inc('tm_files_total', status=status)
+        if file_id is not None and not args.parquet:
+            dbc.file_update_stats(file_id, file_metrics.summary())
+    return status
+
+
+def parse_file_scoped(filename, file_id, url, dbc, checkpoint=None):
+    """
+    Returns the status the file is left in
+    """
     if WORK_DIR not in filename:
         filename = os.path.join(WORK_DIR, filename)
-    with open(filename, 'rb') as inputfile:
-        file_start_time = time.time()
+    zip_filename = os.path.join(WORK_DIR, url.split('/')[-1]) if url else None
+    label = os.path.basename(filename)
+    file_start_time = time.time()
+    if os.path.isfile(filename):
         logger.info('Parsing file %s' % filename)
-        context = etree.iterparse(inputfile, events=('end',), tag='case-file')
-        for event, case in context:
-            doc_id = int(get_text_or_none(case, 'serial-number/text()'))
-            serial_db = dbc.serial_get(doc_id, file_id)
-            if serial_db is not None:
-                transaction_date_string = get_text_or_none(case, 'transaction-date/text()')
-                if transaction_date_string:
-                    transaction_date = datetime.strptime(transaction_date_string, '%Y%m%d').date()
-                else:
-                    logger.warning('Missing transaction date in XML')
-                    transaction_date = None
-                if serial_db['transaction_date'] is not None and serial_db['transaction_date'] != '':
-                    db_transaction_date = datetime.strptime(serial_db['transaction_date'], '%Y%m%d').date()
-                else:
-                    logger.warning('Missing transaction date in database')
-                    db_transaction_date = None
-                if transaction_date > db_transaction_date \
-                    or (serial_db['status'] is False and args.force) \
-                    or (transaction_date > db_transaction_date and args.parseall and args.force):
-                    for t in ('trademark_app_case_files', 'trademark_app_case_file_event_statements',
-                              'trademark_app_case_file_headers', 'trademark_app_case_file_owners',
-                              'trademark_app_case_file_statements', 'trademark_app_classifications',
-                              'trademark_app_correspondents', 'trademark_app_design_searches',
-                              'trademark_app_foreign_applications', 'trademark_app_international_registration',
-                              'trademark_app_madrid_history_events', 'trademark_app_madrid_international_filing_record',
-                              'trademark_app_prior_registration_applications', 'trademark_app_us_codes'):
-                        dbc.delete_serial(doc_id, t)
-                        dbc.cnx.commit()
-                    logger.info('[%s] Deleted serial %s from all tables', os.path.basename(filename), doc_id)
-                    logger.info('[%s] Processing existing serial number %s', os.path.basename(filename), doc_id)
-                    parse_case(case, doc_id, file_id, dbc)
-            else:
-                logger.info('[%s] Processing new serial number %s', os.path.basename(filename), doc_id)
-                parse_case(case, doc_id, file_id, dbc)
-            case.clear()
-    dbc.file_update_status(file_id, 'finished')
-    os.remove(filename)
-    logger.info('[%s] Finished parsing file in [%s sec]', os.path.basename(filename), time.time() - file_start_time)
+        local_filename = filename
+        if checkpoint is not None and resume_file(filename, file_id, dbc, label, checkpoint):
+            pass
+        # a staged file is merged in one transaction, never shard by shard
+        elif args.processes > 1 and not args.parquet and not args.staging \
+                and os.path.getsize(filename) >= SHARD_MIN_SIZE:
+            completed = parse_file_sharded(filename, file_id)
+            if index is not None:
+                # the shard processes do not update the index of this one
+                index.refresh(dbc)
+            if not completed:
+                logger.warning('[%s] Not all shards completed, file stays unfinished', label)
+                return 'unfinished'
+        else:
+            with open(filename, 'rb') as inputfile:
+                parse_source(inputfile, file_id, dbc, label)
+    elif zip_filename and os.path.isfile(zip_filename):
+        logger.info('Parsing file %s from %s' % (label, zip_filename))
+        local_filename = zip_filename
+        try:
+            open_zip_member(zip_filename).close()
+        except (zipfile.BadZipFile, IndexError):
+            logger.error('UNZIP ERROR. Deleting file %s' % zip_filename)
+            os.remove(zip_filename)
+            return 'failed'
+        parse_stream(lambda: open_zip_member(zip_filename), file_id, dbc, label, checkpoint)
+    elif url and args.stream == 'http':
+        logger.info('Parsing file %s from %s' % (label, url))
+        local_filename = None
+        parse_stream(lambda: open_http_stream(url), file_id, dbc, label, checkpoint)
+    else:
+        logger.error('[%s] Nothing to parse, file is missing', label)
+        return 'missing'
+    if not args.parquet:
+        # an export leaves the database status and the file for the database load
+        dbc.file_checkpoint(file_id, None, None)
+        dbc.file_update_status(file_id, 'finished')
+        if local_filename is not None:
+            os.remove(local_filename)
+    seconds = time.time() - file_start_time
+    file_metrics = metrics.current()
+    file_metrics.observe('tm_stage_seconds', seconds, stage='file')
+    rss = metrics.record_peak_rss(file_metrics)
+    logger.info('[%s] Finished parsing file in [%s sec], peak RSS %s MB', label, seconds,
+                rss // (1024 * 1024) if rss else 'unknown')
+    return 'finished'
 
 
 def create_logger():
@@ -333,31 +384,24 @@ def create_logger():
     return logging.getLogger(__name__)
 
 
-def download_file(url):
+def download_file(url, size=None, extract=True):
     zip_filename = os.path.join(WORK_DIR, url.split('/')[-1])
-    if 'apc18840407-' in zip_filename:
-        xml_filename = zip_filename.replace('apc18840407-20', 'apc').replace('zip', 'xml')
-    else:
-        xml_filename = zip_filename.replace('zip', 'xml')
+    xml_filename = os.path.join(WORK_DIR, xml_filename_from_url(url))
     if os.path.isfile(zip_filename) or os.path.isfile(xml_filename):
         logger.debug('File already exists.')
     else:
-        logger.debug('Downloading %s', url)
-        # NOTE the stream=True parameter
         logger.debug('Getting zip from %s' % url)
-        start_time = time.time()
-        r = requests.get(url, stream=True)
-        with open(zip_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
-        r.close()
-        logger.info('File %s downloaded in [%s sec].', zip_filename, time.time() - start_time)
-    if not os.path.isfile(xml_filename) and os.path.isfile(zip_filename):
         try:
-            zip_ref = zipfile.ZipFile(zip_filename, 'r')
-            zip_ref.extractall(WORK_DIR)
-            zip_ref.close()
+            downloader.download(url, zip_filename, expected_size=parse_size(size))
+        except DownloadError as err:
+            logger.error(err)
+            return None
+    if extract and not os.path.isfile(xml_filename) and os.path.isfile(zip_filename):
+        try:
+            with metrics.current().timer('unzip'):
+                zip_ref = zipfile.ZipFile(zip_filename, 'r')
+                zip_ref.extractall(WORK_DIR)
+                zip_ref.close()
             os.remove(zip_filename)
         except Exception:
             logger.error('UNZIP ERROR. Deleting file %s' % zip_filename)
@@ -366,8 +410,44 @@ def download_file(url):
     return xml_filename.split('/')[-1]
 
 
+def fetch_file(file):
+    """
+    Makes the listed file available for parse_file according to --stream
+    """
+    if args.stream == 'http':
+        return xml_filename_from_url(file['url'])
+    return download_file(file['url'], file['size'], extract=args.stream is None)
+
+
 def get_urls(main_url):
-    html_content = download_html(main_url)
+    """
+    Files of the listing at main_url. The parsed listing is kept in LISTING_FILE and only
+    downloaded and parsed again when the server reports a change.
+    """
+    listing = {}
+    if os.path.isfile(LISTING_FILE):
+        with open(LISTING_FILE) as f:
+            listing = json.load(f)
+        if listing.get('url') != main_url:
+            listing = {}
+    status, html_content, etag, last_modified = download_html_if_modified(
+        main_url, listing.get('etag'), listing.get('last_modified'))
+    if status == 304:
+        logger.info('Listing %s not modified since %s', main_url, listing.get('last_modified') or listing.get('etag'))
+        return listing['files']
+    if html_content is None:
+        if listing:
+            logger.warning('Could not download listing %s, using the cached one', main_url)
+        return listing.get('files')
+    files = parse_listing(html_content, main_url)
+    tmp_filename = LISTING_FILE + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump({'url': main_url, 'etag': etag, 'last_modified': last_modified, 'files': files}, f)
+    os.replace(tmp_filename, LISTING_FILE)
+    return files
+
+
+def parse_listing(html_content, main_url):
     html_tree = html.fromstring(html_content)
     html_tree.make_links_absolute(main_url)
     content = html_tree.xpath('//div[@class="container"]/table[2]//tr')
@@ -385,33 +465,55 @@ def get_urls(main_url):
 
 
 def main_worker(file):
+    with metrics.scope() as file_metrics:
+        file_metrics.add('tm_files_in_progress', 1)
+        try:
+            main_worker_scoped(file)
+        finally:
+            file_metrics.add('tm_files_in_progress', -1)
+            if args.metrics_file:
+                metrics.write_textfile(args.metrics_file)
+
+
+def main_worker_scoped(file):
     dbc = Db()
-    file_check = dbc.file_check(file)
-    if file_check is None:
-        xml_filename = download_file(file['url'])
-        if xml_filename is not None:
-            inserted_id = dbc.file_insert(file, os.path.basename(xml_filename))
+    try:
+        if 'file_check' in file:
+            file_check = file['file_check']
+        else:
+            file_check = dbc.file_check(file)
+        if file_check is None:
+            xml_filename = fetch_file(file)
+            if xml_filename is not None:
+                inserted_id = dbc.file_insert(file, os.path.basename(xml_filename))
+                try:
+                    parse_file(xml_filename, inserted_id, file['url'], dbc)
+                except Exception:
+                    logger.exception('message')
+                    raise
+        elif not file_done(file, file_check) or args.force:
+            logger.warning('File %s exists into database. Going to process again', file_check['filename'])
+            if not os.path.isfile(os.path.join(WORK_DIR, file_check['filename'])):
+                xml_filename = fetch_file(file)
+                if xml_filename is None:
+                    return
+            else:
+                xml_filename = file_check['filename']
+            checkpoint = None
+            if file_check['checkpoint_case'] is not None and not args.force and not args.parquet:
+                checkpoint = (file_check['checkpoint_case'], file_check['checkpoint_serial'])
             try:
-                parse_file(xml_filename, inserted_id)
+                parse_file(xml_filename, file_check['id'], file['url'], dbc, checkpoint)
             except Exception:
                 logger.exception('message')
                 raise
-    elif file_check['status'] in ['new', 'reparsing'] or args.force:
-        logger.warning('File %s exists into database. Going to process again', file_check['filename'])
-        if not os.path.isfile(os.path.join(WORK_DIR, file_check['filename'])):
-            xml_filename = download_file(file['url'])
         else:
-            xml_filename = file_check['filename']
-        try:
-            parse_file(xml_filename, file_check['id'])
-        except Exception:
-            logger.exception('message')
-            raise
-    else:
-        logger.info('File %s is already inserted into database. Skiping it', file_check['filename'])
-        if args.parse:
-            logger.info('Nothing to work. Exiting.')
-            exit()
+            logger.info('File %s is already inserted into database. Skiping it', file_check['filename'])
+            if args.parse:
+                logger.info('Nothing to work. Exiting.')
+                exit()
+    finally:
+        dbc.close()
 
 
 def sub_main():
@@ -420,22 +522,164 @@ def sub_main():
     # for file in files_tuple:
     #     main_worker(file)
     # sys.exit()
-    with cf.ThreadPoolExecutor(max_workers=12) as executor:
+    # one connection per file and one per loader thread of the file
+    init_pool(args.workers * (1 + args.loaders))
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+    files_tuple = pending_files(files_tuple or ())
+    try:
+        prepare_bootstrap(files_tuple)
+    except bootstrap.BootstrapError as err:
+        logger.error(err)
+        return
+    if len(files_tuple) == 0:
+        logger.info('Nothing to work. Exiting.')
+        return
+    # the Parquet loader only compares the case-files within a file
+    if args.parseall and not args.staging and not args.parquet:
+        load_index()
+    with cf.ThreadPoolExecutor(max_workers=args.workers) as executor:
         try:
             executor.map(main_worker, files_tuple)
         except Exception:
             logger.exception('message')
+    if args.bootstrap:
+        bootstrap.rebuild(args.workers, args.maintenance_work_mem)
+    if index is not None:
+        save_index()
+    if args.metrics_file:
+        metrics.write_textfile(args.metrics_file)
+
+
+def file_done(file, file_check):
+    """
+    True when the listed file is exported to --parquet, or without it finished in the database
+    """
+    if args.parquet:
+        return exported(args.parquet, xml_filename_from_url(file['url']))
+    return file_check is not None and file_check['status'] not in ['new', 'reparsing']
+
+
+def pending_files(files):
+    """
+    Listed files that are new or not finished, checked against trademark_fileinfo with one
+    query, or with --parquet not exported yet. With --parse the listing, newest first, is
+    read up to the first finished file.
+    """
+    dbc = Db()
+    try:
+        checks = dbc.files_check(files)
+    finally:
+        dbc.close()
+    result = []
+    for file in files:
+        file_check = checks.get(file['url'])
+        if file_done(file, file_check) and not args.force:
+            if args.parse and not args.parseall:
+                break
+            continue
+        result.append(dict(file, file_check=file_check))
+    logger.info('%s of %s listed files to process', len(result), len(files))
+    return result
+
+
+def prepare_bootstrap(files):
+    """
+    Drops the secondary indexes and foreign keys for --bootstrap when there are files to load.
+    Otherwise restores those an interrupted bootstrap left dropped, the loaders need the cascades.
+    """
+    dbc = Db()
+    try:
+        if args.bootstrap and len(files) > 0:
+            bootstrap.start(dbc)
+            return
+        unfinished = bootstrap.pending(dbc)
+    finally:
+        dbc.close()
+    if unfinished:
+        logger.warning('Restoring the indexes and foreign keys dropped by an unfinished bootstrap')
+        bootstrap.rebuild(args.workers, args.maintenance_work_mem)
+
+
+def load_index():
+    """
+    Loads the serial index used by the loaders of --parseall, warm from the snapshot of
+    the previous run when there is one
+    """
+    global index
+    dbc = Db()
+    try:
+        index = serial_index.load(dbc, SERIAL_INDEX_FILE)
+    finally:
+        dbc.close()
 
 
-logger = create_logger()
+def save_index():
+    """
+    Saves the serial index for the next run, which then reads only the case-files modified after this one
+    """
+    dbc = Db()
+    try:
+        index.refresh(dbc)
+        index.save(SERIAL_INDEX_FILE)
+    finally:
+        dbc.close()
+        index.close()
 
 
-if __name__ == '__main__':
+def create_parser():
     parser = argparse.ArgumentParser(description='Downloads and parses trademarks.')
     parser.add_argument('--parse', help='Parses most recent data.', action="store_true")
     parser.add_argument('--parseall', help='Parses all the data.', action="store_true")
     parser.add_argument('--force', help='Forces to discard old data, use with --parseall command.', action="store_true")
+    parser.add_argument('--workers', help='Number of files processed at the same time.', type=int, default=12)
+    parser.add_argument('--batch-size', help='Number of case-files written per COPY batch.', type=int,
+                        default=BATCH_SIZE)
+    parser.add_argument('--batch-seconds', help='Writes a batch after this many seconds even when it has fewer '
+                                                'than --batch-size case-files.', type=float, default=BATCH_SECONDS)
+    parser.add_argument('--parser', help='iterparse builds each case-file element and extracts it, target '
+                                         'fills the rows from the parser events without a tree.',
+                        choices=('iterparse', 'target'), default='iterparse')
+    parser.add_argument('--lookup-size', help='Number of case-files whose serial numbers are looked up at once.',
+                        type=int, default=LOOKUP_SIZE)
+    parser.add_argument('--processes', help='Parses large files in this many processes, not with --staging.', type=int,
+                        default=1)
+    parser.add_argument('--stream', help='Parses straight from the downloaded zip or from the download itself '
+                                         'instead of extracting the XML.', choices=('zip', 'http'))
+    parser.add_argument('--staging', help='Loads each file into staging tables and merges it in one transaction.',
+                        action="store_true")
+    parser.add_argument('--parquet', help='Writes the case-file tables as Parquet datasets under this directory '
+                                          'instead of the database, needs pyarrow.')
+    parser.add_argument('--loaders', help='Writes the case-files of each file in this many threads while it is '
+                                          'parsed, 0 writes them in the parsing thread.', type=int, default=0)
+    parser.add_argument('--queue-size', help='Number of batches parsed ahead of the --loaders threads.', type=int,
+                        default=QUEUE_SIZE)
+    parser.add_argument('--bootstrap', help='Loads an empty database without secondary indexes and foreign keys '
+                                            'and rebuilds them at the end, use with --parseall.', action="store_true")
+    parser.add_argument('--maintenance-work-mem', help='maintenance_work_mem of each index build after --bootstrap.',
+                        default=bootstrap.MAINTENANCE_WORK_MEM)
+    parser.add_argument('--parties', help='Stores owner, attorney, domestic representative and correspondent names '
+                                          'and addresses once in trademark_parties, the rows keep their hash.',
+                        action="store_true")
+    parser.add_argument('--party-cache-size', help='Number of party hashes each process remembers as stored.',
+                        type=int, default=CACHE_SIZE)
+    parser.add_argument('--metrics-file', help='Writes Prometheus metrics to this file after every file.')
+    parser.add_argument('--metrics-port', help='Serves Prometheus metrics over HTTP on this port.', type=int)
+    return parser
+
+
+logger = create_logger()
+downloader = Downloader()
+index = None
+
+
+if __name__ == '__main__':
+    parser = create_parser()
     args = parser.parse_args()
+    if args.bootstrap and (not args.parseall or args.staging or args.parquet):
+        parser.error('--bootstrap needs --parseall and the COPY loader, without --staging or --parquet')
+    if args.parties and (args.staging or args.parquet):
+        parser.error('--parties needs the COPY loader, without --staging or --parquet')
     if args.parse or args.parseall:
         os.makedirs(os.path.dirname(WORK_DIR), exist_ok=True)
         os.makedirs(os.path.dirname(LOG_DIR), exist_ok=True)
@@ -0,0 +1,121 @@
+"""
+Reads the first member of a ZIP archive from a forward-only stream.
+
+zipfile needs the central directory at the end of the archive, so it cannot read a
+download while it arrives. The bulkdata archives hold a single XML file, which can be
+inflated straight from its local file header instead.
+"""
+import struct
+import zlib
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+CHUNK_SIZE = 1024 * 1024
+FLAG_DATA_DESCRIPTOR = 0x08
+STORED = 0
+DEFLATED = 8
+
+
+class BadZipStream(Exception):
+    pass
+
+
+class ZipStream(object):
+    """
+    File-like object with the inflated content of the first member of a zip stream
+    """
+
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        header = self.read_raw_exact(LOCAL_HEADER.size)
+        (signature, version, self.flags, self.method, mod_time, mod_date, self.crc, self.compressed_size,
+         self.size, name_length, extra_length) = LOCAL_HEADER.unpack(header)
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise BadZipStream('Not a zip stream')
+        self.name = self.read_raw_exact(name_length).decode('utf-8', 'replace')
+        self.read_raw_exact(extra_length)
+        if self.method == DEFLATED:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif self.method == STORED and not self.flags & FLAG_DATA_DESCRIPTOR:
+            self.decompressor = None
+            self.remaining = self.compressed_size
+        else:
+            raise BadZipStream('Unsupported compression method %s' % self.method)
+        self.pending = b''
+        self.running_crc = 0
+        self.bytes_read = 0
+        self.eof = False
+
+    def read_raw(self, size):
+        return self.fileobj.read(size)
+
+    def read_raw_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.read_raw(size - len(data))
+            if not chunk:
+                raise BadZipStream('Unexpected end of zip stream')
+            data += chunk
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while not self.eof:
+                chunks.append(self.read(self.chunk_size))
+            return b''.join(chunks)
+        if size == 0:
+            return b''
+        while not self.eof and len(self.pending) == 0:
+            self.pending = self.inflate(size)
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+    def inflate(self, size):
+        if self.decompressor is None:
+            data = self.read_raw(min(size, self.remaining))
+            if not data and self.remaining:
+                raise BadZipStream('Unexpected end of zip stream')
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                self.eof = True
+        else:
+            compressed = self.decompressor.unconsumed_tail
+            if not compressed:
+                compressed = self.read_raw(self.chunk_size)
+                if not compressed:
+                    raise BadZipStream('Unexpected end of zip stream')
+            data = self.decompressor.decompress(compressed, size)
+            if self.decompressor.eof:
+                self.eof = True
+        self.running_crc = zlib.crc32(data, self.running_crc)
+        self.bytes_read += len(data)
+        if self.eof:
+            self.check()
+        return data
+
+    def check(self):
+        crc = self.crc
+        if self.flags & FLAG_DATA_DESCRIPTOR:
+            descriptor = self.decompressor.unused_data
+            descriptor += self.read_raw(16 - len(descriptor)) if len(descriptor) < 16 else b''
+            if descriptor[:4] == DESCRIPTOR_SIGNATURE:
+                descriptor = descriptor[4:]
+            if len(descriptor) >= 4:
+                crc = struct.unpack('<I', descriptor[:4])[0]
+        if crc != self.running_crc:
+            raise BadZipStream('CRC mismatch in %s' % self.name)
+
+    def close(self):
+        close = getattr(self.fileobj, 'close', None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()